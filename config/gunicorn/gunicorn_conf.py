@@ -0,0 +1,25 @@
+# gunicorn settings, used with: gunicorn -c config/gunicorn/gunicorn_conf.py dproject.wsgi:application
+#
+# The application is loaded in the master and the heavy subsystems (Pyomo,
+# Temoa, matplotlib, pandas) are imported there once before the workers are
+# forked, so workers start fast and share those pages copy-on-write.
+# Set TEMOA_PRELOAD=0 to let every worker import them lazily instead.
+
+import os
+
+bind = 'unix:/srv/dproject.sock'
+workers = 3
+preload_app = True
+
+
+def when_ready(server):
+  if os.environ.get('TEMOA_PRELOAD', '1') == '0':
+    return
+
+  from dapp import subsystems
+  errors = subsystems.preload()
+  for name, info in subsystems.report().items():
+    if info['loaded']:
+      server.log.info('preloaded %s in %.2fs (%d modules)', name, info['seconds'], info['modules'])
+  for name, error in errors.items():
+    server.log.warning('preloading %s failed: %s', name, error)
@@ -0,0 +1,15 @@
+# DO NOT RUN THIS SCRIPT AS IS. PLEASE GO THROUGH EACH STEP AND RUN AS REQUIRED AFTER EDITING
+#1. Create the ModelRun table
+cd /srv/
+python manage.py migrate dapp
+
+#2. Change [user] in config/jobs/temoa-jobs.service to the one which runs gunicorn
+
+#3. Copy config/jobs/temoa-jobs.service to /etc/systemd/system/
+sudo cp config/jobs/temoa-jobs.service /etc/systemd/system/
+
+#4. Run the job runner. Runs submitted to /job/submit stay queued until it is running
+sudo systemctl start temoa-jobs
+
+#5. Check if the service is running
+sudo systemctl status temoa-jobs
@@ -0,0 +1,282 @@
+"""
+Admission control for model runs. At most JOB_MAX_RUNNING runs solve at
+once, counting every running ModelRun, whether the job runner or a web
+request (runModel, runModelEvents) solves it. Queued runs start in fair
+order: each owner (signed in user or browser session) has its own FIFO
+queue, and the next run comes from the owner with the fewest runs running
+or already picked, oldest first on ties. The queue position and an
+estimated start time of a queued run are derived from the same order.
+
+Every run is solved under RunLimits, in a solver worker of the job runner
+or in a child process of the web request (jobs.run_limited): CPU time
+(the process and the solver processes it starts), wall time and address
+space (JOB_RUN_MAX_CPU_SECONDS, JOB_RUN_MAX_WALL_SECONDS,
+JOB_RUN_MAX_ADDRESS_SPACE).
+"""
+
+from django.conf import settings
+from django.utils import timezone
+
+import collections
+import ctypes
+import datetime
+import fcntl
+import heapq
+import multiprocessing
+import os
+import resource
+import signal
+import threading
+import time
+
+from .fileutils import makedirs
+from .models import ModelRun
+from . import metrics
+from . import procutils
+
+
+class Lock(object):
+  """
+  Serializes admission decisions of the job runner and the web workers
+  """
+
+  def __enter__(self):
+    makedirs(os.path.dirname(settings.JOB_ADMISSION_LOCK))
+    self.file = open(settings.JOB_ADMISSION_LOCK, 'a')
+    fcntl.flock(self.file, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, *args):
+    fcntl.flock(self.file, fcntl.LOCK_UN)
+    self.file.close()
+
+
+def max_running():
+  return settings.JOB_MAX_RUNNING or settings.JOB_WORKERS or multiprocessing.cpu_count()
+
+
+def fair_order(queued, running):
+  """
+  Queued runs (oldest first) in the order they will start, given the
+  number of running runs of each owner
+  """
+  queues = collections.OrderedDict()
+  for run in queued:
+    queues.setdefault(run.owner, collections.deque()).append(run)
+
+  load = collections.Counter(running)
+  order = []
+  while queues:
+    owner = min(queues, key=lambda o: (load[o], queues[o][0].created))
+    order.append(queues[owner].popleft())
+    load[owner] += 1
+    if not queues[owner]:
+      del queues[owner]
+
+  return order
+
+
+def _running():
+  runs = ModelRun.objects.filter(status=ModelRun.RUNNING)
+  if settings.JOB_RUN_MAX_WALL_SECONDS:
+    #left running by a process that died; its solve stopped itself at the
+    #wall time limit at the latest
+    limit = settings.JOB_RUN_MAX_WALL_SECONDS + 2 * settings.JOB_RUN_LIMIT_CHECK_INTERVAL
+    runs = runs.filter(started__gte=timezone.now() - datetime.timedelta(seconds=limit))
+  return list(runs.only('owner', 'started'))
+
+
+def _queued():
+  return ModelRun.objects.filter(status=ModelRun.QUEUED).order_by('created').only('run_id', 'owner', 'created')
+
+
+def runner_active():
+  #the job runner writes its pool stats every poll
+  try:
+    return time.time() - os.path.getmtime(settings.JOB_POOL_STATS) < 10 * settings.JOB_POLL_INTERVAL
+  except OSError:
+    return False
+
+
+def has_room():
+  """
+  Whether a run may start right now without queueing; call under Lock.
+  Queued runs come first while a job runner is there to start them.
+  """
+  if len(_running()) >= max_running():
+    return False
+  return not (runner_active() and _queued().exists())
+
+
+def admit(limit, runner=''):
+  """
+  Mark up to limit queued runs running by runner, in fair order and within
+  JOB_MAX_RUNNING. Returns their run ids.
+  """
+  claimed = []
+  with Lock():
+    running = [run.owner for run in _running()]
+    limit = min(limit, max_running() - len(running))
+    if limit <= 0:
+      return claimed
+
+    for run in fair_order(_queued(), running)[:limit]:
+      updated = ModelRun.objects.filter(pk=run.pk, status=ModelRun.QUEUED).update(
+        status=ModelRun.RUNNING, started=timezone.now(), runner=runner)
+      if updated:
+        claimed.append(run.run_id)
+
+  return claimed
+
+
+def expected_duration(limit=50):
+  """
+  Mean seconds of the latest finished runs, JOB_DEFAULT_RUN_SECONDS before
+  any has finished
+  """
+  runs = ModelRun.objects.filter(status=ModelRun.DONE, started__isnull=False, finished__isnull=False) \
+    .order_by('-finished').only('started', 'finished')[:limit]
+  durations = [(run.finished - run.started).total_seconds() for run in runs]
+  if not durations:
+    return settings.JOB_DEFAULT_RUN_SECONDS
+  return sum(durations) / len(durations)
+
+
+def queue():
+  """
+  run_id -> { position, estimated_start, estimated_wait } of every queued
+  run. Runs are assumed to take expected_duration(); running ones to need
+  what is left of it.
+  """
+  now = timezone.now()
+  running = _running()
+  duration = expected_duration()
+
+  slots = sorted(max(0, duration - (now - run.started).total_seconds()) if run.started else duration
+    for run in running)
+  slots = ([0] * max(0, max_running() - len(running)) + slots)[:max_running()]
+  heapq.heapify(slots)
+
+  result = {}
+  for position, run in enumerate(fair_order(_queued(), [run.owner for run in running]), 1):
+    wait = heapq.heappop(slots)
+    heapq.heappush(slots, wait + duration)
+    result[run.run_id] = {
+      'position' : position,
+      'estimated_wait' : round(wait, 1),
+      'estimated_start' : now + datetime.timedelta(seconds=wait),
+    }
+
+  return result
+
+
+class RunLimitExceeded(Exception):
+
+  limit = None
+  text = "Run exceeded its limits"
+
+  def __init__(self, *args):
+    #raised as a class in the run's thread, without arguments
+    Exception.__init__(self, *(args or (self.text,)))
+
+
+class CpuTimeExceeded(RunLimitExceeded):
+  limit = 'cpu_time'
+  text = "Run exceeded its CPU time limit"
+
+
+class WallTimeExceeded(RunLimitExceeded):
+  limit = 'wall_time'
+  text = "Run exceeded its wall time limit"
+
+
+def _cpu_seconds():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+class RunLimits(object):
+  """
+  Limits of one run in this process. The address space limit is set
+  with setrlimit and inherited by the solver processes; the process' own
+  RLIMIT_CPU is a backstop. A watchdog thread checks CPU time (counting
+  the solver processes) and wall time every JOB_RUN_LIMIT_CHECK_INTERVAL
+  seconds; over a limit it kills the solver processes and raises
+  RunLimitExceeded in the run's thread.
+  """
+
+  def __init__(self):
+    self.exceeded = None
+
+  def __enter__(self):
+    self.start = time.time()
+    self.cpu_start = _cpu_seconds()
+    self.thread_id = threading.current_thread().ident
+    self.rlimits = {}
+
+    if settings.JOB_RUN_MAX_ADDRESS_SPACE:
+      self._setrlimit(resource.RLIMIT_AS, settings.JOB_RUN_MAX_ADDRESS_SPACE)
+    if settings.JOB_RUN_MAX_CPU_SECONDS:
+      usage = resource.getrusage(resource.RUSAGE_SELF)
+      self._setrlimit(resource.RLIMIT_CPU,
+        int(usage.ru_utime + usage.ru_stime + 2 * settings.JOB_RUN_MAX_CPU_SECONDS))
+
+    self.done = threading.Event()
+    self.watchdog = threading.Thread(target=self._watch)
+    self.watchdog.daemon = True
+    self.watchdog.start()
+    return self
+
+  def _setrlimit(self, limit, value):
+    soft, hard = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY:
+      value = min(value, hard)
+    self.rlimits[limit] = soft
+    resource.setrlimit(limit, (value, hard))
+
+  def check(self):
+    """
+    The limit the run is over, or None
+    """
+    if settings.JOB_RUN_MAX_WALL_SECONDS and time.time() - self.start > settings.JOB_RUN_MAX_WALL_SECONDS:
+      return WallTimeExceeded
+
+    if settings.JOB_RUN_MAX_CPU_SECONDS:
+      cpu = _cpu_seconds() - self.cpu_start + sum(procutils.descendants().values())
+      if cpu > settings.JOB_RUN_MAX_CPU_SECONDS:
+        return CpuTimeExceeded
+
+    return None
+
+  def _watch(self):
+    while not self.done.wait(settings.JOB_RUN_LIMIT_CHECK_INTERVAL):
+      if self.exceeded:
+        #solvers the run starts after it was stopped
+        self.kill_solvers()
+        continue
+      exceeded = self.check()
+      if exceeded:
+        self.exceeded = exceeded
+        metrics.inc('dapp_run_limit_exceeded_total', { 'limit' : exceeded.limit })
+        self.kill_solvers()
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.thread_id), ctypes.py_object(exceeded))
+
+  def kill_solvers(self):
+    for pid in procutils.descendants():
+      try:
+        os.kill(pid, signal.SIGKILL)
+      except OSError:
+        pass
+
+  def __exit__(self, *args):
+    try:
+      self.done.set()
+      self.watchdog.join()
+      #an exception raised just as the run returned
+      ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.thread_id), None)
+    finally:
+      for limit, soft in self.rlimits.items():
+        resource.setrlimit(limit, (soft, resource.getrlimit(limit)[1]))
+      if self.exceeded:
+        self.kill_solvers()
@@ -0,0 +1,86 @@
+"""
+Aggregated output series for charting in the browser. The capacity, flow
+and emissions rows of a scenario are loaded into pandas once per worker
+and grouped by period and technology (or tech_category with
+supercategories, emissions commodity for emissions), giving the data
+generateplot draws as compact columnar json.
+"""
+
+from django.conf import settings
+
+import collections
+import os
+
+from . import dbpool
+from . import subsystems
+
+#plottype -> (series name, query returning sector, period, name, value)
+QUERIES = {
+  1 : ('capacity', 'SELECT sector, t_periods AS period, tech AS name, capacity AS value '
+    'FROM Output_CapacityByPeriodAndTech WHERE scenario = ?'),
+  2 : ('flow', 'SELECT sector, t_periods AS period, tech AS name, vflow_out AS value '
+    'FROM Output_VFlow_Out WHERE scenario = ?'),
+  3 : ('emissions', 'SELECT sector, t_periods AS period, emissions_comm AS name, emissions AS value '
+    'FROM Output_Emissions WHERE scenario = ?'),
+}
+
+_frames = collections.OrderedDict()
+
+
+def load(db_path, scenario, plottype):
+  """
+  DataFrame of the plottype rows of scenario, cached per worker until the
+  database changes
+  """
+  if plottype not in QUERIES:
+    raise ValueError("Unknown plot type %s" % plottype)
+
+  st = os.stat(db_path)
+  key = (os.path.abspath(db_path), st.st_mtime, st.st_size, scenario, plottype)
+
+  if key in _frames:
+    frame = _frames.pop(key)
+  else:
+    pd = subsystems.pandas()
+    con = dbpool.connect(db_path)
+    frame = pd.read_sql_query(QUERIES[plottype][1], con, params=(scenario,))
+    if plottype != 3:
+      categories = pd.read_sql_query('SELECT tech AS name, tech_category AS category FROM technologies', con)
+      frame = frame.merge(categories.drop_duplicates('name'), on='name', how='left')
+    while len(_frames) >= settings.PLOT_DATA_CACHE_SIZE:
+      _frames.popitem(last=False)
+
+  _frames[key] = frame
+  return frame
+
+
+def sectors(db_path, scenario, plottype):
+  return sorted(load(db_path, scenario, plottype)['sector'].dropna().unique().tolist())
+
+
+def series(db_path, scenario, plottype, sector='all', supercategories=False):
+  """
+  { 'periods' : [...], 'names' : [...], 'values' : [[value per period] per name] }
+  for one sector, or all of them
+  """
+  frame = load(db_path, scenario, plottype)
+  if sector and sector != 'all':
+    frame = frame[frame['sector'] == sector]
+
+  if frame.empty:
+    return { 'series' : QUERIES[plottype][0], 'sector' : sector or 'all', 'periods' : [], 'names' : [], 'values' : [] }
+
+  names = frame['name']
+  if supercategories and 'category' in frame:
+    #techs without a category keep their own name
+    names = frame['category'].where(frame['category'].notnull() & (frame['category'] != ''), names)
+
+  table = frame['value'].groupby([frame['period'], names]).sum().unstack(fill_value=0).sort_index()
+
+  return {
+    'series' : QUERIES[plottype][0],
+    'sector' : sector or 'all',
+    'periods' : [int(p) if float(p).is_integer() else float(p) for p in table.index],
+    'names' : [unicode(n) for n in table.columns],
+    'values' : [table[n].round(6).tolist() for n in table.columns],
+  }
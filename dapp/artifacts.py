@@ -0,0 +1,202 @@
+"""
+Generated result artifacts (run folders and zips in db_io, plot images,
+diagram folders, run config files, scratch databases, run workspaces).
+Every top level entry of an area in ARTIFACT_AREAS is tracked in
+ARTIFACT_DB with its size and last access time. The sweeper, run by the
+job runner and by manage.py sweepartifacts, removes entries older than
+the area's max_age and evicts the least recently used ones while the area
+is over its max_bytes quota.
+
+Cache folders managed by a DiskCache are excluded from their areas, they
+evict themselves. Symlinks (the shared db_io run folder names) are not
+entries; an access counts for the folder they point to, and links left
+dangling by a removed folder are dropped.
+"""
+
+from django.conf import settings
+
+import os
+import shutil
+import sqlite3
+import time
+
+from .fileutils import makedirs, tree_size
+
+_last_sweep = [0]
+
+
+def connect():
+  makedirs(os.path.dirname(settings.ARTIFACT_DB))
+  con = sqlite3.connect(settings.ARTIFACT_DB, timeout=30)
+  con.execute('PRAGMA journal_mode=WAL')
+  con.execute('CREATE TABLE IF NOT EXISTS artifacts (path TEXT PRIMARY KEY, area TEXT, size INTEGER, '
+    'mtime REAL, accessed REAL)')
+  con.execute('CREATE INDEX IF NOT EXISTS artifacts_area_accessed ON artifacts (area, accessed)')
+  con.execute('CREATE TABLE IF NOT EXISTS reclaimed (area TEXT PRIMARY KEY, entries INTEGER, bytes INTEGER, last REAL)')
+  return con
+
+
+def entry_of(path):
+  """
+  (area, top level entry path) of a path inside an area, or (None, None)
+  """
+  path = os.path.realpath(path)
+  best = (None, None, '')
+  for area, options in settings.ARTIFACT_AREAS.items():
+    root = os.path.realpath(options['path'])
+    if path.startswith(root + os.sep) and len(root) > len(best[2]):
+      name = os.path.relpath(path, root).split(os.sep)[0]
+      if name not in options.get('exclude', ()):
+        best = (area, os.path.join(root, name), root)
+  return best[0], best[1]
+
+
+def touch(*paths):
+  """
+  Record an access to the artifacts holding paths, e.g. a download
+  """
+  now = time.time()
+  entries = [entry_of(p) for p in paths]
+  entries = [(area, entry) for area, entry in entries if area]
+  if not entries:
+    return
+
+  con = connect()
+  try:
+    with con:
+      for area, entry in entries:
+        con.execute('INSERT OR IGNORE INTO artifacts VALUES (?, ?, NULL, NULL, ?)', (entry, area, now))
+        con.execute('UPDATE artifacts SET accessed = ? WHERE path = ?', (now, entry))
+  except sqlite3.Error as e:
+    #access times are a hint, never fail the request for them
+    print "Artifact access not recorded", e
+  finally:
+    con.close()
+
+
+def _remove(path):
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path, ignore_errors=True)
+  else:
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+
+def scan(con, area, options):
+  """
+  Bring the area's rows up to date with its directory. Sizes are only
+  recomputed for entries whose mtime changed.
+  """
+  root = options['path']
+  known = dict((row[0], row[1:]) for row in
+    con.execute('SELECT path, size, mtime, accessed FROM artifacts WHERE area = ?', (area,)))
+
+  present = set()
+  if os.path.isdir(root):
+    for name in os.listdir(root):
+      if name in options.get('exclude', ()):
+        continue
+      path = os.path.join(os.path.realpath(root), name)
+      try:
+        st = os.lstat(path)
+      except OSError:
+        continue
+      if os.path.islink(path):
+        if not os.path.exists(path):
+          _remove(path)
+        continue
+      present.add(path)
+
+      size, mtime, accessed = known.get(path, (None, None, None))
+      if size is None or mtime != st.st_mtime:
+        size = tree_size(path)
+        accessed = max(accessed or 0, st.st_mtime, st.st_atime if settings.ARTIFACT_USE_ATIME else 0)
+        con.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)', (path, area, size, st.st_mtime, accessed))
+
+  gone = [path for path in known if path not in present]
+  con.executemany('DELETE FROM artifacts WHERE path = ?', [(path,) for path in gone])
+
+
+def sweep_area(con, area, options, now):
+  """
+  Remove expired entries, then least recently used ones while over quota.
+  Returns (entries, bytes) removed.
+  """
+  removed = []
+  freed = 0
+  rows = con.execute('SELECT path, size, accessed FROM artifacts WHERE area = ? ORDER BY accessed', (area,)).fetchall()
+  total = sum(size or 0 for _, size, _ in rows)
+
+  for path, size, accessed in rows:
+    #entries in use (a run writing its folder, a download) are kept
+    if now - accessed < settings.ARTIFACT_MIN_AGE:
+      break
+    expired = options.get('max_age') and now - accessed > options['max_age']
+    over = options.get('max_bytes') and total > options['max_bytes']
+    if not (expired or over):
+      continue
+    _remove(path)
+    removed.append((path,))
+    total -= size or 0
+    freed += size or 0
+
+  con.executemany('DELETE FROM artifacts WHERE path = ?', removed)
+  if removed:
+    con.execute('INSERT OR IGNORE INTO reclaimed VALUES (?, 0, 0, NULL)', (area,))
+    con.execute('UPDATE reclaimed SET entries = entries + ?, bytes = bytes + ?, last = ? WHERE area = ?',
+      (len(removed), freed, now, area))
+  return len(removed), freed
+
+
+def sweep(force=False):
+  """
+  Scan and sweep every area, at most every ARTIFACT_SWEEP_INTERVAL
+  seconds unless forced. Returns area -> (entries, bytes) removed.
+  """
+  now = time.time()
+  if not force and now - _last_sweep[0] < settings.ARTIFACT_SWEEP_INTERVAL:
+    return {}
+  _last_sweep[0] = now
+
+  result = {}
+  con = connect()
+  try:
+    for area, options in settings.ARTIFACT_AREAS.items():
+      with con:
+        scan(con, area, options)
+        result[area] = sweep_area(con, area, options, now)
+  finally:
+    con.close()
+  return result
+
+
+def stats():
+  """
+  Usage, quota and reclaimed totals per area, as of the last sweep
+  """
+  con = connect()
+  try:
+    usage = dict((row[0], row[1:]) for row in
+      con.execute('SELECT area, COUNT(*), SUM(size), MIN(accessed) FROM artifacts GROUP BY area'))
+    reclaimed = dict((row[0], row[1:]) for row in con.execute('SELECT area, entries, bytes, last FROM reclaimed'))
+  finally:
+    con.close()
+
+  result = {}
+  for area, options in settings.ARTIFACT_AREAS.items():
+    entries, size, oldest = usage.get(area, (0, 0, None))
+    removed, freed, last = reclaimed.get(area, (0, 0, None))
+    result[area] = {
+      'path' : options['path'],
+      'entries' : entries,
+      'bytes' : size or 0,
+      'max_bytes' : options.get('max_bytes'),
+      'max_age' : options.get('max_age'),
+      'oldest_access' : oldest,
+      'reclaimed_entries' : removed,
+      'reclaimed_bytes' : freed,
+      'last_reclaim' : last,
+    }
+  return result
@@ -0,0 +1,155 @@
+"""
+Scenario sweeps: one input file run with a list of option variants. Each
+variant becomes a ModelRun of the same batch, so the job runner schedules
+them like any other run; the summary collects status, wall time and
+objective value per variant and a single zip of the result folders of
+its runs.
+"""
+
+from django.conf import settings
+
+import itertools
+import json
+import os
+import re
+import sqlite3
+import uuid
+
+from .models import ModelRun
+from . import jobs
+from . import zipstream
+from . import workspace
+from .handle_modelrun import generated_folder
+
+#fields of the Model Run form used only to describe the sweep itself
+SWEEP_FIELDS = ('variants', 'grid')
+
+OBJECTIVE_RE = re.compile(r'[Oo]bjective[^:\n]*:\s*([-+]?[0-9][0-9.eE+-]*)')
+
+
+def expand(post):
+  """
+  Form data of every variant. 'variants' is a json list of field -> value
+  overrides, 'grid' a json object of field -> list of values whose cartesian
+  product is added. Scenario names are made unique within the batch.
+  Raises ValueError for malformed variants or grid.
+  """
+  base = post.dict() if hasattr(post, 'dict') else dict(post)
+  for field in SWEEP_FIELDS:
+    base.pop(field, None)
+
+  overrides = json.loads(post.get('variants') or '[]')
+  if not isinstance(overrides, list) or not all(isinstance(o, dict) for o in overrides):
+    raise ValueError("variants must be a list of objects")
+
+  grid = json.loads(post.get('grid') or '{}')
+  if not isinstance(grid, dict) or not all(isinstance(v, list) for v in grid.values()):
+    raise ValueError("grid must be an object of lists")
+  if grid:
+    fields = sorted(grid)
+    for combination in itertools.product(*[grid[field] for field in fields]):
+      overrides.append(dict(zip(fields, combination)))
+
+  for override in overrides:
+    if any(isinstance(v, (dict, list)) for v in override.values()):
+      raise ValueError("variant values must be strings or numbers")
+
+  variants = []
+  scenarios = set()
+  for i, override in enumerate(overrides or [{}]):
+    variant = dict(base)
+    variant.update((k, unicode(v)) for k, v in override.items())
+
+    scenario = variant.get('scenarioname', '')
+    n = i + 1
+    while scenario in scenarios:
+      scenario = u"%s_%d" % (variant.get('scenarioname', ''), n)
+      n += 1
+    variant['scenarioname'] = scenario
+    scenarios.add(scenario)
+
+    variants.append(variant)
+
+  return variants
+
+
+def submit(post, owner=''):
+  batch_id = uuid.uuid4().hex
+  runs = [jobs.submit(variant, batch=batch_id, owner=owner) for variant in expand(post)]
+  return batch_id, runs
+
+
+def objective_value(run):
+  """
+  Objective of a finished run from the output database, else from its log
+  """
+  if run.outputfilename and run.outputfilename != '0':
+    try:
+      con = sqlite3.connect(settings.UPLOADED_DIR + run.outputfilename, timeout=1)
+      try:
+        row = con.execute("SELECT objective_value FROM Output_Objective WHERE scenario = ?", (run.scenario,)).fetchone()
+      finally:
+        con.close()
+      if row:
+        return row[0]
+    except sqlite3.Error:
+      pass
+
+  #the objective is reported at the end of the run output
+  try:
+    offset = max(0, os.path.getsize(run.log_path) - settings.RUN_LOG_TAIL_MAX_BYTES)
+  except OSError:
+    offset = 0
+  output, _ = jobs.read_output(run, offset)
+  match = OBJECTIVE_RE.findall(output)
+  return float(match[-1]) if match else None
+
+
+def get_runs(batch_id):
+  return list(ModelRun.objects.filter(batch=batch_id).order_by('id'))
+
+
+def summary(batch_id):
+  variants = []
+  for run in get_runs(batch_id):
+    wall_time = None
+    if run.started and run.finished:
+      wall_time = (run.finished - run.started).total_seconds()
+
+    variants.append({
+      "run_id" : run.run_id,
+      "scenario" : run.scenario,
+      "options" : json.loads(run.options),
+      "status" : run.status,
+      "wall_time" : wall_time,
+      "objective" : objective_value(run) if run.status == ModelRun.DONE else None,
+      "zip_path" : run.zip_path,
+      "error" : run.error,
+    })
+
+  return variants
+
+
+def combined_zip(batch_id):
+  """
+  Url streaming one zip of every finished variant's own results folder
+  (not the shared one a later run may have replaced), None until all runs
+  of the batch are finished
+  """
+  runs = get_runs(batch_id)
+  if not runs or any(run.status in (ModelRun.QUEUED, ModelRun.RUNNING) for run in runs):
+    return None
+
+  folders = []
+  roots = []
+  for run in runs:
+    folder = generated_folder(run.inputfilename, run.scenario)
+    version = workspace.versioned(folder, run.run_id)
+    if run.status == ModelRun.DONE and os.path.isdir(settings.RESULT_DIR + version):
+      folders.append(version)
+      roots.append(os.path.basename(folder))
+
+  if not folders:
+    return None
+
+  return zipstream.download_url(folders, name='batch_' + batch_id + '.zip', roots=roots)
@@ -0,0 +1,156 @@
+"""
+Content addressed store for uploaded files. Every distinct content is kept
+once as UPLOAD_STORE_DIR/<sha1>; the names in UPLOADED_DIR are hard links
+to it, so the rest of the app keeps opening plain paths. Storing a blob
+and linking a name to it happen under one store-wide lock, which garbage
+collection takes too, so a blob is never collected in between. A blob
+is collected once no name links to it, so the store has to be on the
+filesystem of UPLOADED_DIR; elsewhere uploads are kept as plain files.
+"""
+
+from django.conf import settings
+
+import fcntl
+import os
+import shutil
+import time
+import uuid
+
+from .fileutils import file_hash, makedirs
+
+_last_collect = [0]
+
+
+def blob_path(digest):
+  return settings.UPLOAD_STORE_DIR + digest
+
+
+class _locked(object):
+
+  def __enter__(self):
+    makedirs(settings.UPLOAD_STORE_DIR)
+    #next to the store, not in it: collect_garbage would take it for a blob
+    self.f = open(settings.UPLOAD_STORE_DIR.rstrip('/') + '.lock', 'a')
+    fcntl.flock(self.f, fcntl.LOCK_EX)
+
+  def __exit__(self, *args):
+    fcntl.flock(self.f, fcntl.LOCK_UN)
+    self.f.close()
+
+
+def linkable():
+  """
+  Whether names in UPLOADED_DIR can be hard links to the store
+  """
+  makedirs(settings.UPLOAD_STORE_DIR)
+  return os.stat(settings.UPLOAD_STORE_DIR).st_dev == os.stat(settings.UPLOADED_DIR).st_dev
+
+
+def _link(source, target):
+  """
+  Hard link target to source, replacing target; copies if linking fails
+  """
+  tmp = target + '.' + uuid.uuid4().hex[:8] + '.tmp'
+  try:
+    os.link(source, tmp)
+  except OSError:
+    shutil.copyfile(source, tmp)
+  os.rename(tmp, target)
+
+
+def add_blob(path, digest):
+  """
+  Move the file at path into the store as digest, unless that content is
+  stored already. Returns the blob path.
+  """
+  makedirs(settings.UPLOAD_STORE_DIR)
+  blob = blob_path(digest)
+  if os.path.isfile(blob):
+    os.remove(path)
+  else:
+    shutil.move(path, blob)
+  return blob
+
+
+def add_file(path, digest=None):
+  """
+  Deduplicate a file just written to UPLOADED_DIR: afterwards it is a link
+  to the stored blob of its content. Returns the content hash.
+  """
+  digest = digest or file_hash(path)
+  if not linkable():
+    return digest
+
+  with _locked():
+    blob = blob_path(digest)
+    if os.path.isfile(blob):
+      _link(blob, path)
+    else:
+      try:
+        os.link(path, blob)
+      except OSError:
+        #a copy would be collected at once, the file stays a plain one
+        pass
+
+  return digest
+
+
+def link(digest, path):
+  _link(blob_path(digest), path)
+
+
+def store(path, digest, target):
+  """
+  Move the file at path into the store and link target to it
+  """
+  if not linkable():
+    shutil.move(path, target)
+    return
+
+  with _locked():
+    add_blob(path, digest)
+    link(digest, target)
+
+
+def detach(path):
+  """
+  Give path its own copy of the content before it is written to (e.g. an
+  output database), so other names of the same blob are not modified
+  """
+  try:
+    if os.stat(path).st_nlink <= 1:
+      return
+  except OSError:
+    return
+
+  tmp = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+  shutil.copy2(path, tmp)
+  os.rename(tmp, path)
+
+
+def collect_garbage(force=False):
+  """
+  Remove blobs no upload name links to any more, at most every
+  UPLOAD_STORE_GC_INTERVAL seconds unless forced. Returns bytes freed.
+  """
+  freed = 0
+  now = time.time()
+  if not force and now - _last_collect[0] < settings.UPLOAD_STORE_GC_INTERVAL:
+    return freed
+  _last_collect[0] = now
+
+  if not os.path.isdir(settings.UPLOAD_STORE_DIR):
+    return freed
+
+  with _locked():
+    for name in os.listdir(settings.UPLOAD_STORE_DIR):
+      blob = blob_path(name)
+      try:
+        st = os.stat(blob)
+        if st.st_nlink <= 1:
+          os.remove(blob)
+          freed += st.st_size
+      except OSError:
+        pass
+
+  return freed
@@ -0,0 +1,128 @@
+"""
+Reader for uploaded .dat/.data model inputs. Parses the AMPL style set
+and param statements for the app's own readers: the commodity and
+technology lists (extracted once per upload by file_index) and the
+network views (assembled once per content hash by network). Temoa model
+runs and GraphvizDiagramGenerator read the .dat text with their own
+parsers.
+"""
+
+import collections
+import os
+import re
+import shlex
+
+
+DAT_TYPES = ('.dat', '.data')
+
+HEADER_RE = re.compile(r'^\s*(set|param)\b\s*(:)?\s*(.*?)\s*(?:\bdefault\s+\S+\s*)?$', re.S | re.I)
+COMMENT_RE = re.compile(r'#.*$')
+NUMBER_RE = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+#AMPL's missing value in tabular data
+MISSING = '.'
+
+#Efficiency(input_comm, tech, vintage, output_comm) = efficiency
+EFFICIENCY_INPUT, EFFICIENCY_TECH, EFFICIENCY_OUTPUT = 0, 1, 3
+EFFICIENCY_WIDTH = 5
+
+#the commodity the resource technologies draw from, not listed by get_comm_tech
+ETHOS = 'ethos'
+
+
+def is_dat(path):
+  return os.path.splitext(path)[1] in DAT_TYPES
+
+
+def _value(token):
+  #only numerals, a technology named inf or nan stays a name
+  if NUMBER_RE.match(token):
+    try:
+      return int(token)
+    except ValueError:
+      return float(token)
+  return token.decode('utf-8', 'replace')
+
+
+def _rows(body):
+  rows = []
+  for line in body.splitlines():
+    try:
+      tokens = shlex.split(line)
+    except ValueError:
+      #unbalanced quote
+      tokens = line.split()
+    if tokens:
+      rows.append([_value(t) for t in tokens])
+  return rows
+
+
+def parse(path):
+  """
+  symbol -> { 'kind' : 'set' or 'param', 'rows' : [...] } for every set
+  and param statement of the file, param rows ending with the value
+  """
+  with open(path) as f:
+    text = '\n'.join(COMMENT_RE.sub('', line) for line in f)
+
+  symbols = collections.OrderedDict()
+  for statement in text.split(';'):
+    if ':=' not in statement:
+      continue
+    header, body = statement.split(':=', 1)
+    match = HEADER_RE.match(header)
+    if not match:
+      continue
+    kind, tabular, names = match.group(1).lower(), match.group(2), match.group(3).split()
+    if not names:
+      continue
+    rows = _rows(body)
+
+    if kind == 'param' and not tabular and ':' in names:
+      #two dimensional table: param p : col1 col2 := row value1 value2
+      columns = [_value(name) for name in names[names.index(':') + 1:]]
+      symbols[names[0]] = { 'kind' : 'param', 'rows' : [[row[0], column, value]
+        for row in rows for column, value in zip(columns, row[1:]) if value != MISSING] }
+      continue
+
+    if kind == 'set':
+      #a one line set lists single elements: set s := a b c ;
+      if len(rows) == 1 and '\n' not in body.strip():
+        rows = [[element] for element in rows[0]]
+      symbols[names[0]] = { 'kind' : 'set', 'rows' : rows }
+    elif tabular:
+      #param: A B := index.. valueA valueB
+      for i, name in enumerate(names):
+        column = i - len(names)
+        symbols[name] = { 'kind' : 'param', 'rows' : [row[:-len(names)] + [row[column]]
+          for row in rows if len(row) > len(names) and row[column] != MISSING] }
+    else:
+      symbols[names[0]] = { 'kind' : 'param', 'rows' : rows }
+
+  return symbols
+
+
+def efficiency(path):
+  """
+  Complete Efficiency rows (input_comm, tech, vintage, output_comm,
+  efficiency) of the .dat file
+  """
+  symbol = parse(path).get('Efficiency')
+  return [row for row in (symbol['rows'] if symbol else []) if len(row) == EFFICIENCY_WIDTH]
+
+
+def comm_tech(path, listType):
+  """
+  Commodity or technology list of a .dat input from its Efficiency rows
+  (input_comm, tech, vintage, output_comm, efficiency), in the shape
+  get_comm_tech.get_info returns
+  """
+  rows = efficiency(path)
+  if listType == 'commodity':
+    names = set(row[EFFICIENCY_INPUT] for row in rows if row[EFFICIENCY_INPUT] != ETHOS)
+    names |= set(row[EFFICIENCY_OUTPUT] for row in rows)
+  else:
+    names = set(row[EFFICIENCY_TECH] for row in rows)
+
+  names = sorted(unicode(name) for name in names)
+  return collections.OrderedDict((name, name) for name in names)
@@ -0,0 +1,150 @@
+"""
+Per worker pool of read-only SQLite connections to uploaded databases.
+get_comm_tech, db_query, MakeOutputPlots and MakeGraphviz each open their
+own connection for every request; install(), applied by dapp.subsystems
+when it imports them, makes their sqlite3.connect return a shared
+connection for files in UPLOADED_DIR instead, reopened only when the
+file's mtime or size changes.
+
+Python 2's sqlite3 cannot open read-only (mode=ro) connections, so
+read-only is only enforced with PRAGMA query_only.
+"""
+
+from django.conf import settings
+
+import collections
+import os
+import sqlite3
+import time
+
+_connections = collections.OrderedDict()
+
+_stats = {
+  "hits" : 0,
+  "misses" : 0,
+  "invalidations" : 0,
+  "evictions" : 0,
+  "checkout_seconds" : 0.0,
+  "open_seconds" : 0.0,
+}
+
+
+class PooledConnection(object):
+  """
+  Shared connection handed to the callers; closing it leaves it open in
+  the pool and there is nothing to commit
+  """
+
+  def __init__(self, con):
+    self.__dict__['_con'] = con
+
+  def close(self):
+    pass
+
+  def commit(self):
+    pass
+
+  def __getattr__(self, name):
+    return getattr(self._con, name)
+
+  def __setattr__(self, name, value):
+    setattr(self._con, name, value)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+def _open(path):
+  start = time.time()
+  con = sqlite3.connect(path, check_same_thread=False)
+  con.execute('PRAGMA query_only = ON')
+  con.execute('PRAGMA mmap_size = %d' % settings.SQLITE_MMAP_SIZE)
+  con.execute('PRAGMA cache_size = -%d' % settings.SQLITE_CACHE_KB)
+
+  _stats["open_seconds"] += time.time() - start
+  return con
+
+
+def reset():
+  """
+  Forget the connections inherited by a forked child without closing
+  them, they belong to the parent; the child opens its own
+  """
+  _connections.clear()
+
+
+def _close(con):
+  try:
+    con.close()
+  except sqlite3.Error:
+    pass
+
+
+def connect(path):
+  start = time.time()
+  path = os.path.abspath(path)
+  st = os.stat(path)
+  version = (st.st_mtime, st.st_size)
+
+  entry = _connections.pop(path, None)
+  if entry and entry[0] == version:
+    _stats["hits"] += 1
+    con = entry[1]
+  else:
+    if entry:
+      _stats["invalidations"] += 1
+      _close(entry[1])
+    _stats["misses"] += 1
+    con = _open(path)
+    while len(_connections) >= settings.SQLITE_POOL_SIZE:
+      _, (_, old) = _connections.popitem(last=False)
+      _close(old)
+      _stats["evictions"] += 1
+
+  _connections[path] = (version, con)
+
+  #undo what a previous user of the connection set
+  con.row_factory = None
+  con.text_factory = unicode
+
+  _stats["checkout_seconds"] += time.time() - start
+  return PooledConnection(con)
+
+
+def pooled(path):
+  """
+  Whether connections to path are served from the pool
+  """
+  if not isinstance(path, basestring) or not os.path.isfile(path):
+    return False
+  return os.path.abspath(path).startswith(os.path.abspath(settings.UPLOADED_DIR))
+
+
+class _Sqlite3(object):
+  """
+  Stand-in for the sqlite3 module of the patched modules
+  """
+
+  def connect(self, database, *args, **kwargs):
+    if pooled(database):
+      return connect(database)
+    return sqlite3.connect(database, *args, **kwargs)
+
+  def __getattr__(self, name):
+    return getattr(sqlite3, name)
+
+
+def install(module):
+  if getattr(module, 'sqlite3', None) is sqlite3:
+    module.sqlite3 = _Sqlite3()
+
+
+def stats():
+  result = dict(_stats)
+  result["connections"] = len(_connections)
+  checkouts = _stats["hits"] + _stats["misses"]
+  result["avg_checkout_ms"] = 1000.0 * _stats["checkout_seconds"] / checkouts if checkouts else 0.0
+  return result
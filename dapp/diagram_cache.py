@@ -0,0 +1,95 @@
+"""
+Cache of rendered runInput diagrams. An entry holds a copy of the folder
+written by GraphvizDiagramGenerator, so switching back to a diagram does
+not reconnect to the database or run dot again.
+Entries live under result/<mode>/cache/ to stay reachable as static files.
+"""
+
+from django.conf import settings
+
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from .diskcache import DiskCache
+from . import file_catalog
+from . import zipstream
+
+MODES = ('input', 'output')
+
+caches = {}
+
+
+def get_cache(mode):
+  #the mode names the folder under RESULT_DIR
+  if mode not in MODES:
+    raise ValueError("Unknown diagram mode %s" % mode)
+  if mode not in caches:
+    caches[mode] = DiskCache(settings.RESULT_DIR + mode + '/cache/', settings.DIAGRAM_CACHE_MAX_BYTES)
+  return caches[mode]
+
+
+def _prefix(filename):
+  return re.sub(r'[^A-Za-z0-9_.-]', '_', filename) + '-'
+
+
+def diagram_key(filename, scenario, mode, type, value, period, format, colorscheme):
+  options = [file_catalog.content_hash(filename), scenario, mode, type, value, period, format, colorscheme]
+  return _prefix(filename) + hashlib.sha1(json.dumps(options)).hexdigest()
+
+
+def lookup(mode, key):
+  """
+  (imagepath relative to result/<mode>, zip download url) as returned by
+  runInput, or None on a miss
+  """
+  entry = get_cache(mode).get(key)
+  if entry is None:
+    return None
+
+  with open(os.path.join(entry, 'image')) as f:
+    image = f.read()
+
+  return _paths(mode, entry, image)
+
+
+def store(mode, key, folderpath, imagepath):
+  """
+  Cache a rendered diagram and return its paths like lookup, or None if
+  the image is not inside the rendered folder
+  """
+  image = os.path.relpath(imagepath, folderpath)
+  if image.startswith(os.pardir):
+    return None
+
+  folder = os.path.basename(os.path.normpath(folderpath))
+  image = os.path.join(folder, image)
+
+  def build(entry):
+    shutil.copytree(folderpath, os.path.join(entry, folder))
+    with open(os.path.join(entry, 'image'), 'w') as f:
+      f.write(image)
+
+  entry = get_cache(mode).put(key, build)
+  return _paths(mode, entry, image)
+
+
+def _paths(mode, entry, image):
+  folder = image.split(os.sep)[0]
+  imagepath = os.path.relpath(os.path.join(entry, image), os.path.join(settings.RESULT_DIR, mode))
+  zip_file_path = zipstream.download_url([os.path.relpath(os.path.join(entry, folder), settings.RESULT_DIR)])
+  return imagepath, zip_file_path
+
+
+def invalidate_file(filename):
+  """
+  Drop every cached diagram of an uploaded file
+  """
+  for mode in MODES:
+    get_cache(mode).invalidate_prefix(_prefix(filename))
+
+
+def stats():
+  return dict((mode, get_cache(mode).stats()) for mode in MODES)
@@ -0,0 +1,170 @@
+"""
+runInput diagrams. A diagram is rendered by GraphvizDiagramGenerator and
+dot, then kept in the diagram cache. In output mode the diagrams of many
+periods are rendered at once in a process pool created for the request,
+each in its own folder, and returned as one manifest and one zip. Periods
+not rendered within DIAGRAM_TIMEOUT are reported as errors, and the pool's
+processes are killed with the dot processes they started.
+"""
+
+from django.conf import settings
+
+import multiprocessing
+import os
+import shutil
+import signal
+import time
+import uuid
+
+from . import dbpool
+from . import diagram_cache
+from . import file_index
+from . import metrics
+from . import subsystems
+from . import zipstream
+
+
+def render(filename, scenario, mode, type, value, period, format, colorscheme, outDir=None):
+  """
+  Render one diagram, or take it from the cache. Returns a dict with the
+  image path relative to result/<mode>, the zip url, the diagram folder
+  relative to RESULT_DIR and an error message.
+  """
+  result = { "filename" : '', "zip_path" : '', "folder" : '', "error" : '' }
+
+  key = diagram_cache.diagram_key(filename, scenario, mode, type, value, period, format, colorscheme)
+  cached = diagram_cache.lookup(mode, key)
+  if cached:
+    result['filename'], result['zip_path'] = cached
+    result['folder'] = _folder(mode, result['filename'])
+    return result
+
+  outDir = outDir or settings.RESULT_DIR + mode
+  graphGen = subsystems.MakeGraphviz().GraphvizDiagramGenerator(dbFile=settings.UPLOADED_DIR+filename, scenario=scenario, outDir=outDir, verbose=1)
+  graphGen.connect()
+  graphGen.setGraphicOptions(greyFlag = (colorscheme == "grey"))
+
+  if (mode == "input"):
+    if (type == 'commodity'):
+      folderpath, imagepath = graphGen.createCompleteInputGraph(inp_comm=value, outputFormat=format)
+    elif (type == 'technology'):
+      folderpath, imagepath = graphGen.createCompleteInputGraph(inp_tech=value, outputFormat=format)
+    else:
+      folderpath, imagepath = graphGen.createCompleteInputGraph(outputFormat=format)
+  elif (mode == 'output'):
+    if (type == 'commodity' and (value != "")):
+      folderpath, imagepath = graphGen.CreateCommodityPartialResults(period = period, comm=value, outputFormat=format)
+    elif (type == 'technology' and (value != "")):
+      folderpath, imagepath = graphGen.CreateTechResultsDiagrams(period = period, tech=value, outputFormat=format)
+    else:
+      folderpath, imagepath = graphGen.CreateMainResultsDiagram(period = period, outputFormat=format)
+
+  graphGen.close()
+
+  print "output_file_path = ", imagepath
+  if not os.path.exists(imagepath):
+    result['error'] = "The selected technology or commodity doesn't exist for selected period"
+  elif not os.path.exists(folderpath):
+    result['error'] = "Folder is missing at " + folderpath
+  else:
+    cached = diagram_cache.store(mode, key, folderpath, imagepath)
+    if cached:
+      result['filename'], result['zip_path'] = cached
+      result['folder'] = _folder(mode, result['filename'])
+    else:
+      result['folder'] = os.path.relpath(folderpath, settings.RESULT_DIR)
+      result['zip_path'] = zipstream.download_url([result['folder']])
+      result['filename'] = os.path.relpath(imagepath, os.path.join(settings.RESULT_DIR, mode))
+
+  return result
+
+
+def _folder(mode, imagepath):
+  #cached images are <entry>/<folder>/...
+  parts = imagepath.split(os.sep)
+  return os.path.join(mode, parts[0], parts[1], parts[2])
+
+
+def periods(filename, scenario):
+  """
+  Periods of scenario from the output database's period list
+  """
+  data = file_index.get_list(filename, 'period')
+  values = data.get(scenario, []) if isinstance(data, dict) else data
+  if isinstance(values, dict):
+    values = values.values()
+  return sorted(values)
+
+
+def _render_period(args):
+  filename, scenario, type, value, period, format, colorscheme = args
+
+  #separate folders, so concurrent renders do not write over each other
+  outDir = settings.RESULT_DIR + 'output/render/' + uuid.uuid4().hex
+  try:
+    result = render(filename, scenario, 'output', type, value, str(period), format, colorscheme, outDir)
+  except Exception as e:
+    print e
+    metrics.record_error(e, 'runinput')
+    result = { "filename" : '', "zip_path" : '', "folder" : '', "error" : 'An error occured. Please try again.' }
+
+  if not result['folder'].startswith(os.path.relpath(outDir, settings.RESULT_DIR)):
+    shutil.rmtree(outDir, ignore_errors=True)
+
+  result['period'] = period
+  return result
+
+
+def _init_worker():
+  #what the forked web worker had open is not the render process' to use
+  metrics.reset()
+  dbpool.reset()
+  #a process group per worker, so a hung render is killed with its dot
+  os.setpgrp()
+
+
+def _kill(pool):
+  for process in pool._pool:
+    try:
+      os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+      pass
+  pool.terminate()
+
+
+def render_periods(filename, scenario, type, value, period_list, format, colorscheme):
+  """
+  Render the output diagram of every period. Returns the manifest (one
+  render result per period) and the url of one zip of all diagrams.
+  """
+  pool = multiprocessing.Pool(max(1, min(settings.DIAGRAM_WORKERS, len(period_list))), _init_worker)
+  deadline = time.time() + settings.DIAGRAM_TIMEOUT
+  manifest = []
+  timed_out = False
+  try:
+    pending = [(period, pool.apply_async(_render_period, ((filename, scenario, type, value, period, format, colorscheme),)))
+      for period in period_list]
+
+    for period, result in pending:
+      try:
+        manifest.append(result.get(max(0, deadline - time.time())))
+      except multiprocessing.TimeoutError:
+        timed_out = True
+        manifest.append({ "filename" : '', "zip_path" : '', "folder" : '', "period" : period,
+          "error" : 'Rendering the diagram took too long' })
+  finally:
+    #hung or interrupted renders would keep the pool from closing
+    if timed_out or len(manifest) < len(period_list):
+      _kill(pool)
+    else:
+      pool.close()
+    pool.join()
+
+  done = [r for r in manifest if r['folder']]
+  zip_path = ''
+  if done:
+    zip_path = zipstream.download_url([r['folder'] for r in done],
+      name='%s_%s_periods.zip' % (os.path.splitext(filename)[0], scenario),
+      roots=['%s/%s' % (r['period'], os.path.basename(r['folder'])) for r in done])
+
+  return manifest, zip_path
@@ -0,0 +1,134 @@
+import os
+import shutil
+import time
+import uuid
+
+from .fileutils import makedirs, tree_size
+
+
+class DiskCache(object):
+  """
+  Directory per key under root, evicted least recently used first once the
+  total size passes max_bytes. An entry's mtime is its last access time and
+  its size is kept in a .size file so eviction does not walk every entry.
+  Entries are built in a temporary directory and renamed into place, so
+  concurrent workers never see a half written entry; when two workers build
+  the same key the first entry stays and the second build is dropped.
+  """
+
+  SIZE_FILE = '.size'
+
+  def __init__(self, root, max_bytes):
+    self.root = root
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def path(self, key):
+    return os.path.join(self.root, key)
+
+  def get(self, key):
+    """
+    Entry directory for key, or None on a miss
+    """
+    entry = self.path(key)
+    if os.path.isfile(os.path.join(entry, self.SIZE_FILE)):
+      try:
+        os.utime(entry, None)
+      except OSError:
+        pass
+      self.hits += 1
+      return entry
+
+    self.misses += 1
+    return None
+
+  def put(self, key, build):
+    """
+    Create the entry for key by calling build(directory) and return its
+    path. An existing entry is kept, invalidate first to replace it.
+    """
+    makedirs(self.root)
+    tmp = os.path.join(self.root, '.tmp_' + uuid.uuid4().hex)
+    os.makedirs(tmp)
+
+    try:
+      build(tmp)
+      with open(os.path.join(tmp, self.SIZE_FILE), 'w') as f:
+        f.write(str(tree_size(tmp)))
+
+      entry = self.path(key)
+      try:
+        os.rename(tmp, entry)
+      except OSError:
+        #built meanwhile by another worker, which may be reading it already
+        if not os.path.isfile(os.path.join(entry, self.SIZE_FILE)):
+          raise
+    finally:
+      if os.path.exists(tmp):
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    self.evict()
+    return entry
+
+  def invalidate(self, key):
+    #renamed away first, so the entry is gone at once rather than half removed
+    trash = os.path.join(self.root, '.old_' + uuid.uuid4().hex)
+    try:
+      os.rename(self.path(key), trash)
+    except OSError:
+      return
+    shutil.rmtree(trash, ignore_errors=True)
+
+  def invalidate_prefix(self, prefix):
+    if not os.path.isdir(self.root):
+      return
+    for key in os.listdir(self.root):
+      if key.startswith(prefix):
+        self.invalidate(key)
+
+  def entries(self):
+    """
+    (mtime, size, key) for every complete entry
+    """
+    result = []
+    if not os.path.isdir(self.root):
+      return result
+
+    for key in os.listdir(self.root):
+      if key.startswith('.'):
+        continue
+      entry = self.path(key)
+      try:
+        with open(os.path.join(entry, self.SIZE_FILE)) as f:
+          size = int(f.read() or 0)
+        result.append((os.path.getmtime(entry), size, key))
+      except (IOError, OSError, ValueError):
+        continue
+
+    return result
+
+  def evict(self):
+    entries = sorted(self.entries())
+    total = sum(size for _, size, _ in entries)
+
+    for _, size, key in entries:
+      if total <= self.max_bytes:
+        break
+      self.invalidate(key)
+      total -= size
+      self.evictions += 1
+
+    return total
+
+  def stats(self):
+    entries = self.entries()
+    return {
+      "entries" : len(entries),
+      "bytes" : sum(size for _, size, _ in entries),
+      "max_bytes" : self.max_bytes,
+      "hits" : self.hits,
+      "misses" : self.misses,
+      "evictions" : self.evictions,
+    }
@@ -0,0 +1,272 @@
+"""
+Catalog of the uploaded files (name, size, mtime, type and hash) kept in
+UPLOADED_DIR/.index/catalog.json and in memory per worker. It is rescanned
+when the directory mtime changes; uploads and model runs update their
+file's entry directly since rewriting a file leaves the directory as is.
+Changes are made under a file lock, re-reading the catalog first, and a
+worker reloads catalog.json when another process replaced it.
+
+Requests never hash files: a new entry takes the hash the upload already
+computed, else it is null until fill_hashes (run by the job runner)
+hashes it.
+"""
+
+from django.conf import settings
+
+import collections
+import fcntl
+import hashlib
+import json
+import os
+
+from .fileutils import file_hash, makedirs
+from . import file_index
+
+
+TYPES = collections.OrderedDict([
+  ('.data', 'dat'),
+  ('.dat', 'dat'),
+  ('.sqlite', 'sqlite'),
+  ('.sqlite3', 'sqlite'),
+])
+
+MODE_TYPES = {
+  'input' : ('.data', '.sqlite', '.sqlite3', '.dat'),
+  'output' : ('.sqlite', '.sqlite3'),
+}
+
+CATALOG_FILE = 'catalog.json'
+
+_catalog = {}
+#(inode, mtime, size) of the catalog.json _catalog was read from or written to
+_catalog_file = [None]
+
+
+def catalog_path():
+  return settings.UPLOADED_DIR + file_index.INDEX_DIR + CATALOG_FILE
+
+
+class _locked(object):
+
+  def __enter__(self):
+    makedirs(settings.UPLOADED_DIR + file_index.INDEX_DIR)
+    self.f = open(catalog_path() + '.lock', 'a')
+    fcntl.flock(self.f, fcntl.LOCK_EX)
+
+  def __exit__(self, *args):
+    fcntl.flock(self.f, fcntl.LOCK_UN)
+    self.f.close()
+
+
+def _entry(name, previous=None, digest=None):
+  path = settings.UPLOADED_DIR + name
+  st = os.stat(path)
+
+  if previous and previous['size'] == st.st_size and previous['mtime'] == st.st_mtime:
+    if digest and not previous['hash']:
+      previous['hash'] = digest
+    return previous
+
+  if not digest:
+    #the upload index already hashed the file
+    index = file_index.get_index(name)
+    digest = index['hash'] if index else None
+
+  entry = collections.OrderedDict()
+  entry['name'] = name
+  entry['size'] = st.st_size
+  entry['mtime'] = st.st_mtime
+  entry['type'] = TYPES[os.path.splitext(name)[1]]
+  entry['hash'] = digest
+  return entry
+
+
+def _file_version(st):
+  return (st.st_ino, st.st_mtime, st.st_size)
+
+
+def _version(files):
+  return hashlib.sha1(json.dumps(files)).hexdigest()
+
+
+def _save(catalog):
+  global _catalog
+  catalog['version'] = _version(catalog['files'])
+
+  makedirs(settings.UPLOADED_DIR + file_index.INDEX_DIR)
+  tmp = catalog_path() + '.%d.tmp' % os.getpid()
+  with open(tmp, 'w') as f:
+    json.dump(catalog, f)
+    f.flush()
+    #the rename keeps the inode
+    version = _file_version(os.fstat(f.fileno()))
+  os.rename(tmp, catalog_path())
+
+  _catalog = catalog
+  _catalog_file[0] = version
+  return catalog
+
+
+def _load():
+  try:
+    with open(catalog_path()) as f:
+      version = _file_version(os.fstat(f.fileno()))
+      catalog = json.load(f, object_pairs_hook=collections.OrderedDict)
+  except (IOError, ValueError):
+    return None
+  catalog['_file'] = version
+  return catalog
+
+
+def _use(catalog):
+  global _catalog
+  _catalog_file[0] = catalog.pop('_file', None)
+  _catalog = catalog
+  return catalog
+
+
+def _unchanged():
+  try:
+    return _file_version(os.stat(catalog_path())) == _catalog_file[0]
+  except OSError:
+    return False
+
+
+def scan(previous=None):
+  """
+  Rebuild the catalog from the directory, reusing the entries of files
+  that did not change; call under _locked
+  """
+  old = dict((e['name'], e) for e in (previous or {}).get('files', []))
+  dir_mtime = os.stat(settings.UPLOADED_DIR).st_mtime
+
+  files = []
+  for name in os.listdir(settings.UPLOADED_DIR):
+    if os.path.splitext(name)[1] not in TYPES:
+      continue
+    try:
+      files.append(_entry(name, old.get(name)))
+    except OSError:
+      #removed while scanning
+      pass
+
+  files.sort(key=lambda e: e['name'].lower())
+  return _save({ 'dir_mtime' : dir_mtime, 'files' : files })
+
+
+def get_catalog():
+  dir_mtime = os.stat(settings.UPLOADED_DIR).st_mtime
+
+  #updates and hashing in other processes replace catalog.json only
+  if _catalog.get('dir_mtime') == dir_mtime and _unchanged():
+    return _catalog
+
+  catalog = _load()
+  if catalog and catalog.get('dir_mtime') == dir_mtime:
+    return _use(catalog)
+
+  with _locked():
+    return _current()
+
+
+def _current():
+  """
+  The catalog on disk, rescanned if it is stale; call under _locked
+  """
+  catalog = _load()
+  if catalog and catalog.get('dir_mtime') == os.stat(settings.UPLOADED_DIR).st_mtime:
+    return _use(catalog)
+  if catalog:
+    catalog.pop('_file')
+  return scan(catalog or _catalog)
+
+
+def update(name, digest=None):
+  """
+  Refresh the entry of an uploaded, overwritten or deleted file, with its
+  content hash if the caller knows it
+  """
+  with _locked():
+    catalog = _current()
+    files = [e for e in catalog['files'] if e['name'] != name]
+    previous = [e for e in catalog['files'] if e['name'] == name]
+
+    if os.path.splitext(name)[1] in TYPES and os.path.isfile(settings.UPLOADED_DIR + name):
+      files.append(_entry(name, previous[0] if previous else None, digest))
+      files.sort(key=lambda e: e['name'].lower())
+
+    return _save({ 'dir_mtime' : os.stat(settings.UPLOADED_DIR).st_mtime, 'files' : files })
+
+
+def fill_hashes():
+  """
+  Hash the files whose entry has none yet. The files are hashed without
+  the lock; a file changed meanwhile keeps its new entry.
+  """
+  missing = [e for e in get_catalog()['files'] if not e['hash']]
+  hashes = {}
+  for entry in missing:
+    try:
+      hashes[(entry['name'], entry['size'], entry['mtime'])] = file_hash(settings.UPLOADED_DIR + entry['name'])
+    except (IOError, OSError):
+      pass
+  if not hashes:
+    return 0
+
+  with _locked():
+    catalog = _current()
+    filled = 0
+    for entry in catalog['files']:
+      digest = hashes.get((entry['name'], entry['size'], entry['mtime']))
+      if digest and not entry['hash']:
+        entry['hash'] = digest
+        filled += 1
+    _save(catalog)
+  return filled
+
+
+def content_hash(name):
+  """
+  Hash of an uploaded file as recorded in the catalog; the file is hashed
+  only when its entry has no hash yet or is out of date
+  """
+  path = settings.UPLOADED_DIR + name
+  st = os.stat(path)
+  for entry in get_catalog()['files']:
+    if entry['name'] == name:
+      if entry['hash'] and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+        return entry['hash']
+      break
+  return file_hash(path)
+
+
+def path_hash(path):
+  """
+  content_hash for a path, hashing files outside UPLOADED_DIR
+  """
+  directory, name = os.path.split(path)
+  if os.path.abspath(directory) == os.path.abspath(settings.UPLOADED_DIR):
+    return content_hash(name)
+  return file_hash(path)
+
+
+def version():
+  return get_catalog()['version']
+
+
+def listing(mode, prefix='', page=1, per_page=None):
+  """
+  (entries, total) of the files usable in mode whose name starts with
+  prefix (case insensitive). Without per_page every match is returned.
+  """
+  types = MODE_TYPES.get(mode, MODE_TYPES['output'])
+  prefix = prefix.lower()
+
+  files = [e for e in get_catalog()['files']
+    if os.path.splitext(e['name'])[1] in types and e['name'].lower().startswith(prefix)]
+
+  if not per_page:
+    return files, len(files)
+
+  start = (max(page, 1) - 1) * per_page
+  return files[start:start + per_page], len(files)
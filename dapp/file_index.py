@@ -0,0 +1,141 @@
+"""
+Sidecar metadata index for uploaded files. When an upload finishes the
+commodity, technology, scenario and period lists, table row counts and
+the content hash are extracted once and stored as json next to the
+uploads, so loadCTList does not re-parse the .dat file or rescan the
+database for every dropdown.
+"""
+
+from django.conf import settings
+
+import collections
+import json
+import os
+import sqlite3
+
+from .fileutils import file_hash, makedirs
+from . import dbpool
+from . import dat_reader
+from . import subsystems
+
+#list type -> get_comm_tech.get_info flag
+LIST_FLAGS = collections.OrderedDict([
+  ('commodity', '--comm'),
+  ('technology', '--tech'),
+  ('scenario', '--scenario'),
+  ('period', '--period'),
+])
+
+INDEX_DIR = '.index/'
+
+
+def index_path(filename):
+  return settings.UPLOADED_DIR + INDEX_DIR + filename + '.json'
+
+
+def extract_list(filename, listType):
+  if dat_reader.is_dat(filename):
+    if listType in ('commodity', 'technology'):
+      return dat_reader.comm_tech(settings.UPLOADED_DIR + filename, listType)
+    if listType in ('scenario', 'period'):
+      raise ValueError('Scenarios and periods are only in output databases (.sqlite)')
+
+  input = {"--input" : settings.UPLOADED_DIR + filename}
+  if listType in LIST_FLAGS:
+    input[LIST_FLAGS[listType]] = True
+  return subsystems.get_comm_tech().get_info(input)
+
+
+def _jsonable(data):
+  if isinstance(data, (set, frozenset)):
+    return sorted(data)
+  if isinstance(data, dict):
+    return collections.OrderedDict((k, _jsonable(v)) for k, v in data.items())
+  if isinstance(data, (list, tuple)):
+    return [_jsonable(v) for v in data]
+  return data
+
+
+def row_counts(path):
+  counts = collections.OrderedDict()
+  cur = dbpool.connect(path).cursor()
+  tables = [row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+  for table in tables:
+    counts[table] = cur.execute('SELECT COUNT(*) FROM "%s"' % table.replace('"', '""')).fetchone()[0]
+  return counts
+
+
+def build_index(filename):
+  path = settings.UPLOADED_DIR + filename
+  st = os.stat(path)
+
+  index = collections.OrderedDict()
+  index['filename'] = filename
+  index['size'] = st.st_size
+  index['mtime'] = st.st_mtime
+  index['hash'] = file_hash(path)
+  index['lists'] = collections.OrderedDict()
+  index['errors'] = collections.OrderedDict()
+
+  for listType in LIST_FLAGS:
+    try:
+      index['lists'][listType] = _jsonable(extract_list(filename, listType))
+    except Exception as e:
+      index['errors'][listType] = str(e)
+
+  if os.path.splitext(filename)[1] in ('.sqlite', '.sqlite3'):
+    try:
+      index['row_counts'] = row_counts(path)
+    except sqlite3.Error as e:
+      index['errors']['row_counts'] = str(e)
+
+  makedirs(settings.UPLOADED_DIR + INDEX_DIR)
+  tmp = index_path(filename) + '.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(index, f)
+  os.rename(tmp, index_path(filename))
+
+  return index
+
+
+def get_index(filename):
+  """
+  Index of an uploaded file, or None if it is missing or the file changed
+  since it was built
+  """
+  try:
+    with open(index_path(filename)) as f:
+      index = json.load(f, object_pairs_hook=collections.OrderedDict)
+    st = os.stat(settings.UPLOADED_DIR + filename)
+  except (IOError, OSError, ValueError):
+    return None
+
+  if index.get('size') != st.st_size or index.get('mtime') != st.st_mtime:
+    return None
+
+  return index
+
+
+def get_list(filename, listType):
+  """
+  get_comm_tech.get_info result for listType, served from the index and
+  rebuilt first when the index is stale
+  """
+  if listType not in LIST_FLAGS:
+    return extract_list(filename, listType)
+
+  index = get_index(filename)
+  if index is None:
+    index = build_index(filename)
+
+  if listType in index['errors']:
+    raise ValueError(index['errors'][listType])
+
+  return index['lists'][listType]
+
+
+def remove_index(filename):
+  try:
+    os.remove(index_path(filename))
+  except OSError:
+    pass
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import shutil
+import subprocess
+
+#(path, mtime, size) -> sha1 of file contents, so unchanged files are hashed once per worker
+_hashes = {}
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+  st = os.stat(path)
+  key = (os.path.abspath(path), st.st_mtime, st.st_size)
+
+  if key not in _hashes:
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+        sha.update(block)
+    _hashes[key] = sha.hexdigest()
+
+  return _hashes[key]
+
+
+def tree_size(path):
+  if os.path.isfile(path):
+    return os.path.getsize(path)
+
+  total = 0
+  for root, dirs, files in os.walk(path):
+    for name in files:
+      try:
+        total += os.path.getsize(os.path.join(root, name))
+      except OSError:
+        pass
+
+  return total
+
+
+def makedirs(path):
+  if not os.path.isdir(path):
+    try:
+      os.makedirs(path)
+    except OSError:
+      #created concurrently by another worker
+      if not os.path.isdir(path):
+        raise
+
+
+def clone_file(source, target, link=False):
+  """
+  Copy source to target as cheaply as the filesystem allows: a hardlink
+  if link is set (only for files that are replaced, never written in
+  place), a reflink sharing blocks until either side is written, or a
+  plain copy. Returns the method used.
+  """
+  if link:
+    try:
+      os.link(source, target)
+      return 'link'
+    except OSError:
+      pass
+
+  with open(os.devnull, 'w') as devnull:
+    if subprocess.call(['cp', '--reflink=always', source, target], stdout=devnull, stderr=devnull) == 0:
+      return 'reflink'
+
+  shutil.copyfile(source, target)
+  return 'copy'
@@ -1,9 +1,17 @@
 from django.conf import settings
 import collections
 
-import uuid, os
+import uuid, os, shutil
 
-from thirdparty.temoa.temoa_model import temoa_model
+import subsystems
+import result_cache
+import zipstream
+import result_writer
+import runlog
+import mga
+import file_catalog
+import artifacts
+import workspace
 
 def create_config(values):
 
@@ -76,7 +84,57 @@ def extractFlags(values, flags):
       values["--{0}".format(val[0])] = ""
       
 
-def run_model(request):
+def build_values(post, run_id=None, space=None):
+  """
+  Config options for a run, built from the Model Run form data
+  (request.POST or the options dict stored with a background run).
+  With a run_id Temoa writes its debug logs to that run's own folder,
+  with a workspace it writes its run folder there.
+  """
+    
+  values = collections.OrderedDict()
+  
+  inputfilename = post.get("inputdatafilename", "")
+  values['--input'] = settings.UPLOADED_DIR + inputfilename
+  output_filename = post.get("outputdatafilename", "")
+  if output_filename != '0':
+      values['--output'] = settings.UPLOADED_DIR + output_filename
+  values["--scenario"] =post.get("scenarioname", "")
+  values["--solver"] =post.get("solver", "")
+  values["--path_to_db_io"] =   space.dir("db_io") if space else settings.RESULT_DIR + "db_io"
+  if run_id:
+    values["--path_to_logs"]=     runlog.debug_dir(run_id)
+  else:
+    values["--path_to_logs"]=     settings.RESULT_DIR + "debug_logs"
+
+  runoption =post.get("runoption", "")
+  
+  extractFlags(values, post.get("custom_flags","") )
+  
+  if runoption == "Uncertainty-Analysis" :
+    values["--mga"] = "{" + \
+      "\n  slack=" + post.get("MGASlackValue", "") + \
+      "\n  iteration=" + post.get("NumberofMGAIterations", "") + \
+      "\n  weight=" + post.get("MGAWeightingMethod", "") + \
+    "\n}"
+  
+  
+  
+  if post.get("createspreadsheetoption", "") :
+    values['--saveEXCEL'] = ""
+  
+  #OPTION is missing
+  if post.get("createtextfileoption", ""):
+    values['--saveTEXTFILE'] = ""
+  #  values['--generate_solver_text_file'] = ""
+  
+  if post.get("generatelpfileoption", ""):
+    values["--keep_pyomo_lp_file"] = ""
+
+  return values
+
+
+def run_model(post, values=None, space=None):
   
   #print ( "this is a very %s" % ("someman")
       #"long string too"
@@ -85,70 +143,133 @@ def run_model(request):
 
 
   #need to create config with form post data
-  if request.method == 'POST':
-    
-    values = collections.OrderedDict()
+  if post:
     
-    inputfilename = request.POST.get("inputdatafilename", "")
-    values['--input'] = settings.UPLOADED_DIR + inputfilename
-    output_filename = request.POST.get("outputdatafilename", "")
-    if output_filename != '0':
-        values['--output'] = settings.UPLOADED_DIR + output_filename
-    values["--scenario"] =request.POST.get("scenarioname", "")
-    values["--solver"] =request.POST.get("solver", "")
-    values["--path_to_db_io"] =   settings.RESULT_DIR + "db_io"
-    values["--path_to_logs"]=     settings.RESULT_DIR + "debug_logs"
+    if values is None:
+      values = build_values(post)
 
-    runoption =request.POST.get("runoption", "")
-    
-    extractFlags(values, request.POST.get("custom_flags","") )
-    
-    print "values", values
-    
-    if runoption == "Uncertainty-Analysis" :
-      values["--mga"] = "{" + \
-        "\n  slack=" + request.POST.get("MGASlackValue", "") + \
-        "\n  iteration=" + request.POST.get("NumberofMGAIterations", "") + \
-        "\n  weight=" + request.POST.get("MGAWeightingMethod", "") + \
-      "\n}"
-    
-    
-    
-    if request.POST.get("createspreadsheetoption", "") :
-      values['--saveEXCEL'] = ""
-    
-    #OPTION is missing
-    if request.POST.get("createtextfileoption", ""):
-      values['--saveTEXTFILE'] = ""
-    #  values['--generate_solver_text_file'] = ""
-    
-    if request.POST.get("generatelpfileoption", ""):
-      values["--keep_pyomo_lp_file"] = ""
-    
-   
-    
-    filename = create_config(values)
-    
-    #yield "About to call runmodel UI\n"
-    for k in temoa_model.runModelUI(filename):
-      #yield "<div>"+k+"</div>"
-      yield k
-      #yield " " * 1024
-    
-    
-    #Remove this temp config file
-    
-    #uncomment below on production 
-    #os.remove(filename)
-    
-    
-    #print "DATA"
-    generatedfolderpath =  settings.RESULT_DIR + "db_io/" + os.path.splitext(inputfilename)[0] + "_" + values["--scenario"] + "_model"
+    #the solve reads a clone of the input in its workspace, only made when
+    #the run is not served from the result cache
+    inputfile = values['--input']
+    if space:
+      values['--input'] = space.clone_input(inputfile)
+
+    #results are written into a scratch copy of the output database and
+    #merged into the shared one after the solve
+    output = values.get('--output')
+    scratch = None
+    if output:
+      scratch = result_writer.scratch_copy(output, space and space.dir("output"))
+      values['--output'] = scratch
+
+    filename = None
+    try:
+      filename = create_config(values)
+
+      lines = subsystems.temoa_model().runModelUI(filename)
+      if "--mga" in values:
+        lines = mga.progress(values, lines)
+
+      #yield "About to call runmodel UI\n"
+      for k in lines:
+        #yield "<div>"+k+"</div>"
+        yield k
+        #yield " " * 1024
+
+      if scratch:
+        yield result_writer.merge(scratch, output, values["--scenario"])
+    finally:
+      values['--input'] = inputfile
+      if scratch:
+        values['--output'] = output
+        result_writer.discard(scratch)
+      if filename and os.path.exists(filename):
+        os.remove(filename)
     
-    print generatedfolderpath
-    print runoption
     yield "runmodelUI finished<br/>"
-    
-    #return generatedfolderpath
-    
-    
+
+
+def generated_folder(inputfilename, scenario):
+  """
+  Folder Temoa writes the run results to, relative to RESULT_DIR
+  """
+  return "db_io/" + os.path.splitext(inputfilename)[0] + "_" + scenario + "_model"
+
+
+def run_pipeline(post, result=None, run_id=None):
+  """
+  Complete model run as served by the Model Run page. The run works in its
+  own workspace and its folder becomes the shared db_io folder when it is
+  done, so runs of the same input and scenario can go on at once. Yields
+  the run output. The url streaming a zip of this run's folder is stored
+  in result['zip_path'].
+
+  Identical earlier runs are served from the result cache. Post
+  resultcache=bypass to skip the cache, resultcache=refresh to solve again
+  and replace the cached result.
+  """
+
+  if result is None:
+    result = {}
+
+  outputFilename = post.get("outputdatafilename")
+  inputfilename =  post.get("inputdatafilename")
+  scenario = post.get("scenarioname")
+  cache_mode = post.get("resultcache", "")
+
+  folder = generated_folder(inputfilename, scenario)
+
+  space = workspace.Workspace(run_id or uuid.uuid4().hex)
+  try:
+    values = build_values(post, space.run_id, space)
+    runfolderpath = space.run_folder(os.path.basename(folder))
+
+    cache_key = None
+    cached = None
+    if cache_mode != 'bypass':
+      cache_key = result_cache.run_key(values)
+    if cache_key and cache_mode != 'refresh':
+      cached = result_cache.lookup(cache_key)
+
+    output = []
+    yield "<div>Starting Model Run \n"
+    if cached:
+      yield "Reusing the result of an identical earlier run\n"
+      yield result_cache.restore(cached, runfolderpath)
+    else:
+      for k in run_model(post, values, space):
+        output.append(k)
+        yield k
+
+    if cache_key and not cached and os.path.exists(runfolderpath):
+      try:
+        if cache_mode == 'refresh':
+          result_cache.invalidate(cache_key)
+        result_cache.store(cache_key, runfolderpath, ''.join(output))
+      except (IOError, OSError) as e:
+        #the run itself succeeded, only its cached copy is missing
+        yield "Run result not cached: %s<br/>" % e
+
+    promoted = space.promote(os.path.basename(folder))
+  finally:
+    space.remove()
+
+  yield "Model Run Compelete</div>"
+
+  zip_path = ""
+
+  if outputFilename:
+    if promoted:
+      zip_path = zipstream.download_url([promoted], roots=[os.path.basename(folder)])
+      result['zip_path'] = zip_path
+      yield "*Zip file is at path {" + zip_path + "}"
+
+    else:
+      yield "Failed to generate zip file"
+
+  #the run rewrote the output database in place
+  if values.get('--output'):
+    file_catalog.update(outputFilename)
+
+  if promoted:
+    artifacts.touch(settings.RESULT_DIR + promoted)
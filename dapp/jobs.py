@@ -0,0 +1,338 @@
+"""
+Background model runs. The web workers only create ModelRun rows
+(submit) and read their state and logs back; the runs themselves are
+claimed by the job runner (manage.py runjobs) and executed in a local
+pool of warm solver processes (dapp/solver_pool.py), so a long solve
+never holds a gunicorn worker. Which queued runs start, and how many run
+at once, is decided by dapp/admission.py.
+"""
+
+from django.conf import settings
+from django.db import connections, close_old_connections
+from django.utils import timezone
+
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import traceback
+import uuid
+
+from .models import ModelRun
+from .handle_modelrun import run_pipeline
+from .fileutils import makedirs
+from . import runlog
+from . import progress
+from . import metrics
+from . import solver_pool
+from . import artifacts
+from . import content_store
+from . import admission
+from . import dbpool
+from . import file_catalog
+
+
+def submit(post, batch='', status=ModelRun.QUEUED, owner=''):
+  """
+  Create the ModelRun for the posted form; queued runs are picked up by
+  the job runner
+  """
+  makedirs(settings.RUN_LOG_DIR)
+  runlog.rotate()
+
+  run_id = uuid.uuid4().hex
+  run = ModelRun.objects.create(
+    run_id = run_id,
+    batch = batch,
+    owner = owner,
+    status = status,
+    started = timezone.now() if status == ModelRun.RUNNING else None,
+    inputfilename = post.get("inputdatafilename", ""),
+    outputfilename = post.get("outputdatafilename", ""),
+    scenario = post.get("scenarioname", ""),
+    options = json.dumps(post.dict() if hasattr(post, 'dict') else dict(post)),
+    log_path = runlog.output_path(run_id) )
+
+  return run
+
+
+def start(post, owner=''):
+  """
+  Create a running ModelRun for a run solved for the request with
+  run_limited, or return None if it has to wait for the queue
+  """
+  with admission.Lock():
+    if not admission.has_room():
+      return None
+    return submit(post, status=ModelRun.RUNNING, owner=owner)
+
+
+def queue_state(run):
+  """
+  Queue position and estimated start of a queued run, {} otherwise
+  """
+  if run.status != ModelRun.QUEUED:
+    return {}
+  return admission.queue().get(run.run_id, {})
+
+
+def get_run(run_id):
+  try:
+    return ModelRun.objects.get(run_id=run_id)
+  except ModelRun.DoesNotExist:
+    return None
+
+
+def read_output(run, offset=0, max_bytes=None):
+  """
+  Output written by the run since byte offset. Returns (data, new_offset).
+  """
+  if not run.log_path:
+    return "", offset
+
+  return runlog.tail(run.log_path, offset, max_bytes)
+
+
+def run_events(run, dispatched=None):
+  """
+  Run a model run in this process, yielding its progress events. Output
+  goes to the run log; status, zip path and phase timings are saved when
+  the run ends. dispatched is when the job runner handed the run over,
+  the time until its first phase is stored as the startup overhead.
+  """
+  result = {}
+  tracker = progress.Tracker()
+  if dispatched:
+    tracker.start = dispatched
+
+  with open(run.log_path, 'a') as log:
+    try:
+      for event in progress.events(run_pipeline(json.loads(run.options), result, run.run_id), tracker):
+        if event['type'] == 'output':
+          log.write(event['text'])
+          log.flush()
+        yield event
+      run.status = ModelRun.DONE
+    except GeneratorExit:
+      #the request streaming the run went away, the run stops with it
+      run.status = ModelRun.FAILED
+      run.error = 'Stopped when the client disconnected'
+      run.finished = timezone.now()
+      run.save()
+      raise
+    except Exception as e:
+      log.write(traceback.format_exc())
+      run.status = ModelRun.FAILED
+      run.error = str(e)
+      yield { 'type' : 'error', 'error' : str(e), 'time' : time.time() }
+
+  run.zip_path = result.get('zip_path', '')
+  timings = tracker.timings()
+  run.timings = json.dumps(timings)
+  run.finished = timezone.now()
+  run.save()
+
+  if timings.get('startup') is not None:
+    metrics.observe('dapp_run_startup_seconds', {}, timings['startup'])
+  metrics.record_run(run.status, time.time() - tracker.start)
+
+
+def _solve_child(conn, run_id):
+  #own process group, so the request can stop the solvers with it
+  os.setpgrp()
+  metrics.reset()
+  dbpool.reset()
+
+  run = ModelRun.objects.get(run_id=run_id)
+  with admission.RunLimits():
+    for event in run_events(run):
+      conn.send(event)
+  conn.send(None)
+  conn.close()
+
+
+def run_limited(run):
+  """
+  Progress events of a run solved for a web request (runModel,
+  runModelEvents). The run is solved in a child process under the same
+  RunLimits as in the job runner's solver workers; the request relays
+  its events and stops it if the client goes away.
+  """
+  #the child must not share the request's database connections
+  _close_connections()
+  conn, child = multiprocessing.Pipe()
+  process = multiprocessing.Process(target=_solve_child, args=(child, run.run_id))
+  process.daemon = True
+  process.start()
+  child.close()
+
+  error = 'Solver process exited during the run'
+  try:
+    while True:
+      try:
+        event = conn.recv()
+      except EOFError:
+        break
+      if event is None:
+        break
+      yield event
+  except GeneratorExit:
+    error = 'Stopped when the client disconnected'
+    raise
+  finally:
+    if process.is_alive():
+      try:
+        os.killpg(process.pid, signal.SIGKILL)
+      except OSError:
+        pass
+    process.join()
+    conn.close()
+    ModelRun.objects.filter(pk=run.pk, status=ModelRun.RUNNING).update(
+      status=ModelRun.FAILED, error=error, finished=timezone.now())
+
+
+def execute(run_id, dispatched=None):
+  """
+  Runs in a solver worker: solve the model for a claimed run
+  """
+  close_old_connections()
+
+  run = ModelRun.objects.get(run_id=run_id)
+  for event in run_events(run, dispatched):
+    pass
+
+  close_old_connections()
+  return run_id
+
+
+def phase_stats(limit=100):
+  """
+  Phase durations over the latest finished runs
+  """
+  runs = ModelRun.objects.filter(status=ModelRun.DONE).exclude(timings='').order_by('-finished')[:limit]
+  return progress.summarize([json.loads(run.timings) for run in runs])
+
+
+def available_memory():
+  """
+  Bytes of memory available for new processes, None if unknown
+  """
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except (IOError, ValueError):
+    pass
+  return None
+
+
+def max_parallel_solves(workers, running=0):
+  """
+  Number of solves that may run at once: at most one per solver worker and
+  CPU, and no more than the available memory fits at SOLVE_MEMORY_BYTES each.
+  Memory held by the running solves is already taken out of MemAvailable.
+  """
+  limit = min(workers, multiprocessing.cpu_count())
+
+  memory = available_memory()
+  if memory is not None and settings.SOLVE_MEMORY_BYTES:
+    fits = memory // settings.SOLVE_MEMORY_BYTES
+    limit = min(limit, running + (fits if running else max(1, fits)))
+
+  return limit
+
+
+def _close_connections():
+  #DB connections must not be shared with forked solver workers
+  for conn in connections.all():
+    conn.close()
+
+
+def write_pool_stats(pool):
+  stats = pool.stats()
+  stats['time'] = time.time()
+
+  makedirs(os.path.dirname(settings.JOB_POOL_STATS))
+  tmp = settings.JOB_POOL_STATS + '.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(stats, f)
+  os.rename(tmp, settings.JOB_POOL_STATS)
+
+
+def pool_stats():
+  """
+  Solver pool state last written by the job runner, and the startup
+  overhead of the latest runs
+  """
+  try:
+    with open(settings.JOB_POOL_STATS) as f:
+      stats = json.load(f)
+  except (IOError, ValueError):
+    stats = {}
+
+  stats['startup'] = phase_stats().get('startup')
+  return stats
+
+
+def runner_id():
+  return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError:
+    return False
+  return True
+
+
+def reset_orphans():
+  """
+  Fail the runs claimed by job runners of this host which exited. Runs
+  solved inside web requests have no runner and are left alone.
+  """
+  host = socket.gethostname() + ':'
+  orphans = [run.pk for run in ModelRun.objects.filter(status=ModelRun.RUNNING, runner__startswith=host).only('runner')
+    if not _alive(int(run.runner[len(host):]))]
+  ModelRun.objects.filter(pk__in=orphans).update(
+    status=ModelRun.FAILED, error='Interrupted by job runner restart', finished=timezone.now())
+
+
+def serve(workers=None, poll_interval=None):
+  """
+  Job runner main loop used by manage.py runjobs.
+  """
+  workers = workers or settings.JOB_WORKERS or multiprocessing.cpu_count()
+  poll_interval = poll_interval or settings.JOB_POLL_INTERVAL
+
+  #Runs left running by a previous runner will never finish
+  reset_orphans()
+
+  _close_connections()
+  pool = solver_pool.SolverPool(workers, execute)
+
+  try:
+    while True:
+      _close_connections()
+      lost = pool.poll()
+      if lost:
+        ModelRun.objects.filter(run_id__in=lost, status=ModelRun.RUNNING).update(
+          status=ModelRun.FAILED, error='Solver worker exited during the run', finished=timezone.now())
+
+      runlog.rotate()
+      artifacts.sweep()
+      content_store.collect_garbage()
+      file_catalog.fill_hashes()
+
+      #runs only go to workers which finished preloading
+      busy = pool.busy()
+      for run_id in admission.admit(min(max_parallel_solves(workers, busy) - busy, len(pool.idle())), runner_id()):
+        pool.dispatch(run_id)
+
+      write_pool_stats(pool)
+      time.sleep(poll_interval)
+  finally:
+    pool.close()
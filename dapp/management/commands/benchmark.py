@@ -0,0 +1,408 @@
+"""
+End-to-end benchmark of the dapp endpoints on the utopia sample database.
+
+The benchmark runs in a sandbox: the upload and result folders (and the
+caches under them) are moved to a temporary folder and the requests use a
+test database, so nothing of the site is read or changed. Only the
+results are written to BENCHMARK_DIR.
+
+Every case runs in a forked child with its caches dropped: the first
+request is the cold latency, the median of the following ones the warm
+latency. The child's peak RSS (from wait4) and the bytes it wrote are
+recorded too. A case whose requests fail gets no timings and fails the
+command. Results are written as json and compared to a stored baseline,
+regressions are reported and fail the command.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings, setup_test_environment
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from dapp import diagram_cache
+from dapp import file_index
+from dapp import network
+from dapp import plot_cache
+from dapp import result_cache
+from dapp.fileutils import makedirs
+from dapp.models import ModelRun
+
+
+SAMPLES = [
+  'thirdparty/temoa/db_io/temoa_utopia.sqlite',
+  'thirdparty/temoa/db_io/temoa_utopia.sql',
+]
+
+DB_NAME = 'benchmark_utopia.sqlite'
+
+SCENARIO = 'benchmark'
+
+#metric -> smallest difference reported as a regression
+METRICS = [
+  ('cold', 0.005),
+  ('warm', 0.005),
+  ('peak_rss_kb', 1024),
+  ('bytes_written', 4096),
+]
+
+
+class Sandbox(object):
+  """
+  Upload and result folders under a temporary folder, and a test database
+  the forked cases can open too
+  """
+
+  def __init__(self):
+    self.root = tempfile.mkdtemp(prefix='benchmark-')
+    self.prefixes = [
+      (settings.BASE_DIR + '/uploads/', os.path.join(self.root, 'uploads/')),
+      (settings.RESULT_DIR, os.path.join(self.root, 'result/')),
+    ]
+
+  def move(self, path):
+    for prefix, target in self.prefixes:
+      if path.startswith(prefix):
+        return target + path[len(prefix):]
+    return path
+
+  def overrides(self):
+    result = {}
+    for name in dir(settings):
+      value = getattr(settings, name)
+      if name.isupper() and name != 'BENCHMARK_DIR' and isinstance(value, basestring) and self.move(value) != value:
+        result[name] = self.move(value)
+    result['ARTIFACT_AREAS'] = dict((area, dict(conf, path=self.move(conf['path'])))
+      for area, conf in settings.ARTIFACT_AREAS.items())
+    return result
+
+  def caches(self):
+    #created when their modules were imported
+    return [network.graphs, network.images, plot_cache.plots, result_cache.cache]
+
+  def __enter__(self):
+    overrides = self.overrides()
+    #folders the site expects to be there
+    for value in overrides.values():
+      if isinstance(value, basestring) and value.endswith('/'):
+        makedirs(value)
+    self.settings = override_settings(**overrides)
+    self.settings.enable()
+    self.roots = [cache.root for cache in self.caches()]
+    for cache in self.caches():
+      cache.root = self.move(cache.root)
+    diagram_cache.caches.clear()
+
+    #a file, the in-memory test database is gone when the cases fork
+    connections['default'].settings_dict['TEST']['NAME'] = os.path.join(self.root, 'test.sqlite3')
+    self.runner = DiscoverRunner(verbosity=0, interactive=False)
+    self.databases = self.runner.setup_databases()
+    return self
+
+  def __exit__(self, *args):
+    try:
+      self.runner.teardown_databases(self.databases)
+    finally:
+      for cache, root in zip(self.caches(), self.roots):
+        cache.root = root
+      diagram_cache.caches.clear()
+      self.settings.disable()
+      shutil.rmtree(self.root, ignore_errors=True)
+
+
+def sample_database():
+  for sample in SAMPLES:
+    path = os.path.join(settings.BASE_DIR, sample)
+    if os.path.exists(path):
+      return path
+  return None
+
+
+def install_database(sample):
+  """
+  Copy the sample (.sqlite, or .sql script) into the uploads folder
+  """
+  makedirs(settings.UPLOADED_DIR)
+  target = settings.UPLOADED_DIR + DB_NAME
+  if os.path.exists(target):
+    os.remove(target)
+
+  if sample.endswith('.sql'):
+    con = sqlite3.connect(target)
+    with open(sample) as f:
+      con.executescript(f.read())
+    con.commit()
+    con.close()
+  else:
+    shutil.copyfile(sample, target)
+
+  file_index.remove_index(DB_NAME)
+  diagram_cache.invalidate_file(DB_NAME)
+
+
+def cases(period, sector):
+  """
+  (name, method, url, data). The model run comes first, it writes the
+  results the output cases read.
+  """
+  result = [
+    ('model', 'post', '/model/events', {
+      'inputdatafilename' : DB_NAME, 'outputdatafilename' : DB_NAME,
+      'scenarioname' : SCENARIO, 'solver' : 'glpk', 'runoption' : 'Single-Run',
+      'resultcache' : 'bypass' }),
+    ('loadfilelist', 'get', '/loadfilelist', { 'mode' : 'input' }),
+  ]
+
+  for listType in file_index.LIST_FLAGS:
+    result.append(('loadctlist-' + listType, 'get', '/loadctlist', {
+      'mode' : 'output', 'filename' : DB_NAME, 'type' : listType, 'scenario-name' : SCENARIO }))
+
+  result.append(('runinput-input', 'post', '/runinput', {
+    'mode' : 'input', 'datafile' : DB_NAME, 'format' : 'svg', 'colorscheme' : 'color' }))
+  result.append(('runinput-output', 'post', '/runinput', {
+    'mode' : 'output', 'datafile' : DB_NAME, 'format' : 'svg', 'colorscheme' : 'color',
+    'scenario-name' : SCENARIO, 'date-range' : period }))
+
+  result.append(('loadsector', 'get', '/loadsector', {
+    'filename' : DB_NAME, 'scenario' : SCENARIO, 'plottype' : '1' }))
+  for plottype in ('1', '2', '3'):
+    result.append(('generateplot-' + plottype, 'post', '/generateplot', {
+      'db-plot-datafilename' : DB_NAME, 'plot-scenario-name' : SCENARIO,
+      'plot-type-name' : plottype, 'sector-type-name' : sector }))
+
+  return result
+
+
+def drop_caches(name, data):
+  """
+  Forget everything cached for the case so its first request is cold
+  """
+  file_index.remove_index(DB_NAME)
+  diagram_cache.invalidate_file(DB_NAME)
+  if name.startswith('generateplot'):
+    key = plot_cache.plot_key(settings.UPLOADED_DIR + DB_NAME, SCENARIO,
+      int(data['plot-type-name']), data['sector-type-name'], False)
+    plot_cache.plots.invalidate(key)
+
+
+def bytes_written():
+  #characters passed to write() by this process, files and pipes alike
+  try:
+    with open('/proc/self/io') as f:
+      for line in f:
+        if line.startswith('wchar:'):
+          return int(line.split()[1])
+  except IOError:
+    pass
+  return 0
+
+
+def run_error(content):
+  """
+  Error of a model run from its progress events
+  """
+  events = [json.loads(line) for line in content.splitlines() if line.strip()]
+  errors = [event['error'] for event in events if event['type'] == 'error']
+  if errors:
+    return errors[-1]
+
+  run_ids = [event['run_id'] for event in events if event['type'] == 'run']
+  run = ModelRun.objects.filter(run_id__in=run_ids).first()
+  if run is None:
+    return 'no run'
+  if run.status != ModelRun.DONE:
+    return 'run %s' % run.status
+  return ''
+
+
+def request(client, method, url, data):
+  """
+  Seconds taken by one request and its error, if any
+  """
+  start = time.time()
+  response = getattr(client, method)(url, data)
+  if response.streaming:
+    content = ''.join(response.streaming_content)
+  else:
+    content = response.content
+  elapsed = time.time() - start
+
+  error = ''
+  content_type = response.get('Content-Type', '')
+  if response.status_code != 200:
+    error = 'status %s' % response.status_code
+  elif content_type.startswith('application/json'):
+    error = json.loads(content).get('error', '')
+  elif content_type.startswith('application/x-ndjson'):
+    error = run_error(content)
+  return elapsed, error
+
+
+def measure(name, method, url, data, repeat):
+  """
+  Run the case in the current (child) process, result as a dict
+  """
+  drop_caches(name, data)
+  client = Client()
+
+  written = bytes_written()
+  cold, error = request(client, method, url, data)
+  if error:
+    return { 'error' : error }
+  warm = []
+  for i in range(repeat):
+    elapsed, error = request(client, method, url, data)
+    if error:
+      return { 'error' : error }
+    warm.append(elapsed)
+  written = bytes_written() - written
+
+  warm.sort()
+  return {
+    'cold' : cold,
+    'warm' : warm[len(warm) // 2] if warm else None,
+    'bytes_written' : written,
+    'error' : error,
+  }
+
+
+def run_case(case, repeat):
+  """
+  Measure a case in a forked child; adds the child's peak RSS
+  """
+  connections.close_all()
+  read_end, write_end = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_end)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+      result = measure(*case, repeat=repeat)
+    except Exception as e:
+      result = { 'error' : repr(e) }
+    os.write(write_end, json.dumps(result))
+    os.close(write_end)
+    os._exit(0)
+
+  os.close(write_end)
+  chunks = []
+  while True:
+    chunk = os.read(read_end, 65536)
+    if not chunk:
+      break
+    chunks.append(chunk)
+  os.close(read_end)
+  _, status, rusage = os.wait4(pid, 0)
+
+  result = json.loads(''.join(chunks)) if chunks else { 'error' : 'exit status %s' % status }
+  result['peak_rss_kb'] = rusage.ru_maxrss
+  return result
+
+
+def compare(results, baseline, threshold):
+  """
+  Regressions as (case, metric, baseline value, value)
+  """
+  regressions = []
+  for name, result in results.iteritems():
+    base = baseline.get(name)
+    if not base:
+      continue
+    for metric, floor in METRICS:
+      old, new = base.get(metric), result.get(metric)
+      if old is None or new is None:
+        continue
+      if new > old * (1 + threshold) and new - old > floor:
+        regressions.append((name, metric, old, new))
+  return regressions
+
+
+class Command(BaseCommand):
+  help = 'Benchmark the endpoints on the utopia sample database and compare with the baseline'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--database', default=None,
+      help='Sample database, .sqlite or .sql (default: utopia from thirdparty/temoa)')
+    parser.add_argument('--repeat', type=int, default=5,
+      help='Warm requests per case (default: 5)')
+    parser.add_argument('--only', action='append', default=[],
+      help='Run only cases starting with this name, may be repeated')
+    parser.add_argument('--period', default='1990',
+      help='Period of the output diagram (default: 1990)')
+    parser.add_argument('--sector', default='all',
+      help='Sector of the plots (default: all)')
+    parser.add_argument('--output', default=None,
+      help='Results file (default: BENCHMARK_DIR/latest.json)')
+    parser.add_argument('--baseline', default=None,
+      help='Baseline file (default: BENCHMARK_DIR/baseline.json)')
+    parser.add_argument('--threshold', type=float, default=0.2,
+      help='Relative slowdown reported as a regression (default: 0.2)')
+    parser.add_argument('--save-baseline', action='store_true',
+      help='Store the results as the new baseline')
+
+  def handle(self, *args, **options):
+    sample = options['database'] or sample_database()
+    if not sample or not os.path.exists(sample):
+      raise CommandError('Sample database not found, pass --database')
+
+    output = options['output'] or settings.BENCHMARK_DIR + 'latest.json'
+    baseline_path = options['baseline'] or settings.BENCHMARK_DIR + 'baseline.json'
+
+    setup_test_environment()
+    with Sandbox():
+      install_database(sample)
+      results = self.run_cases(options)
+
+    report = { 'sample' : os.path.basename(sample), 'time' : time.time(), 'results' : results }
+    makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+    self.stdout.write('Results written to %s' % output)
+
+    failed = sorted(name for name, result in results.items() if result.get('error'))
+    if failed:
+      raise CommandError('%d case(s) failed: %s' % (len(failed), ', '.join(failed)))
+
+    if options['save_baseline']:
+      makedirs(os.path.dirname(baseline_path))
+      shutil.copyfile(output, baseline_path)
+      self.stdout.write('Baseline saved to %s' % baseline_path)
+      return
+
+    if not os.path.exists(baseline_path):
+      self.stdout.write('No baseline at %s, run with --save-baseline to create one' % baseline_path)
+      return
+
+    with open(baseline_path) as f:
+      baseline = json.load(f)['results']
+
+    regressions = compare(results, baseline, options['threshold'])
+    for name, metric, old, new in regressions:
+      self.stdout.write('REGRESSION %s %s: %s -> %s' % (name, metric, old, new))
+    if regressions:
+      raise CommandError('%d regression(s) against %s' % (len(regressions), baseline_path))
+    self.stdout.write('No regressions against %s' % baseline_path)
+
+  def run_cases(self, options):
+    results = {}
+    for case in cases(options['period'], options['sector']):
+      name = case[0]
+      if options['only'] and not any(name.startswith(prefix) for prefix in options['only']):
+        continue
+      repeat = 1 if name == 'model' else options['repeat']
+      results[name] = result = run_case(case, repeat)
+      self.stdout.write('%-22s cold %8s  warm %8s  rss %7d KB  written %10d B  %s' % (
+        name, '%.3fs' % result['cold'] if result.get('cold') is not None else '-',
+        '%.3fs' % result['warm'] if result.get('warm') is not None else '-',
+        result['peak_rss_kb'], result.get('bytes_written') or 0, result.get('error', '')))
+    return results
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+import time
+
+from dapp import subsystems
+
+
+class Command(BaseCommand):
+  help = 'Import every heavy subsystem and report what each one costs at startup'
+
+  def handle(self, *args, **options):
+    start = time.time()
+    errors = subsystems.preload()
+    total = time.time() - start
+
+    for name, info in subsystems.report().items():
+      if info['loaded']:
+        self.stdout.write('%-16s %8.3fs %6d modules' % (name, info['seconds'], info['modules']))
+      else:
+        self.stdout.write('%-16s failed: %s' % (name, errors.get(name, '')))
+    self.stdout.write('%-16s %8.3fs' % ('total', total))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from dapp import jobs
+
+
+class Command(BaseCommand):
+  help = 'Execute queued model runs in a local process pool'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--workers', type=int, default=None,
+      help='Number of pool processes (default: JOB_WORKERS)')
+
+  def handle(self, *args, **options):
+    jobs.serve(workers=options['workers'])
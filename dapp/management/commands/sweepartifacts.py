@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from dapp import artifacts
+
+
+class Command(BaseCommand):
+  help = 'Remove expired and least recently used result artifacts over their quota'
+
+  def handle(self, *args, **options):
+    for area, (entries, freed) in sorted(artifacts.sweep(force=True).items()):
+      self.stdout.write('%-12s removed %d entries, %d bytes' % (area, entries, freed))
@@ -0,0 +1,250 @@
+"""
+Request and model run metrics in Prometheus text format. Each process
+(gunicorn worker, job runner worker) keeps its own counters and writes
+them to METRICS_DIR/<pid>-<token>.json at most every
+METRICS_FLUSH_INTERVAL seconds, and whenever a request starts or ends so
+the in-flight gauge is current; the /metrics view merges every process's
+file, so the numbers cover all workers.
+"""
+
+from django.conf import settings
+
+import fcntl
+import glob
+import json
+import os
+import time
+import uuid
+
+from .fileutils import makedirs
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RUN_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+HELP = {
+  'dapp_request_duration_seconds' : ('histogram', 'View latency by url name'),
+  'dapp_requests_total' : ('counter', 'Requests by url name and status code'),
+  'dapp_errors_total' : ('counter', 'Exceptions raised or caught in views by url name and type'),
+  'dapp_requests_in_flight' : ('gauge', 'Requests being served by each worker process'),
+  'dapp_model_runs_total' : ('counter', 'Finished model runs by status'),
+  'dapp_model_run_duration_seconds' : ('histogram', 'Model run wall time by status'),
+  'dapp_run_startup_seconds' : ('histogram', 'Time from dispatch to the first phase of a model run'),
+  'dapp_solver_preload_seconds' : ('histogram', 'Time a solver worker spent importing Pyomo and Temoa'),
+  'dapp_solver_workers_warm' : ('gauge', 'Solver workers with Pyomo and Temoa loaded'),
+  'dapp_solver_workers_busy' : ('gauge', 'Solver workers running a model'),
+  'dapp_solver_workers_recycled_total' : ('counter', 'Solver workers replaced after their run or memory limit'),
+  'dapp_run_limit_exceeded_total' : ('counter', 'Runs stopped for going over a CPU or wall time limit'),
+}
+
+RETIRED = 'retired.json'
+
+_token = uuid.uuid4().hex[:8]
+_data = { 'counters' : {}, 'histograms' : {}, 'gauges' : {} }
+_last_flush = [0]
+_view = [None]
+
+
+def _key(labels):
+  return json.dumps(sorted(labels.items()))
+
+
+def inc(name, labels, value=1):
+  series = _data['counters'].setdefault(name, {})
+  key = _key(labels)
+  series[key] = series.get(key, 0) + value
+
+
+def set_gauge(name, labels, value):
+  _data['gauges'].setdefault(name, {})[_key(labels)] = value
+
+
+def observe(name, labels, value, buckets=REQUEST_BUCKETS):
+  series = _data['histograms'].setdefault(name, {})
+  key = _key(labels)
+  if key not in series:
+    series[key] = { 'le' : list(buckets), 'buckets' : [0] * len(buckets), 'sum' : 0.0, 'count' : 0 }
+  histogram = series[key]
+  for i, bound in enumerate(histogram['le']):
+    if value <= bound:
+      histogram['buckets'][i] += 1
+  histogram['sum'] += value
+  histogram['count'] += 1
+
+
+def record_error(exc, view=None):
+  """
+  Count an exception a view caught itself instead of letting it propagate
+  """
+  inc('dapp_errors_total', { 'view' : view or _view[0] or 'unknown', 'exception' : type(exc).__name__ })
+
+
+def record_run(status, duration):
+  inc('dapp_model_runs_total', { 'status' : status })
+  observe('dapp_model_run_duration_seconds', { 'status' : status }, duration, RUN_BUCKETS)
+  flush(force=True)
+
+
+def reset():
+  """
+  Start with empty samples in a forked child, the parent's are its own
+  """
+  for samples in _data.values():
+    samples.clear()
+  _last_flush[0] = 0
+
+
+def _path():
+  return os.path.join(settings.METRICS_DIR, '%d-%s.json' % (os.getpid(), _token))
+
+
+def flush(force=False):
+  now = time.time()
+  if not force and now - _last_flush[0] < settings.METRICS_FLUSH_INTERVAL:
+    return
+  _last_flush[0] = now
+
+  makedirs(settings.METRICS_DIR)
+  path = _path()
+  with open(path + '.tmp', 'w') as f:
+    json.dump(_data, f)
+  os.rename(path + '.tmp', path)
+
+
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError:
+    return False
+  return True
+
+
+def _merge(total, data, gauges=True):
+  for name, series in data.get('counters', {}).items():
+    target = total['counters'].setdefault(name, {})
+    for key, value in series.items():
+      target[key] = target.get(key, 0) + value
+
+  for name, series in data.get('histograms', {}).items():
+    target = total['histograms'].setdefault(name, {})
+    for key, histogram in series.items():
+      if key not in target:
+        target[key] = { 'le' : histogram['le'], 'buckets' : [0] * len(histogram['le']), 'sum' : 0.0, 'count' : 0 }
+      merged = target[key]
+      merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+      merged['sum'] += histogram['sum']
+      merged['count'] += histogram['count']
+
+  if gauges:
+    for name, series in data.get('gauges', {}).items():
+      total['gauges'].setdefault(name, {}).update(series)
+
+
+def _load(path):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+
+def collect():
+  """
+  Metrics of all processes. Files of processes that exited are folded into
+  retired.json so their counts are kept without keeping their files.
+  """
+  flush(force=True)
+
+  total = { 'counters' : {}, 'histograms' : {}, 'gauges' : {} }
+  with open(os.path.join(settings.METRICS_DIR, '.lock'), 'a') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+
+    retired_path = os.path.join(settings.METRICS_DIR, RETIRED)
+    retired = _load(retired_path)
+    retired_changed = False
+
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, '*-*.json')):
+      data = _load(path)
+      pid = int(os.path.basename(path).split('-')[0])
+      if _alive(pid):
+        _merge(total, data)
+      else:
+        retired.setdefault('counters', {})
+        retired.setdefault('histograms', {})
+        _merge(retired, data, gauges=False)
+        retired_changed = True
+        os.remove(path)
+
+    if retired_changed:
+      with open(retired_path + '.tmp', 'w') as f:
+        json.dump(retired, f)
+      os.rename(retired_path + '.tmp', retired_path)
+
+    fcntl.flock(lock, fcntl.LOCK_UN)
+
+  _merge(total, retired, gauges=False)
+  return total
+
+
+def _labels(key, extra=None):
+  pairs = [(k, v) for k, v in json.loads(key)] + (extra or [])
+  if not pairs:
+    return ''
+  return '{' + ','.join('%s="%s"' % (k, unicode(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def render():
+  data = collect()
+  lines = []
+
+  for name in sorted(HELP):
+    kind, text = HELP[name]
+    lines.append('# HELP %s %s' % (name, text))
+    lines.append('# TYPE %s %s' % (name, kind))
+
+    if kind == 'histogram':
+      for key, histogram in sorted(data['histograms'].get(name, {}).items()):
+        for bound, count in zip(histogram['le'], histogram['buckets']):
+          lines.append('%s_bucket%s %d' % (name, _labels(key, [('le', repr(float(bound)))]), count))
+        lines.append('%s_bucket%s %d' % (name, _labels(key, [('le', '+Inf')]), histogram['count']))
+        lines.append('%s_sum%s %r' % (name, _labels(key), histogram['sum']))
+        lines.append('%s_count%s %d' % (name, _labels(key), histogram['count']))
+    else:
+      series = data['counters' if kind == 'counter' else 'gauges'].get(name, {})
+      for key, value in sorted(series.items()):
+        lines.append('%s%s %s' % (name, _labels(key), value))
+
+  return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware(object):
+
+  def process_request(self, request):
+    request._metrics_start = time.time()
+    _view[0] = None
+    inflight = _data['gauges'].get('dapp_requests_in_flight', {}).get(_key({ 'pid' : os.getpid() }), 0)
+    set_gauge('dapp_requests_in_flight', { 'pid' : os.getpid() }, inflight + 1)
+    #the gauge is only worth reading while the request is served
+    flush(force=True)
+
+  def process_view(self, request, view_func, view_args, view_kwargs):
+    match = getattr(request, 'resolver_match', None)
+    _view[0] = match.url_name if match and match.url_name else view_func.__name__
+
+  def process_exception(self, request, exception):
+    record_error(exception)
+
+  def process_response(self, request, response):
+    start = getattr(request, '_metrics_start', None)
+    if start is None:
+      return response
+
+    view = _view[0] or 'unresolved'
+    #streaming responses are timed until their first byte is ready
+    observe('dapp_request_duration_seconds', { 'view' : view }, time.time() - start)
+    inc('dapp_requests_total', { 'view' : view, 'status' : response.status_code })
+
+    inflight = _data['gauges'].get('dapp_requests_in_flight', {}).get(_key({ 'pid' : os.getpid() }), 1)
+    set_gauge('dapp_requests_in_flight', { 'pid' : os.getpid() }, max(0, inflight - 1))
+
+    flush(force=True)
+    return response
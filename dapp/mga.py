@@ -0,0 +1,88 @@
+"""
+Progress reporting for MGA (Uncertainty-Analysis) runs. Temoa writes each
+MGA iteration under its own <scenario>_mga_<N> scenario in the output
+database; between lines of runModelUI output the database is polled and a
+line is streamed for every iteration that has been written.
+"""
+
+from django.conf import settings
+
+import re
+import sqlite3
+import time
+
+
+def mga_iterations(values):
+  match = re.search(r'iteration\s*=\s*(\d+)', values.get('--mga', ''))
+  return int(match.group(1)) if match else None
+
+
+def _objectives(output_db, scenario, after_rowid):
+  """
+  (rowid, iteration, objective value) written after after_rowid for the
+  MGA scenarios of scenario
+  """
+  prefix = scenario + '_mga_'
+  con = sqlite3.connect(output_db, timeout=1)
+  try:
+    rows = con.execute("SELECT rowid, scenario, objective_value FROM Output_Objective WHERE rowid > ?", (after_rowid,)).fetchall()
+  finally:
+    con.close()
+
+  result = []
+  for rowid, name, objective in rows:
+    if name.startswith(prefix) and name[len(prefix):].isdigit():
+      result.append((rowid, int(name[len(prefix):]), objective))
+  return result
+
+
+def _last_rowid(output_db):
+  con = sqlite3.connect(output_db, timeout=1)
+  try:
+    return con.execute("SELECT MAX(rowid) FROM Output_Objective").fetchone()[0] or 0
+  finally:
+    con.close()
+
+
+def progress(values, lines):
+  """
+  Pass through the runModelUI output lines of an MGA run, adding a line
+  for each finished iteration. Needs an output database to poll.
+  """
+  output_db = values.get('--output')
+  scenario = values.get('--scenario', '')
+  total = mga_iterations(values)
+
+  try:
+    last_rowid = _last_rowid(output_db) if output_db else None
+  except sqlite3.Error:
+    last_rowid = None
+
+  if last_rowid is None:
+    for line in lines:
+      yield line
+    return
+
+  done = set()
+  last_poll = 0
+
+  def finished():
+    try:
+      rows = _objectives(output_db, scenario, last_rowid)
+    except sqlite3.Error:
+      #locked while Temoa writes, try again on the next line
+      return
+    for _, iteration, objective in sorted(rows):
+      if iteration not in done:
+        done.add(iteration)
+        yield "MGA iteration %d of %s finished, objective %s\n" % (iteration, total or '?', objective)
+
+  for line in lines:
+    yield line
+    if time.time() - last_poll >= settings.MGA_PROGRESS_INTERVAL:
+      last_poll = time.time()
+      for message in finished():
+        yield message
+
+  for message in finished():
+    yield message
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 11:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelrun',
+            name='batch',
+            field=models.CharField(blank=True, db_index=True, max_length=32),
+        ),
+    ]
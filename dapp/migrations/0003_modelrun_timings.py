@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 12:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dapp', '0002_modelrun_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelrun',
+            name='timings',
+            field=models.TextField(blank=True),
+        ),
+    ]
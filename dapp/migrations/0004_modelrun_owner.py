@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dapp', '0003_modelrun_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelrun',
+            name='owner',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
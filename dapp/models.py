@@ -3,3 +3,44 @@ from __future__ import unicode_literals
 from django.db import models
 
 # Create your models here.
+
+class ModelRun(models.Model):
+  """
+  A model run submitted through the job API. The run is executed by the
+  job runner (manage.py runjobs) outside the web workers; options holds the
+  posted Model Run form as json.
+  """
+
+  QUEUED = 'queued'
+  RUNNING = 'running'
+  DONE = 'done'
+  FAILED = 'failed'
+
+  STATUS_CHOICES = (
+    (QUEUED, 'Queued'),
+    (RUNNING, 'Running'),
+    (DONE, 'Done'),
+    (FAILED, 'Failed'),
+  )
+
+  run_id = models.CharField(max_length=32, unique=True)
+  batch = models.CharField(max_length=32, blank=True, db_index=True)
+  #user or session that submitted the run, runs are scheduled fairly between owners
+  owner = models.CharField(max_length=64, blank=True, db_index=True)
+  #<host>:<pid> of the job runner that claimed the run, empty for runs solved in a request
+  runner = models.CharField(max_length=64, blank=True)
+  status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+  inputfilename = models.CharField(max_length=255)
+  outputfilename = models.CharField(max_length=255, blank=True)
+  scenario = models.CharField(max_length=255)
+  options = models.TextField()
+  log_path = models.CharField(max_length=512, blank=True)
+  zip_path = models.CharField(max_length=512, blank=True)
+  error = models.TextField(blank=True)
+  timings = models.TextField(blank=True)
+  created = models.DateTimeField(auto_now_add=True)
+  started = models.DateTimeField(null=True, blank=True)
+  finished = models.DateTimeField(null=True, blank=True)
+
+  def __unicode__(self):
+    return '%s (%s)' % (self.run_id, self.status)
@@ -0,0 +1,305 @@
+"""
+Level of detail views of the input energy network for databases too large
+for a complete input diagram. The commodity/technology graph is assembled
+once per database content (from Efficiency and technologies, or the
+parsed .dat) and cached as json; a view is then a cheap selection:
+
+  overview      one node per sector, linked by the commodities they trade
+                (databases only, .dat inputs have no sectors)
+  neighborhood  the nodes within hops of a commodity or technology
+  full          the whole graph
+
+A node budget keeps the most connected nodes and merges the others into
+one node per sector. Views are drawn with dot and cached like diagrams.
+"""
+
+from django.conf import settings
+
+import collections
+import hashlib
+import json
+import os
+import subprocess
+import time
+
+from .diskcache import DiskCache
+from . import dat_reader
+from . import dbpool
+from . import file_catalog
+from . import zipstream
+
+VIEWS = ('overview', 'neighborhood', 'full')
+
+FORMATS = ('svg', 'png', 'pdf')
+
+UNKNOWN_SECTOR = 'other'
+
+graphs = DiskCache(settings.NETWORK_CACHE_DIR, settings.NETWORK_CACHE_MAX_BYTES)
+images = DiskCache(settings.RESULT_DIR + 'input/lod/', settings.DIAGRAM_CACHE_MAX_BYTES)
+
+_graphs = collections.OrderedDict()
+
+
+def _efficiency(path):
+  """
+  (input_comm, tech, output_comm) rows and tech -> sector, which is empty
+  for .dat inputs
+  """
+  if dat_reader.is_dat(path):
+    rows = [(r[dat_reader.EFFICIENCY_INPUT], r[dat_reader.EFFICIENCY_TECH], r[dat_reader.EFFICIENCY_OUTPUT])
+      for r in dat_reader.efficiency(path)]
+    return rows, {}
+
+  cur = dbpool.connect(path).cursor()
+  rows = cur.execute('SELECT DISTINCT input_comm, tech, output_comm FROM Efficiency').fetchall()
+  sectors = dict(cur.execute('SELECT tech, sector FROM technologies').fetchall())
+  return rows, sectors
+
+
+def assemble(path):
+  """
+  { 'nodes' : { id : { kind, name, sector, degree } }, 'edges' : [[source, target]] }
+  with ids 'c:<commodity>' and 't:<technology>'. A commodity's sector is
+  the sector of the first technology producing it.
+  """
+  rows, sectors = _efficiency(path)
+
+  nodes = {}
+  edges = set()
+  for input_comm, tech, output_comm in rows:
+    tech_id = 't:%s' % tech
+    nodes.setdefault(tech_id, { 'kind' : 'tech', 'name' : unicode(tech), 'sector' : sectors.get(tech) or UNKNOWN_SECTOR })
+    for comm in (input_comm, output_comm):
+      nodes.setdefault('c:%s' % comm, { 'kind' : 'comm', 'name' : unicode(comm), 'sector' : None })
+    edges.add(('c:%s' % input_comm, tech_id))
+    edges.add((tech_id, 'c:%s' % output_comm))
+
+  for source, target in edges:
+    if nodes[target]['kind'] == 'comm' and nodes[target]['sector'] is None:
+      nodes[target]['sector'] = nodes[source]['sector']
+  for node in nodes.values():
+    node['sector'] = node['sector'] or UNKNOWN_SECTOR
+    node['degree'] = 0
+  for source, target in edges:
+    nodes[source]['degree'] += 1
+    nodes[target]['degree'] += 1
+
+  return { 'nodes' : nodes, 'edges' : sorted(edges) }
+
+
+def get_graph(filename):
+  """
+  Assembled graph of an uploaded file, built once per content hash
+  """
+  path = settings.UPLOADED_DIR + filename
+  key = file_catalog.content_hash(filename)
+
+  if key in _graphs:
+    _graphs[key] = _graphs.pop(key)
+    return _graphs[key]
+
+  entry = graphs.get(key)
+  if entry is None:
+    def build(directory):
+      with open(os.path.join(directory, 'graph.json'), 'w') as f:
+        json.dump(assemble(path), f)
+    entry = graphs.put(key, build)
+
+  with open(os.path.join(entry, 'graph.json')) as f:
+    graph = json.load(f)
+
+  while len(_graphs) >= settings.PLOT_DATA_CACHE_SIZE:
+    _graphs.popitem(last=False)
+  _graphs[key] = graph
+  return graph
+
+
+def overview(graph):
+  """
+  Sector graph: an edge per commodity flowing from a technology of one
+  sector to a technology of another
+  """
+  nodes = graph['nodes']
+  producers = collections.defaultdict(set)
+  for source, target in graph['edges']:
+    if nodes[source]['kind'] == 'tech':
+      producers[target].add(nodes[source]['sector'])
+
+  sector_nodes = {}
+  flows = collections.Counter()
+  for source, target in graph['edges']:
+    if nodes[target]['kind'] != 'tech':
+      continue
+    sector = nodes[target]['sector']
+    sector_nodes['s:' + sector] = { 'kind' : 'sector', 'name' : sector, 'sector' : sector }
+    for producer in producers[source]:
+      if producer != sector:
+        sector_nodes['s:' + producer] = { 'kind' : 'sector', 'name' : producer, 'sector' : producer }
+        flows[('s:' + producer, 's:' + sector)] += 1
+
+  for node_id, node in sector_nodes.items():
+    node['degree'] = len([1 for edge in flows if node_id in edge])
+
+  return { 'nodes' : sector_nodes, 'edges' : sorted(flows), 'labels' : dict(('%s>%s' % e, n) for e, n in flows.items()) }
+
+
+def neighborhood(graph, center, hops):
+  """
+  Subgraph of the nodes at most hops edges away from center, a commodity
+  or technology name
+  """
+  nodes = graph['nodes']
+  start = [n for n in ('c:' + center, 't:' + center) if n in nodes]
+  if not start:
+    raise ValueError("%s is neither a commodity nor a technology of this database" % center)
+
+  adjacent = collections.defaultdict(set)
+  for source, target in graph['edges']:
+    adjacent[source].add(target)
+    adjacent[target].add(source)
+
+  seen = set(start)
+  frontier = start
+  for i in range(min(hops, settings.NETWORK_MAX_HOPS)):
+    frontier = [n for node in frontier for n in adjacent[node] if n not in seen]
+    if not frontier:
+      break
+    seen.update(frontier)
+
+  return {
+    'nodes' : dict((n, nodes[n]) for n in seen),
+    'edges' : [e for e in graph['edges'] if e[0] in seen and e[1] in seen],
+  }
+
+
+def apply_budget(graph, budget, keep=()):
+  """
+  Keep the budget most connected nodes (and keep), merging the others into
+  one node per sector; parallel edges are merged and counted
+  """
+  nodes = graph['nodes']
+  if not budget or len(nodes) <= budget:
+    return graph
+
+  ranked = sorted(nodes, key=lambda n: (n not in keep, -nodes[n]['degree'], n))
+  kept = set(ranked[:budget])
+
+  mapping = {}
+  merged = {}
+  for node_id, node in nodes.items():
+    if node_id in kept:
+      mapping[node_id] = node_id
+      merged[node_id] = node
+    else:
+      group = 'g:' + node['sector']
+      mapping[node_id] = group
+      entry = merged.setdefault(group, { 'kind' : 'group', 'name' : node['sector'], 'sector' : node['sector'], 'degree' : 0, 'members' : 0 })
+      entry['members'] += 1
+      entry['degree'] += node['degree']
+
+  labels = collections.Counter(graph.get('labels', {}))
+  edges = collections.Counter()
+  for source, target in graph['edges']:
+    edge = (mapping[source], mapping[target])
+    if edge[0] != edge[1]:
+      edges[edge] += labels.get('%s>%s' % (source, target), 1)
+
+  return { 'nodes' : merged, 'edges' : sorted(edges), 'labels' : dict(('%s>%s' % e, n) for e, n in edges.items() if n > 1) }
+
+
+def select(filename, view, center='', hops=1, budget=None):
+  if budget is not None:
+    budget = max(budget, 1)
+  if view == 'overview' and dat_reader.is_dat(filename):
+    raise ValueError("The overview groups technologies by sector, which only databases (.sqlite) have. "
+      "Use the neighborhood or full view for .dat inputs.")
+
+  graph = get_graph(filename)
+  if view == 'overview':
+    graph = overview(graph)
+  elif view == 'neighborhood':
+    graph = neighborhood(graph, center, hops)
+  elif view != 'full':
+    raise ValueError("Unknown view %s" % view)
+
+  keep = [n for n in ('c:' + center, 't:' + center) if center]
+  return apply_budget(graph, budget, keep)
+
+
+SHAPES = { 'comm' : 'circle', 'tech' : 'box', 'sector' : 'box3d', 'group' : 'folder' }
+
+
+def _quote(text):
+  return '"' + unicode(text).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def to_dot(graph, grey=False, center=''):
+  lines = ['digraph lod {', '  rankdir=LR;', '  node [fontname="Helvetica", fontsize=10];']
+  for node_id, node in sorted(graph['nodes'].items()):
+    label = node['name']
+    if node['kind'] == 'group':
+      label = '%s (%d more)' % (node['name'], node['members'])
+    color = 'grey40' if grey else ('red' if node['name'] == center else { 'comm' : 'darkgreen', 'tech' : 'darkblue' }.get(node['kind'], 'black'))
+    lines.append('  %s [label=%s, shape=%s, color=%s];' % (_quote(node_id), _quote(label), SHAPES[node['kind']], color))
+  labels = graph.get('labels', {})
+  for source, target in graph['edges']:
+    count = labels.get('%s>%s' % (source, target))
+    lines.append('  %s -> %s%s;' % (_quote(source), _quote(target), ' [label="%d"]' % count if count else ''))
+  lines.append('}')
+  return u'\n'.join(lines).encode('utf-8')
+
+
+def _dot(args):
+  """
+  Run dot, killing it after DIAGRAM_TIMEOUT seconds
+  """
+  process = subprocess.Popen(['dot'] + args)
+  deadline = time.time() + settings.DIAGRAM_TIMEOUT
+  while process.poll() is None:
+    if time.time() > deadline:
+      process.kill()
+      process.wait()
+      raise ValueError("The graph could not be drawn within %d seconds, try a smaller node budget" % settings.DIAGRAM_TIMEOUT)
+    time.sleep(0.1)
+  if process.returncode:
+    raise subprocess.CalledProcessError(process.returncode, 'dot')
+
+
+def render(filename, view, center='', hops=1, budget=None, format='svg', colorscheme='color'):
+  """
+  Draw a view with dot. Returns a dict with the image path relative to
+  result/input (like runInput), the zip url and the graph size.
+  """
+  if format not in FORMATS:
+    raise ValueError("Unknown format %s, use one of %s" % (format, ', '.join(FORMATS)))
+
+  options = [file_catalog.content_hash(filename), view, center, hops, budget, format, colorscheme]
+  key = hashlib.sha1(json.dumps(options)).hexdigest()
+
+  entry = images.get(key)
+  if entry is None:
+    graph = select(filename, view, center, hops, budget)
+
+    def build(directory):
+      source = to_dot(graph, colorscheme == 'grey', center)
+      with open(os.path.join(directory, 'graph.dot'), 'w') as f:
+        f.write(source)
+      _dot(['-T' + format, '-o', os.path.join(directory, 'graph.' + format), os.path.join(directory, 'graph.dot')])
+      with open(os.path.join(directory, 'size.json'), 'w') as f:
+        json.dump({ 'nodes' : len(graph['nodes']), 'edges' : len(graph['edges']) }, f)
+
+    entry = images.put(key, build)
+
+  with open(os.path.join(entry, 'size.json')) as f:
+    size = json.load(f)
+
+  result = {
+    'filename' : os.path.relpath(os.path.join(entry, 'graph.' + format), settings.RESULT_DIR + 'input'),
+    'zip_path' : zipstream.download_url([os.path.relpath(entry, settings.RESULT_DIR)], name='graph.zip'),
+  }
+  result.update(size)
+  return result
+
+
+def stats():
+  return { 'graphs' : graphs.stats(), 'images' : images.stats() }
@@ -0,0 +1,102 @@
+"""
+Output plot caching for loadsector and generateplot. Loaded output tables
+are kept per worker in a bounded in-process cache keyed by the database
+file and scenario; drawn PNGs are memoized on disk so an identical plot
+is drawn once.
+"""
+
+from django.conf import settings
+
+import collections
+import hashlib
+import json
+import os
+
+from .diskcache import DiskCache
+from . import file_catalog
+from . import subsystems
+
+_generator_class = []
+
+
+def generator_class():
+  """
+  CachedOutputPlotGenerator, defined on first use so MakeOutputPlots and
+  matplotlib are only imported when a plot is needed
+  """
+  if _generator_class:
+    return _generator_class[0]
+
+  OutputPlotGenerator = subsystems.MakeOutputPlots().OutputPlotGenerator
+
+  class CachedOutputPlotGenerator(OutputPlotGenerator):
+    """
+    OutputPlotGenerator which reads each output table (capacity, flow,
+    emissions) from the database only once
+    """
+
+    def __init__(self, db_path, scenario):
+      OutputPlotGenerator.__init__(self, db_path, scenario)
+      self.extracted = set()
+
+    def extractFromDatabase(self, type):
+      if type in self.extracted:
+        return
+      OutputPlotGenerator.extractFromDatabase(self, type)
+      self.extracted.add(type)
+
+  _generator_class.append(CachedOutputPlotGenerator)
+  return CachedOutputPlotGenerator
+
+
+_generators = collections.OrderedDict()
+
+plots = DiskCache(settings.RESULT_DIR + 'matplot/cache/', settings.PLOT_CACHE_MAX_BYTES)
+
+
+def get_generator(db_path, scenario):
+  st = os.stat(db_path)
+  key = (os.path.abspath(db_path), st.st_mtime, st.st_size, scenario)
+
+  if key in _generators:
+    generator = _generators.pop(key)
+  else:
+    generator = generator_class()(db_path, scenario)
+    while len(_generators) >= settings.PLOT_DATA_CACHE_SIZE:
+      _generators.popitem(last=False)
+
+  _generators[key] = generator
+  return generator
+
+
+def plot_key(db_path, scenario, plottype, sector, supercategories):
+  return hashlib.sha1(json.dumps([file_catalog.path_hash(db_path), scenario, plottype, sector, str(supercategories)])).hexdigest()
+
+
+def get_plot(db_path, scenario, plottype, sector, supercategories):
+  """
+  Path of the plot image relative to RESULT_DIR, drawn on the first request
+  """
+  key = plot_key(db_path, scenario, plottype, sector, supercategories)
+
+  entry = plots.get(key)
+  if entry is None:
+    def build(directory):
+      res = get_generator(db_path, scenario)
+      if (plottype == 1):
+        image = res.generatePlotForCapacity(sector, supercategories, directory + '/')
+      elif (plottype == 2):
+        image = res.generatePlotForOutputFlow(sector, supercategories, directory + '/')
+      elif (plottype == 3):
+        image = res.generatePlotForEmissions(sector, supercategories, directory + '/')
+      else:
+        raise ValueError("Unknown plot type %s" % plottype)
+      with open(os.path.join(directory, 'image'), 'w') as f:
+        f.write(image)
+
+    entry = plots.put(key, build)
+
+  with open(os.path.join(entry, 'image')) as f:
+    image = f.read()
+
+  return os.path.relpath(os.path.join(entry, image), settings.RESULT_DIR)
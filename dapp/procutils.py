@@ -0,0 +1,61 @@
+"""
+Process information from /proc (Linux)
+"""
+
+import os
+
+
+def descendants():
+  """
+  pid -> cpu seconds of the processes started by this one
+  """
+  parents = {}
+  cpu = {}
+  ticks = float(os.sysconf('SC_CLK_TCK'))
+  for name in os.listdir('/proc'):
+    if not name.isdigit():
+      continue
+    try:
+      with open('/proc/%s/stat' % name) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, IndexError):
+      continue
+    parents[int(name)] = int(fields[1])
+    cpu[int(name)] = (int(fields[11]) + int(fields[12])) / ticks
+
+  found = {}
+  pids = [os.getpid()]
+  while pids:
+    children = [pid for pid, ppid in parents.items() if ppid in pids and pid not in found]
+    for pid in children:
+      found[pid] = cpu[pid]
+    pids = children
+  return found
+
+
+def peak_rss(pid='self'):
+  """
+  High-water mark of the resident set size in bytes (VmHWM), None if
+  unknown
+  """
+  try:
+    with open('/proc/%s/status' % pid) as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except (IOError, ValueError):
+    pass
+  return None
+
+
+def reset_peak_rss():
+  """
+  Reset this process' VmHWM to its current RSS. Returns False where the
+  kernel does not support it.
+  """
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except IOError:
+    return False
@@ -0,0 +1,186 @@
+"""
+Structured progress of a model run. The text runModelUI yields is matched
+against the messages Temoa prints when it enters each phase, giving typed
+events with start/end timestamps, peak RSS and model size that can be
+streamed as newline-delimited json or server-sent events and stored with
+the run.
+
+The peak RSS of a phase is that of the phase alone: the process' high-water
+mark is reset when a phase starts, and the solver processes' own peaks are
+sampled while the phase prints output.
+"""
+
+import json
+import re
+import resource
+import time
+
+from . import procutils
+
+#phase -> message printed by Temoa when the phase starts
+PHASES = [
+  ('read_data', re.compile(r'reading data', re.I)),
+  ('build_instance', re.compile(r'(creating|building).*(model )?instance', re.I)),
+  ('write_lp', re.compile(r'(writing|creating).*lp file', re.I)),
+  ('solve', re.compile(r'\bsolving\b', re.I)),
+  ('write_results', re.compile(r'(formatting|writing|saving)\s.*results', re.I)),
+]
+
+#solver and Pyomo messages reporting the model size
+VARIABLES_RE = re.compile(r'Number of variables:\s*(\d+)', re.I)
+CONSTRAINTS_RE = re.compile(r'Number of constraints:\s*(\d+)', re.I)
+GLPK_SIZE_RE = re.compile(r'(\d+) rows, (\d+) columns')
+
+#seconds between samples of the solver processes' peak RSS
+SAMPLE_INTERVAL = 1
+
+
+def _children_maxrss():
+  #kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+class PeakRss(object):
+  """
+  Peak RSS in bytes of this process and its solver processes since start()
+  """
+
+  def start(self):
+    self.own = procutils.reset_peak_rss()
+    self.children_base = _children_maxrss()
+    self.children = 0
+    self.sampled = 0
+
+  def sample(self, interval=0):
+    #live solver processes, their peak is gone once they are reaped
+    now = time.time()
+    if now - self.sampled < interval:
+      return
+    self.sampled = now
+    for pid in procutils.descendants():
+      self.children = max(self.children, procutils.peak_rss(pid) or 0)
+
+  def peak(self):
+    self.sample()
+    #a solver reaped during the phase raises the children's high-water mark
+    reaped = _children_maxrss()
+    children = max(self.children, reaped if reaped > self.children_base else 0)
+    own = procutils.peak_rss() if self.own else None
+    if own is None:
+      #lifetime peak where the high-water mark can't be reset
+      own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return max(own, children)
+
+
+class Tracker(object):
+
+  def __init__(self):
+    self.phases = []
+    self.current = None
+    self.model = {}
+    self.start = time.time()
+    self.rss = PeakRss()
+
+  def _end_phase(self, now):
+    phase = self.current
+    phase['end'] = now
+    phase['duration'] = now - phase['start']
+    phase['peak_rss'] = self.rss.peak()
+    self.phases.append(phase)
+    self.current = None
+    return dict(phase, type='phase_end')
+
+  def feed(self, text):
+    """
+    Events for a piece of run output, the output event last
+    """
+    now = time.time()
+    events = []
+
+    for name, pattern in PHASES:
+      if pattern.search(text) and (self.current is None or self.current['phase'] != name):
+        if self.current:
+          events.append(self._end_phase(now))
+        self.current = { 'phase' : name, 'start' : now }
+        self.rss.start()
+        events.append({ 'type' : 'phase_start', 'phase' : name, 'time' : now })
+
+    size = {}
+    match = VARIABLES_RE.search(text)
+    if match:
+      size['variables'] = int(match.group(1))
+    match = CONSTRAINTS_RE.search(text)
+    if match:
+      size['constraints'] = int(match.group(1))
+    match = GLPK_SIZE_RE.search(text)
+    if match:
+      size['constraints'], size['variables'] = int(match.group(1)), int(match.group(2))
+    if size and size != dict((k, self.model.get(k)) for k in size):
+      self.model.update(size)
+      events.append(dict(self.model, type='model_size', time=now))
+
+    if self.current:
+      self.rss.sample(SAMPLE_INTERVAL)
+
+    events.append({ 'type' : 'output', 'text' : text, 'time' : now })
+    return events
+
+  def finish(self):
+    now = time.time()
+    events = []
+    if self.current:
+      events.append(self._end_phase(now))
+    events.append({ 'type' : 'done', 'time' : now, 'timings' : self.timings() })
+    return events
+
+  def timings(self):
+    phases = self.phases + ([self.current] if self.current else [])
+    return {
+      'start' : self.start,
+      'startup' : phases[0]['start'] - self.start if phases else None,
+      'phases' : self.phases,
+      'model' : self.model,
+      'peak_rss' : max([p['peak_rss'] for p in self.phases] or [None]),
+    }
+
+
+def events(lines, tracker=None):
+  tracker = tracker or Tracker()
+  for text in lines:
+    for event in tracker.feed(text):
+      yield event
+  for event in tracker.finish():
+    yield event
+
+
+def ndjson(events):
+  for event in events:
+    yield json.dumps(event) + '\n'
+
+
+def sse(events):
+  for event in events:
+    yield 'event: %s\ndata: %s\n\n' % (event['type'], json.dumps(event))
+
+
+def summarize(timings_list):
+  """
+  Count, mean and max duration of each phase, and of the startup before
+  the first one, over the timings of many runs
+  """
+  summary = {}
+  for timings in timings_list:
+    #time before the first phase, reported like a phase
+    if timings.get('startup') is not None:
+      phase = { 'phase' : 'startup', 'duration' : timings['startup'] }
+      timings = dict(timings, phases=[phase] + timings.get('phases', []))
+    for phase in timings.get('phases', []):
+      entry = summary.setdefault(phase['phase'], { 'runs' : 0, 'total' : 0.0, 'max' : 0.0 })
+      entry['runs'] += 1
+      entry['total'] += phase['duration']
+      entry['max'] = max(entry['max'], phase['duration'])
+
+  for entry in summary.values():
+    entry['mean'] = entry['total'] / entry['runs']
+
+  return summary
@@ -0,0 +1,70 @@
+"""
+Cache of model run results keyed by the input file contents and the run
+options, so an identical run returns the stored db_io folder and log
+instead of solving again.
+"""
+
+from django.conf import settings
+
+import hashlib
+import json
+import os
+import shutil
+
+from .diskcache import DiskCache
+from .fileutils import file_hash
+
+#options that only say where things are written, not what is solved
+PATH_OPTIONS = ('--input', '--output', '--path_to_db_io', '--path_to_logs')
+
+LOG_FILE = 'output.log'
+MODEL_DIR = 'model'
+
+cache = DiskCache(settings.RESULT_CACHE_DIR, settings.RESULT_CACHE_MAX_BYTES)
+
+
+def run_key(values):
+  """
+  Cache key for the config values of a run, or None if the run can't be
+  cached. Runs writing into an output database are never cached: a hit
+  would skip writing the scenario into that database.
+  """
+  if values.get('--output'):
+    return None
+
+  inputfile = values.get('--input', '')
+  if not os.path.isfile(inputfile):
+    return None
+
+  options = dict((k, v) for k, v in values.items() if k not in PATH_OPTIONS)
+  options['input_ext'] = os.path.splitext(inputfile)[1]
+  options['input_hash'] = file_hash(inputfile)
+
+  return hashlib.sha1(json.dumps(options, sort_keys=True)).hexdigest()
+
+
+def lookup(key):
+  return cache.get(key)
+
+
+def restore(entry, generatedfolderpath):
+  """
+  Copy the cached db_io folder into place and return the cached run output
+  """
+  shutil.copytree(os.path.join(entry, MODEL_DIR), generatedfolderpath)
+
+  with open(os.path.join(entry, LOG_FILE)) as f:
+    return f.read()
+
+
+def store(key, generatedfolderpath, output):
+  def build(entry):
+    shutil.copytree(generatedfolderpath, os.path.join(entry, MODEL_DIR))
+    with open(os.path.join(entry, LOG_FILE), 'w') as f:
+      f.write(output)
+
+  return cache.put(key, build)
+
+
+def invalidate(key):
+  cache.invalidate(key)
@@ -0,0 +1,142 @@
+"""
+Result writes into shared output databases. Temoa writes a run's results
+into a scratch copy of the output database; the Output_* rows of the run's
+scenarios are then merged into the shared database in WAL mode, one
+transaction and batched executemany per table. Merges into the same
+database wait for each other on a lock file, solves never do.
+"""
+
+from django.conf import settings
+
+import fcntl
+import os
+import sqlite3
+import time
+import uuid
+
+from .fileutils import clone_file, makedirs
+from . import content_store
+
+LOCK_DIR = '.locks/'
+
+BATCH_ROWS = 10000
+
+
+def lock_path(path):
+  return os.path.join(os.path.dirname(path), LOCK_DIR, os.path.basename(path) + '.lock')
+
+
+class DatabaseLock(object):
+  """
+  flock on the lock file of a database: shared while it is copied,
+  exclusive while results are merged into it
+  """
+
+  def __init__(self, path, exclusive=True):
+    self.path = lock_path(path)
+    self.mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+
+  def __enter__(self):
+    makedirs(os.path.dirname(self.path))
+    self.file = open(self.path, 'a')
+    fcntl.flock(self.file, self.mode)
+    return self
+
+  def __exit__(self, *args):
+    fcntl.flock(self.file, fcntl.LOCK_UN)
+    self.file.close()
+
+
+def scratch_copy(path, directory=None):
+  """
+  Private copy of the output database for one run to write into, in
+  directory (RESULT_SCRATCH_DIR by default)
+  """
+  directory = directory or settings.RESULT_SCRATCH_DIR
+  makedirs(directory)
+  scratch = os.path.join(directory, uuid.uuid4().hex + '_' + os.path.basename(path))
+  with DatabaseLock(path, exclusive=False):
+    clone_file(path, scratch)
+  return scratch
+
+
+def discard(scratch):
+  for name in (scratch, scratch + '-journal', scratch + '-wal', scratch + '-shm'):
+    try:
+      os.remove(name)
+    except OSError:
+      pass
+
+
+def _quote(name):
+  return '"' + name.replace('"', '""') + '"'
+
+
+def _output_tables(cur):
+  """
+  (table, columns) of the Output_ tables with a scenario column
+  """
+  tables = []
+  names = [row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Output%'")]
+  for name in names:
+    columns = [row[1] for row in cur.execute('PRAGMA table_info(%s)' % _quote(name))]
+    if 'scenario' in columns:
+      tables.append((name, columns))
+  return tables
+
+
+def merge(scratch, path, scenario):
+  """
+  Replace the rows of scenario and its MGA iterations in the Output tables
+  of the shared database by those of the scratch copy. Returns a report
+  line for the run output.
+  """
+  start = time.time()
+  pattern = scenario.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '\\_mga\\_%'
+  where = "scenario = ? OR scenario LIKE ? ESCAPE '\\'"
+
+  source = sqlite3.connect(scratch)
+  rows = 0
+  tables = 0
+
+  with DatabaseLock(path):
+    content_store.detach(path)
+
+    target = sqlite3.connect(path, timeout=60, isolation_level=None)
+    try:
+      target.execute('PRAGMA journal_mode=WAL')
+      target.execute('PRAGMA synchronous=NORMAL')
+
+      existing = dict(_output_tables(target.cursor()))
+      for table, columns in _output_tables(source.cursor()):
+        if table not in existing:
+          continue
+        columns = [c for c in columns if c in existing[table]]
+        read = source.execute('SELECT %s FROM %s WHERE %s' % (', '.join(map(_quote, columns)), _quote(table), where),
+          (scenario, pattern))
+        insert = 'INSERT INTO %s (%s) VALUES (%s)' % (_quote(table), ', '.join(map(_quote, columns)), ', '.join('?' * len(columns)))
+
+        target.execute('BEGIN IMMEDIATE')
+        try:
+          target.execute('DELETE FROM %s WHERE %s' % (_quote(table), where), (scenario, pattern))
+          while True:
+            batch = read.fetchmany(BATCH_ROWS)
+            if not batch:
+              break
+            target.executemany(insert, batch)
+            rows += len(batch)
+          target.execute('COMMIT')
+        except:
+          target.execute('ROLLBACK')
+          raise
+        tables += 1
+
+      #copies of the database file must see the merged rows
+      target.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+      target.close()
+      source.close()
+
+  elapsed = time.time() - start
+  return "Wrote %d result rows into %d tables of %s in %.2fs (%d rows/s)\n" % (
+    rows, tables, os.path.basename(path), elapsed, rows / elapsed if elapsed > 0 else rows)
@@ -0,0 +1,191 @@
+"""
+Per-run logs. The output of a run goes to RUN_LOG_DIR/<run_id>.log and
+Temoa's debug logs to RUN_LOG_DIR/<run_id>/. Clients poll with the byte
+offset they have read up to and get only the bytes written since, so a
+poll costs the same however long the log is. Old logs are compressed and
+removed by rotate(), logs larger than RUN_LOG_MAX_BYTES are rotated.
+
+Logs are rotated by copy and truncate, so a writer keeping the log open
+goes on writing to it: the bytes so far are appended to <log>.1.gz and
+counted in <log>.1.size, which keeps the offsets of tail() valid. Bytes
+written during the rotation itself are lost. Temoa's logs are only
+rotated while no run writes to them; run output, which is opened for
+appending, at any time.
+"""
+
+from django.conf import settings
+
+import gzip
+import os
+import shutil
+import time
+
+from .fileutils import makedirs, tree_size
+from .models import ModelRun
+
+#Temoa's debug log in a run's debug folder
+DEBUG_LOG = 'Complete_OutputLog.log'
+
+#Temoa's log when runs write to the shared debug_logs folder
+SHARED_LOG = 'debug_logs/' + DEBUG_LOG
+
+ROTATED = '.1.gz'
+ROTATED_SIZE = '.1.size'
+
+_last_rotate = [0]
+
+
+def output_path(run_id):
+  return settings.RUN_LOG_DIR + run_id + '.log'
+
+
+def debug_dir(run_id):
+  path = settings.RUN_LOG_DIR + run_id
+  makedirs(path)
+  return path
+
+
+def tail(path, offset=0, max_bytes=None):
+  """
+  Bytes of the log written after offset, at most max_bytes of them.
+  Returns (data, new_offset); a compressed log is read transparently.
+  """
+  max_bytes = max_bytes or settings.RUN_LOG_TAIL_MAX_BYTES
+  offset = max(0, int(offset))
+
+  rotated = _rotated_size(path)
+  if offset < rotated and not os.path.isfile(path + ROTATED):
+    #the rotated part was removed
+    offset = rotated
+
+  if offset < rotated:
+    f = gzip.open(path + ROTATED, 'rb')
+    position, max_bytes = offset, min(max_bytes, rotated - offset)
+  elif os.path.isfile(path):
+    f = open(path, 'rb')
+    position = offset - rotated
+  elif os.path.isfile(path + '.gz'):
+    f = gzip.open(path + '.gz', 'rb')
+    position = offset - rotated
+  else:
+    return "", offset
+
+  try:
+    f.seek(position)
+    data = f.read(max_bytes)
+  finally:
+    f.close()
+
+  return data, offset + len(data)
+
+
+def _rotated_size(path):
+  try:
+    with open(path + ROTATED_SIZE) as f:
+      return int(f.read() or 0)
+  except (IOError, ValueError):
+    return 0
+
+
+def _copy_truncate(path, archive):
+  """
+  Append the log to the gzip archive and empty it. Returns the number of
+  bytes moved.
+  """
+  with open(path, 'r+b') as src:
+    dst = gzip.open(archive, 'ab')
+    try:
+      shutil.copyfileobj(src, dst)
+    finally:
+      dst.close()
+    moved = src.tell()
+    src.truncate(0)
+  return moved
+
+
+def _rotate(path):
+  if os.path.getsize(path) < settings.RUN_LOG_MAX_BYTES:
+    return
+  rotated = _rotated_size(path) + _copy_truncate(path, path + ROTATED)
+  with open(path + ROTATED_SIZE + '.tmp', 'w') as f:
+    f.write(str(rotated))
+  os.rename(path + ROTATED_SIZE + '.tmp', path + ROTATED_SIZE)
+
+
+def _compress(path):
+  with open(path, 'rb') as src:
+    dst = gzip.open(path + '.gz.tmp', 'wb')
+    try:
+      shutil.copyfileobj(src, dst)
+    finally:
+      dst.close()
+  os.rename(path + '.gz.tmp', path + '.gz')
+  os.remove(path)
+
+
+def _rotate_shared(now):
+  path = settings.RESULT_DIR + SHARED_LOG
+  try:
+    if os.path.getsize(path) < settings.RUN_LOG_MAX_BYTES:
+      return
+  except OSError:
+    return
+
+  archive = settings.RESULT_DIR + "debug_logs/OutputLog__" + time.strftime('%Y-%m-%d__%H-%M-%S', time.localtime(now)) + ".log.gz"
+  _copy_truncate(path, archive)
+
+
+def rotate(force=False):
+  """
+  Compress logs idle for RUN_LOG_COMPRESS_AGE, delete those older than
+  RUN_LOG_MAX_AGE and then the oldest ones while the log folder is larger
+  than RUN_LOG_DIR_MAX_BYTES. Runs at most every RUN_LOG_ROTATE_INTERVAL.
+  """
+  now = time.time()
+  if not force and now - _last_rotate[0] < settings.RUN_LOG_ROTATE_INTERVAL:
+    return
+  _last_rotate[0] = now
+
+  #Temoa may write to the shared log during any run
+  running = set(ModelRun.objects.filter(status=ModelRun.RUNNING).values_list('run_id', flat=True))
+  if not running:
+    _rotate_shared(now)
+
+  if not os.path.isdir(settings.RUN_LOG_DIR):
+    return
+
+  entries = []
+  for name in os.listdir(settings.RUN_LOG_DIR):
+    path = settings.RUN_LOG_DIR + name
+    try:
+      mtime = os.path.getmtime(path)
+      if now - mtime > settings.RUN_LOG_MAX_AGE:
+        if os.path.isdir(path):
+          shutil.rmtree(path, ignore_errors=True)
+        else:
+          os.remove(path)
+        continue
+
+      if name.endswith('.log'):
+        _rotate(path)
+        if now - mtime > settings.RUN_LOG_COMPRESS_AGE:
+          _compress(path)
+          path += '.gz'
+      elif os.path.isdir(path) and name not in running and os.path.isfile(os.path.join(path, DEBUG_LOG)):
+        _rotate(os.path.join(path, DEBUG_LOG))
+      entries.append((mtime, tree_size(path), path))
+    except (IOError, OSError):
+      continue
+
+  total = sum(size for _, size, _ in entries)
+  for mtime, size, path in sorted(entries):
+    if total <= settings.RUN_LOG_DIR_MAX_BYTES:
+      break
+    #never remove the log of a run still writing to it
+    if now - mtime < settings.RUN_LOG_COMPRESS_AGE:
+      break
+    if os.path.isdir(path):
+      shutil.rmtree(path, ignore_errors=True)
+    else:
+      os.remove(path)
+    total -= size
@@ -0,0 +1,186 @@
+"""
+Pre-forked solver processes for the job runner. Each worker imports Pyomo
+and the Temoa model once when it starts, then takes run ids from the
+runner over a pipe. A worker exits after JOB_MAX_RUNS_PER_WORKER runs or
+when its RSS grows past JOB_WORKER_MAX_RSS, and the runner starts a fresh
+one, so the pool stays warm without leaking memory across runs. Runs go
+through admission.RunLimits; a worker whose run went over a limit is
+replaced too.
+"""
+
+from django.conf import settings
+
+import multiprocessing
+import os
+import resource
+import time
+import traceback
+
+from . import admission
+from . import metrics
+from . import subsystems
+
+
+def preload():
+  """
+  Import what every run needs; done once per worker instead of per run
+  """
+  pyomo = subsystems.load('pyomo')
+  subsystems.temoa_model()
+
+  #locates the solver executable, cached by Pyomo for later runs
+  try:
+    pyomo.SolverFactory(settings.JOB_PRELOAD_SOLVER).available(exception_flag=False)
+  except Exception as e:
+    print "Solver preload failed", e
+
+
+def current_rss():
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * resource.getpagesize()
+  except (IOError, ValueError):
+    return 0
+
+
+def _worker_main(conn, target):
+  metrics.reset()
+  start = time.time()
+  preload()
+  conn.send({ 'type' : 'ready', 'pid' : os.getpid(), 'preload' : time.time() - start })
+
+  runs = 0
+  while True:
+    try:
+      task = conn.recv()
+    except EOFError:
+      break
+    if task is None:
+      break
+
+    limits = admission.RunLimits()
+    try:
+      with limits:
+        target(task['run_id'], task['dispatched'])
+    except Exception:
+      traceback.print_exc()
+
+    runs += 1
+    rss = current_rss()
+    recycle = runs >= settings.JOB_MAX_RUNS_PER_WORKER or bool(limits.exceeded) or \
+      bool(settings.JOB_WORKER_MAX_RSS and rss > settings.JOB_WORKER_MAX_RSS)
+    conn.send({ 'type' : 'done', 'run_id' : task['run_id'], 'rss' : rss, 'runs' : runs, 'recycle' : recycle })
+    if recycle:
+      break
+
+  conn.close()
+
+
+class Worker(object):
+
+  def __init__(self, target):
+    self.conn, child = multiprocessing.Pipe()
+    self.process = multiprocessing.Process(target=_worker_main, args=(child, target))
+    self.process.daemon = True
+    self.process.start()
+    child.close()
+
+    self.spawned = time.time()
+    self.ready = False
+    self.run_id = None
+    self.runs = 0
+    self.rss = 0
+    self.recycle = False
+
+  def dispatch(self, run_id):
+    self.run_id = run_id
+    self.conn.send({ 'run_id' : run_id, 'dispatched' : time.time() })
+
+
+class SolverPool(object):
+  """
+  size warm workers calling target(run_id, dispatched) for each run
+  """
+
+  def __init__(self, size, target):
+    self.size = size
+    self.target = target
+    self.workers = []
+    self.recycled = 0
+    self.fill()
+
+  def fill(self):
+    while len(self.workers) < self.size:
+      self.workers.append(Worker(self.target))
+
+  def poll(self):
+    """
+    Handle worker messages and replace exited workers. Returns the ids of
+    runs whose worker died before finishing them.
+    """
+    lost = []
+
+    for worker in list(self.workers):
+      try:
+        while worker.conn.poll():
+          message = worker.conn.recv()
+          if message['type'] == 'ready':
+            worker.ready = True
+            metrics.observe('dapp_solver_preload_seconds', {}, message['preload'])
+          elif message['type'] == 'done':
+            worker.run_id = None
+            worker.runs = message['runs']
+            worker.rss = message['rss']
+            worker.recycle = message['recycle']
+      except (EOFError, IOError):
+        pass
+
+      if worker.recycle or not worker.process.is_alive():
+        worker.process.join(1)
+        if worker.run_id:
+          lost.append(worker.run_id)
+        if worker.recycle:
+          self.recycled += 1
+          metrics.inc('dapp_solver_workers_recycled_total', {})
+        worker.conn.close()
+        self.workers.remove(worker)
+
+    self.fill()
+    self._report()
+    return lost
+
+  def idle(self):
+    return [w for w in self.workers if w.ready and w.run_id is None]
+
+  def busy(self):
+    return len([w for w in self.workers if w.run_id is not None])
+
+  def dispatch(self, run_id):
+    self.idle()[0].dispatch(run_id)
+
+  def _report(self):
+    metrics.set_gauge('dapp_solver_workers_warm', {}, len([w for w in self.workers if w.ready]))
+    metrics.set_gauge('dapp_solver_workers_busy', {}, self.busy())
+    metrics.flush()
+
+  def stats(self):
+    return {
+      'size' : self.size,
+      'warm' : len([w for w in self.workers if w.ready]),
+      'busy' : self.busy(),
+      'recycled' : self.recycled,
+      'workers' : [{ 'pid' : w.process.pid, 'ready' : w.ready, 'run_id' : w.run_id,
+        'runs' : w.runs, 'rss' : w.rss, 'age' : time.time() - w.spawned } for w in self.workers],
+    }
+
+  def close(self):
+    for worker in self.workers:
+      try:
+        worker.conn.send(None)
+      except IOError:
+        pass
+    for worker in self.workers:
+      worker.process.join(5)
+      if worker.process.is_alive():
+        worker.process.terminate()
+    self.workers = []
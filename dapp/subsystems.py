@@ -0,0 +1,108 @@
+"""
+Heavy subsystems (Pyomo and the Temoa model, the Temoa data processing
+modules with matplotlib, pandas) imported on first use instead of when
+dapp loads, so a worker serving only file lists never pays for them.
+preload() imports them all up front, e.g. in the gunicorn master before
+it forks (config/gunicorn/gunicorn_conf.py), and the time each import
+took is kept for the startup report.
+"""
+
+import collections
+import importlib
+import os
+import sys
+import time
+
+#name -> module; earlier entries are dependencies of later ones, so
+#preloading in this order gives the cost of each one on its own
+SUBSYSTEMS = collections.OrderedDict([
+  ('pyomo', 'pyomo.environ'),
+  ('temoa_model', 'thirdparty.temoa.temoa_model.temoa_model'),
+  ('get_comm_tech', 'thirdparty.temoa.temoa_model.get_comm_tech'),
+  ('matplotlib', 'matplotlib'),
+  ('pandas', 'pandas'),
+  ('db_query', 'thirdparty.temoa.data_processing.db_query'),
+  ('MakeOutputPlots', 'thirdparty.temoa.data_processing.MakeOutputPlots'),
+  ('MakeGraphviz', 'thirdparty.temoa.data_processing.MakeGraphviz'),
+])
+
+#modules whose sqlite3 connections to uploads go through dapp.dbpool
+POOLED = ('get_comm_tech', 'db_query', 'MakeOutputPlots', 'MakeGraphviz')
+
+_loaded = collections.OrderedDict()
+
+
+def load(name):
+  if name in _loaded:
+    return _loaded[name]['module']
+
+  modules = len(sys.modules)
+  start = time.time()
+  if name == 'matplotlib':
+    #no display on the server
+    import matplotlib
+    matplotlib.use('Agg')
+  module = importlib.import_module(SUBSYSTEMS[name])
+  elapsed = time.time() - start
+
+  if name in POOLED:
+    from . import dbpool
+    dbpool.install(module)
+
+  _loaded[name] = {
+    'module' : module,
+    'seconds' : elapsed,
+    'modules' : len(sys.modules) - modules,
+    'pid' : os.getpid(),
+  }
+  return module
+
+
+def temoa_model():
+  return load('temoa_model')
+
+def get_comm_tech():
+  return load('get_comm_tech')
+
+def db_query():
+  return load('db_query')
+
+def pandas():
+  return load('pandas')
+
+def MakeOutputPlots():
+  return load('MakeOutputPlots')
+
+def MakeGraphviz():
+  return load('MakeGraphviz')
+
+
+def preload(names=None):
+  """
+  Import the given subsystems (all by default); ones that fail to import
+  are reported, not raised, so a missing optional part does not stop the
+  server
+  """
+  errors = {}
+  for name in names or SUBSYSTEMS:
+    try:
+      load(name)
+    except Exception as e:
+      errors[name] = '%s: %s' % (type(e).__name__, e)
+  return errors
+
+
+def report():
+  """
+  Import cost of each subsystem loaded by this process. preloaded is true
+  for the ones inherited from the parent process (e.g. gunicorn master).
+  """
+  result = collections.OrderedDict()
+  for name in SUBSYSTEMS:
+    if name in _loaded:
+      info = _loaded[name]
+      result[name] = { 'loaded' : True, 'seconds' : round(info['seconds'], 4),
+        'modules' : info['modules'], 'preloaded' : info['pid'] != os.getpid() }
+    else:
+      result[name] = { 'loaded' : False }
+  return result
@@ -1,4 +1,1390 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from django.utils import timezone
 
-# Create your tests here.
-#test commit
+import collections
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+from .diskcache import DiskCache
+from .models import ModelRun
+from . import admission
+from . import analytics
+from . import artifacts
+from . import batch
+from . import content_store
+from . import dbpool
+from . import dat_reader
+from . import diagram_cache
+from . import diagrams
+from . import file_catalog
+from . import file_index
+from . import jobs
+from . import metrics
+from . import mga
+from . import network
+from . import plot_cache
+from . import procutils
+from . import progress
+from . import result_writer
+from . import solver_pool
+from . import subsystems
+from . import runlog
+from . import uploads
+from . import workspace
+from . import zipstream
+
+#excerpt of Temoa's utopia.dat
+UTOPIA_DAT = """
+data ;
+
+set time_exist := 1960 1970 1980 ;
+set time_future :=
+  1990
+  2000
+  2010
+  2020 # final period
+;
+
+set tech_resource := IMPDSL1 IMPGSL1 IMPHCO1 ;
+set tech_production := E01 E21 'RHO' ;
+set commodity_demand := RH RL TX ;
+
+param GlobalDiscountRate := 0.05 ;
+
+param: Efficiency :=
+  ethos     IMPDSL1  1990  DSL   1.00
+  ethos     IMPGSL1  1990  GSL   1.00
+  HCO       E01      1960  ELC   0.32   # coal power plant
+  URN       E21      1990  ELC   0.40
+  DSL       RHO      1990  RH    0.65
+  ELC       nan      2000  RL    0.90
+;
+
+param: LifetimeTech  LifetimeLoanTech :=
+  E01  40  40
+  E21  40  .
+;
+
+param Demand :=
+  1990 RH 25.2
+  2000 RH 37.8
+;
+
+param CapacityFactorProcess : 1960 1990 :=
+  E01  0.8  .
+  E21  .    0.85
+;
+"""
+
+
+def _importable(name):
+  try:
+    __import__(name)
+    return True
+  except ImportError:
+    return False
+
+
+class DatReaderTest(SimpleTestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'utopia.dat')
+    with open(self.path, 'w') as f:
+      f.write(UTOPIA_DAT)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_sets(self):
+    symbols = dat_reader.parse(self.path)
+    self.assertEqual(symbols['time_exist'], { 'kind' : 'set', 'rows' : [[1960], [1970], [1980]] })
+    self.assertEqual(symbols['time_future']['rows'], [[1990], [2000], [2010], [2020]])
+    self.assertEqual(symbols['tech_production']['rows'], [[u'E01'], [u'E21'], [u'RHO']])
+
+  def test_values(self):
+    rows = dat_reader.parse(self.path)['Efficiency']['rows']
+    self.assertEqual(rows[2], [u'HCO', u'E01', 1960, u'ELC', 0.32])
+    #names are unicode, numerals only are numbers
+    self.assertIsInstance(rows[0][0], unicode)
+    self.assertEqual(rows[5][1], u'nan')
+    self.assertEqual(dat_reader.parse(self.path)['GlobalDiscountRate']['rows'], [[0.05]])
+
+  def test_tabular_params(self):
+    symbols = dat_reader.parse(self.path)
+    self.assertEqual(symbols['LifetimeTech']['rows'], [[u'E01', 40], [u'E21', 40]])
+    #missing values are left out
+    self.assertEqual(symbols['LifetimeLoanTech']['rows'], [[u'E01', 40]])
+    self.assertEqual(symbols['CapacityFactorProcess']['rows'], [[u'E01', 1960, 0.8], [u'E21', 1990, 0.85]])
+
+  def test_comm_tech(self):
+    technologies = dat_reader.comm_tech(self.path, 'technology')
+    self.assertEqual(list(technologies), [u'E01', u'E21', u'IMPDSL1', u'IMPGSL1', u'RHO', u'nan'])
+    commodities = dat_reader.comm_tech(self.path, 'commodity')
+    self.assertEqual(list(commodities), [u'DSL', u'ELC', u'GSL', u'HCO', u'RH', u'RL', u'URN'])
+
+  def test_efficiency(self):
+    self.assertEqual(len(dat_reader.efficiency(self.path)), 6)
+    self.assertEqual(dat_reader.efficiency(self.path)[3], [u'URN', u'E21', 1990, u'ELC', 0.4])
+
+  @unittest.skipUnless(_importable('thirdparty.temoa.temoa_model.get_comm_tech'), 'Temoa is not installed')
+  def test_same_lists_as_get_comm_tech(self):
+    from thirdparty.temoa.temoa_model import get_comm_tech
+    for listType, flag in (('commodity', '--comm'), ('technology', '--tech')):
+      self.assertEqual(dat_reader.comm_tech(self.path, listType), get_comm_tech.get_info({ '--input' : self.path, flag : True }))
+
+
+class TempDirTest(SimpleTestCase):
+  """
+  A temporary folder per test, self.dir
+  """
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp() + '/'
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+
+Run = collections.namedtuple('Run', 'name owner created')
+
+
+class FairOrderTest(SimpleTestCase):
+
+  def test_round_robin_between_owners(self):
+    queued = [Run('a1', 'a', 1), Run('a2', 'a', 2), Run('a3', 'a', 3), Run('b4', 'b', 4), Run('c5', 'c', 5), Run('b6', 'b', 6)]
+    order = [run.name for run in admission.fair_order(queued, [])]
+    self.assertEqual(order, ['a1', 'b4', 'c5', 'a2', 'b6', 'a3'])
+
+  def test_owners_with_running_runs_wait(self):
+    queued = [Run('a1', 'a', 1), Run('a2', 'a', 2), Run('b3', 'b', 3)]
+    order = [run.name for run in admission.fair_order(queued, ['a', 'a'])]
+    self.assertEqual(order, ['b3', 'a1', 'a2'])
+
+
+@override_settings(JOB_MAX_RUNNING=2, JOB_DEFAULT_RUN_SECONDS=600, JOB_POOL_STATS='/nonexistent/pool.json')
+class AdmissionTest(TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp() + '/'
+    self.override = override_settings(JOB_ADMISSION_LOCK=self.dir + 'admission.lock')
+    self.override.enable()
+
+  def tearDown(self):
+    self.override.disable()
+    shutil.rmtree(self.dir)
+
+  def run_of(self, run_id, owner, status=ModelRun.QUEUED, age=0, started=None):
+    ModelRun.objects.create(run_id=run_id, owner=owner, status=status, started=started,
+      inputfilename='in.sqlite', scenario='s', options='{}')
+    #oldest first, age in seconds
+    ModelRun.objects.filter(run_id=run_id).update(created=timezone.now() - datetime.timedelta(seconds=age))
+
+  def test_admit_within_limit_in_fair_order(self):
+    self.run_of('a1', 'a', age=30)
+    self.run_of('a2', 'a', age=20)
+    self.run_of('b1', 'b', age=10)
+
+    self.assertEqual(admission.admit(5, 'host:1'), ['a1', 'b1'])
+    self.assertEqual(admission.admit(5, 'host:1'), [])
+    self.assertEqual(ModelRun.objects.get(run_id='b1').runner, 'host:1')
+    self.assertEqual(ModelRun.objects.get(run_id='a2').status, ModelRun.QUEUED)
+
+  def test_has_room(self):
+    self.assertTrue(admission.has_room())
+    self.run_of('r1', 'a', ModelRun.RUNNING, started=timezone.now())
+    self.run_of('r2', 'b', ModelRun.RUNNING, started=timezone.now())
+    self.assertFalse(admission.has_room())
+
+  @override_settings(JOB_RUN_MAX_WALL_SECONDS=3600, JOB_RUN_LIMIT_CHECK_INTERVAL=5)
+  def test_stale_running_runs_do_not_count(self):
+    self.run_of('r1', 'a', ModelRun.RUNNING, started=timezone.now() - datetime.timedelta(hours=2))
+    self.run_of('r2', 'b', ModelRun.RUNNING, started=timezone.now())
+    self.assertTrue(admission.has_room())
+
+  def test_queue_positions_and_waits(self):
+    self.run_of('r1', 'a', ModelRun.RUNNING, started=timezone.now())
+    self.run_of('a1', 'a', age=30)
+    self.run_of('b1', 'b', age=20)
+    self.run_of('b2', 'b', age=10)
+
+    queue = admission.queue()
+    self.assertEqual([queue[run_id]['position'] for run_id in ('b1', 'a1', 'b2')], [1, 2, 3])
+    #one free slot, one slot busy for about the default duration
+    self.assertEqual(queue['b1']['estimated_wait'], 0)
+    self.assertAlmostEqual(queue['a1']['estimated_wait'], 600, delta=5)
+    self.assertAlmostEqual(queue['b2']['estimated_wait'], 600, delta=5)
+
+
+class ZipStreamTest(TempDirTest):
+
+  def write(self, name, data):
+    path = os.path.join(self.dir, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+  def test_archive(self):
+    self.write('run/results.txt', 'result ' * 1000)
+    self.write('run/plots/plot.png', '\x89PNG' + os.urandom(100))
+    self.write(u'run/r\xe9sum\xe9.txt'.encode('utf-8'), 'x')
+
+    data = ''.join(zipstream.generate(zipstream.walk(self.dir + 'run', 'out')))
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    self.assertIsNone(archive.testzip())
+    self.assertEqual(set(archive.namelist()), set(['out/plots/plot.png', u'out/r\xe9sum\xe9.txt', 'out/results.txt']))
+    self.assertEqual(archive.read('out/results.txt'), 'result ' * 1000)
+    self.assertEqual(archive.getinfo('out/results.txt').compress_type, zipfile.ZIP_DEFLATED)
+    #already compressed
+    self.assertEqual(archive.getinfo('out/plots/plot.png').compress_type, zipfile.ZIP_STORED)
+
+  def test_store(self):
+    path = self.write('a.txt', 'a' * 100)
+    archive = zipfile.ZipFile(io.BytesIO(''.join(zipstream.generate([('a.txt', path)], store=True))))
+    self.assertEqual(archive.getinfo('a.txt').compress_type, zipfile.ZIP_STORED)
+
+  def test_size_limit(self):
+    path = self.write('a.txt', 'a' * 100)
+    limit = zipstream.ZIP_MAX
+    zipstream.ZIP_MAX = 50
+    try:
+      with self.assertRaises(ValueError):
+        list(zipstream.generate([('a.txt', path)], store=True))
+    finally:
+      zipstream.ZIP_MAX = limit
+
+  def test_resolve_stays_in_result_dir(self):
+    self.write('result/run/a.txt', 'a')
+    self.write('secret.txt', 's')
+    os.symlink(self.dir + 'secret.txt', self.dir + 'result/link.txt')
+    with self.settings(RESULT_DIR=self.dir + 'result/'):
+      self.assertEqual(zipstream.resolve('run/a.txt'), os.path.realpath(self.dir + 'result/run/a.txt'))
+      self.assertIsNone(zipstream.resolve('../secret.txt'))
+      self.assertIsNone(zipstream.resolve('link.txt'))
+      self.assertIsNone(zipstream.resolve(''))
+      self.assertIsNone(zipstream.resolve('run/missing.txt'))
+
+
+class UploadTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.override = override_settings(UPLOADED_DIR=self.dir + 'files/', UPLOAD_STORE_DIR=self.dir + 'store/',
+      UPLOAD_PARTIAL_DIR=self.dir + 'partial/', UPLOAD_CHUNK_SIZE=4)
+    self.override.enable()
+    os.makedirs(self.dir + 'files/')
+
+  def tearDown(self):
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def upload(self, name, data, overwrite=0):
+    state = uploads.init(name, len(data), 'input', overwrite)
+    #in any order
+    for index in reversed(range(state['chunks'])):
+      chunk = data[index * 4:(index + 1) * 4]
+      uploads.write_chunk(state['upload_id'], index, hashlib.sha1(chunk).hexdigest(), chunk)
+    return uploads.finalize(state['upload_id'])
+
+  def test_finalize_links_name_to_blob(self):
+    state = self.upload('a.sqlite', 'abcdefghij')
+    self.assertEqual(state['hash'], hashlib.sha1('abcdefghij').hexdigest())
+    path = self.dir + 'files/a.sqlite'
+    with open(path) as f:
+      self.assertEqual(f.read(), 'abcdefghij')
+    self.assertTrue(os.path.samefile(path, content_store.blob_path(state['hash'])))
+    self.assertEqual(os.listdir(self.dir + 'partial/'), [])
+
+  def test_same_content_is_stored_once(self):
+    self.upload('a.sqlite', 'abcdefghij')
+    self.upload('b.sqlite', 'abcdefghij')
+    self.assertTrue(os.path.samefile(self.dir + 'files/a.sqlite', self.dir + 'files/b.sqlite'))
+    self.assertEqual(len(os.listdir(self.dir + 'store/')), 1)
+
+  def test_chunk_errors(self):
+    state = uploads.init('a.sqlite', 10, 'input', 0)
+    with self.assertRaises(uploads.UploadError):
+      uploads.write_chunk(state['upload_id'], 0, hashlib.sha1('other').hexdigest(), 'abcd')
+    with self.assertRaises(uploads.UploadError):
+      uploads.write_chunk(state['upload_id'], 3, hashlib.sha1('abcd').hexdigest(), 'abcd')
+    uploads.write_chunk(state['upload_id'], 0, hashlib.sha1('abcd').hexdigest(), 'abcd')
+    with self.assertRaises(uploads.UploadError):
+      uploads.finalize(state['upload_id'])
+    with self.assertRaises(uploads.UploadError):
+      uploads.init('../a.sqlite', 10, 'input', 0)
+
+  def test_garbage_collection(self):
+    kept = self.upload('a.sqlite', 'abcdefghij')['hash']
+    removed = self.upload('b.sqlite', 'klmnopqrst')['hash']
+    os.remove(self.dir + 'files/b.sqlite')
+
+    self.assertEqual(content_store.collect_garbage(force=True), 10)
+    self.assertTrue(os.path.isfile(content_store.blob_path(kept)))
+    self.assertFalse(os.path.exists(content_store.blob_path(removed)))
+
+  def test_garbage_collection_interval(self):
+    content_store.collect_garbage(force=True)
+    self.upload('b.sqlite', 'klmnopqrst')
+    os.remove(self.dir + 'files/b.sqlite')
+    self.assertEqual(content_store.collect_garbage(), 0)
+    self.assertEqual(content_store.collect_garbage(force=True), 10)
+
+  def test_invalid_sizes(self):
+    for size, chunk_size in ((-1, None), ('ten', None), (None, None), (10, -4), (10, 'four')):
+      with self.assertRaises(uploads.UploadError):
+        uploads.init('a.sqlite', size, 'input', 0, chunk_size)
+    self.assertEqual(uploads.init('empty.sqlite', 0, 'input', 0)['chunks'], 0)
+
+  @override_settings(UPLOAD_PARTIAL_MAX_AGE=-10)
+  def test_expired_uploads_are_purged(self):
+    state = uploads.init('a.sqlite', 10, 'input', 0)
+    uploads.write_chunk(state['upload_id'], 0, hashlib.sha1('abcd').hexdigest(), 'abcd')
+    self.assertIn(state['upload_id'], uploads._hashers)
+
+    uploads.purge_expired()
+    self.assertNotIn(state['upload_id'], uploads._hashers)
+    with self.assertRaises(uploads.UploadError):
+      uploads.status(state['upload_id'])
+
+  def test_garbage_collection_during_finalize(self):
+    done = threading.Event()
+    def collect():
+      while not done.is_set():
+        content_store.collect_garbage(force=True)
+    collector = threading.Thread(target=collect)
+    collector.start()
+    try:
+      for i in range(50):
+        self.upload('f%d.sqlite' % i, 'data %d' % i)
+    finally:
+      done.set()
+      collector.join()
+
+    for i in range(50):
+      with open(self.dir + 'files/f%d.sqlite' % i) as f:
+        self.assertEqual(f.read(), 'data %d' % i)
+      self.assertEqual(os.stat(self.dir + 'files/f%d.sqlite' % i).st_nlink, 2)
+
+
+class DiskCacheTest(TempDirTest):
+
+  def build(self, data):
+    def build(directory):
+      with open(os.path.join(directory, 'data'), 'w') as f:
+        f.write(data)
+    return build
+
+  def read(self, entry):
+    with open(os.path.join(entry, 'data')) as f:
+      return f.read()
+
+  def test_existing_entry_is_kept(self):
+    cache = DiskCache(self.dir, 10 ** 6)
+    first = cache.put('key', self.build('first'))
+    second = cache.put('key', self.build('second'))
+    self.assertEqual(first, second)
+    self.assertEqual(self.read(first), 'first')
+    self.assertEqual(os.listdir(self.dir), ['key'])
+
+  def test_invalidate_then_put(self):
+    cache = DiskCache(self.dir, 10 ** 6)
+    cache.put('key', self.build('first'))
+    cache.invalidate('key')
+    self.assertIsNone(cache.get('key'))
+    self.assertEqual(self.read(cache.put('key', self.build('second'))), 'second')
+    self.assertEqual(os.listdir(self.dir), ['key'])
+
+  def test_concurrent_puts(self):
+    cache = DiskCache(self.dir, 10 ** 6)
+    entries = []
+    def put(i):
+      entries.append(cache.put('key', self.build('build %d' % i)))
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(len(entries), 8)
+    self.assertEqual(len(set(entries)), 1)
+    self.assertIn(self.read(entries[0]), ['build %d' % i for i in range(8)])
+    self.assertEqual(os.listdir(self.dir), ['key'])
+
+  def test_incomplete_entry_fails_put(self):
+    cache = DiskCache(self.dir, 10 ** 6)
+    os.makedirs(self.dir + 'key/partial')
+    with self.assertRaises(OSError):
+      cache.put('key', self.build('data'))
+    self.assertEqual(os.listdir(self.dir), ['key'])
+
+  def test_failed_build_leaves_nothing(self):
+    cache = DiskCache(self.dir, 10 ** 6)
+    def build(directory):
+      raise IOError('build failed')
+    with self.assertRaises(IOError):
+      cache.put('key', build)
+    self.assertEqual(os.listdir(self.dir), [])
+
+  def test_eviction(self):
+    cache = DiskCache(self.dir, 15)
+    cache.put('a', self.build('x' * 10))
+    os.utime(self.dir + 'a', (1, 1))
+    cache.put('b', self.build('x' * 10))
+    self.assertIsNone(cache.get('a'))
+    self.assertIsNotNone(cache.get('b'))
+
+
+class MergeTest(TempDirTest):
+
+  SCHEMA = 'CREATE TABLE Output_VFlow_Out (scenario TEXT, tech TEXT, vflow_out REAL)'
+
+  def database(self, name, rows, schema=SCHEMA):
+    path = self.dir + name
+    con = sqlite3.connect(path)
+    con.execute(schema)
+    con.executemany('INSERT INTO Output_VFlow_Out (scenario, tech, vflow_out) VALUES (?, ?, ?)', rows)
+    con.commit()
+    con.close()
+    return path
+
+  def rows(self, path):
+    con = sqlite3.connect(path)
+    try:
+      return sorted(con.execute('SELECT scenario, tech, vflow_out FROM Output_VFlow_Out'))
+    finally:
+      con.close()
+
+  def test_replaces_rows_of_the_scenario(self):
+    target = self.database('shared.sqlite', [
+      ('a_b', 'E01', 1.0), ('a_b_mga_1', 'E01', 2.0), ('aXb_mga_1', 'E01', 3.0), ('other', 'E01', 4.0)])
+    scratch = self.database('scratch.sqlite', [
+      ('a_b', 'E01', 10.0), ('a_b', 'E21', 11.0), ('a_b_mga_2', 'E01', 12.0), ('other', 'E01', 40.0)])
+
+    report = result_writer.merge(scratch, target, 'a_b')
+    self.assertIn('Wrote 3 result rows into 1 tables', report)
+    self.assertEqual(self.rows(target), [
+      (u'aXb_mga_1', u'E01', 3.0), (u'a_b', u'E01', 10.0), (u'a_b', u'E21', 11.0),
+      (u'a_b_mga_2', u'E01', 12.0), (u'other', u'E01', 4.0)])
+
+  def test_columns_and_tables_missing_in_target(self):
+    target = self.database('shared.sqlite', [])
+    scratch = self.database('scratch.sqlite', [('s', 'E01', 1.0)],
+      'CREATE TABLE Output_VFlow_Out (scenario TEXT, tech TEXT, vflow_out REAL, extra TEXT)')
+    con = sqlite3.connect(scratch)
+    con.execute('CREATE TABLE Output_New (scenario TEXT, value REAL)')
+    con.execute("INSERT INTO Output_New VALUES ('s', 1)")
+    con.commit()
+    con.close()
+
+    result_writer.merge(scratch, target, 's')
+    self.assertEqual(self.rows(target), [(u's', u'E01', 1.0)])
+
+  def test_other_names_of_the_content_are_not_modified(self):
+    target = self.database('shared.sqlite', [('s', 'E01', 1.0)])
+    os.link(target, self.dir + 'copy.sqlite')
+    scratch = self.database('scratch.sqlite', [('s', 'E01', 2.0)])
+
+    result_writer.merge(scratch, target, 's')
+    self.assertEqual(self.rows(target), [(u's', u'E01', 2.0)])
+    self.assertEqual(self.rows(self.dir + 'copy.sqlite'), [(u's', u'E01', 1.0)])
+
+
+def _rewrite_and_update(path, data):
+  with open(path, 'w') as f:
+    f.write(data)
+  file_catalog.update(os.path.basename(path), hashlib.sha1(data).hexdigest())
+
+
+class FileCatalogTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.override = override_settings(UPLOADED_DIR=self.dir)
+    self.override.enable()
+    with open(self.dir + 'a.sqlite', 'w') as f:
+      f.write('abc')
+
+  def tearDown(self):
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def entry(self, name):
+    return [e for e in file_catalog.get_catalog()['files'] if e['name'] == name][0]
+
+  def test_update_in_another_process_is_seen(self):
+    self.assertEqual(self.entry('a.sqlite')['size'], 3)
+    before = file_catalog.version()
+
+    #overwriting leaves the directory mtime as is
+    child = multiprocessing.Process(target=_rewrite_and_update, args=(self.dir + 'a.sqlite', 'abcdef'))
+    child.start()
+    child.join()
+    self.assertEqual(child.exitcode, 0)
+
+    self.assertEqual(self.entry('a.sqlite')['size'], 6)
+    self.assertEqual(self.entry('a.sqlite')['hash'], hashlib.sha1('abcdef').hexdigest())
+    self.assertNotEqual(file_catalog.version(), before)
+
+  def test_content_hash_comes_from_the_catalog(self):
+    file_catalog.update('a.sqlite', 'recorded')
+    self.assertEqual(file_catalog.content_hash('a.sqlite'), 'recorded')
+
+    os.utime(self.dir + 'a.sqlite', (1, 1))
+    self.assertEqual(file_catalog.content_hash('a.sqlite'), hashlib.sha1('abc').hexdigest())
+
+  def test_plot_key(self):
+    file_catalog.update('a.sqlite', 'recorded')
+    key = plot_cache.plot_key(self.dir + 'a.sqlite', 'base', 1, 'all', False)
+    self.assertEqual(key, hashlib.sha1(json.dumps(['recorded', 'base', 1, 'all', 'False'])).hexdigest())
+    self.assertNotEqual(plot_cache.plot_key(self.dir + 'a.sqlite', 'base', 2, 'all', False), key)
+
+    shutil.copy(self.dir + 'a.sqlite', self.dir + 'b.db')
+    self.assertEqual(plot_cache.plot_key(self.dir + 'b.db', 'base', 1, 'all', False),
+      hashlib.sha1(json.dumps([hashlib.sha1('abc').hexdigest(), 'base', 1, 'all', 'False'])).hexdigest())
+
+  def test_listing(self):
+    for name in ('B.sqlite', 'b2.dat', 'c.sqlite', 'notes.txt'):
+      with open(self.dir + name, 'w') as f:
+        f.write(name)
+
+    files, total = file_catalog.listing('input', 'b')
+    self.assertEqual(([e['name'] for e in files], total), (['B.sqlite', 'b2.dat'], 2))
+    files, total = file_catalog.listing('output', '', page=2, per_page=2)
+    self.assertEqual(([e['name'] for e in files], total), (['c.sqlite'], 3))
+    self.assertEqual((files[0]['size'], files[0]['type']), (8, 'sqlite'))
+
+  def test_unchanged_listing_is_not_modified(self):
+    with self.settings(METRICS_DIR=self.dir + '.metrics/'):
+      response = self.client.get(reverse('loadfilelist') + '?mode=input')
+      self.assertEqual(response.json()['data'], ['a.sqlite'])
+      etag = response['ETag']
+      self.assertEqual(self.client.get(reverse('loadfilelist') + '?mode=input', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+      with open(self.dir + 'a.sqlite', 'w') as f:
+        f.write('abcdef')
+      file_catalog.update('a.sqlite')
+      self.assertEqual(self.client.get(reverse('loadfilelist') + '?mode=input', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+  def test_fill_hashes(self):
+    self.assertFalse(self.entry('a.sqlite')['hash'])
+    self.assertEqual(file_catalog.fill_hashes(), 1)
+    self.assertEqual(self.entry('a.sqlite')['hash'], hashlib.sha1('abc').hexdigest())
+    self.assertEqual(file_catalog.fill_hashes(), 0)
+
+
+class NetworkViewTest(TempDirTest):
+  """
+  A chain ethos -> IMP -> oil -> REF -> gas -> PLANT -> elc
+  """
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    names = ['c:ethos', 't:IMP', 'c:oil', 't:REF', 'c:gas', 't:PLANT', 'c:elc']
+    self.graph = {
+      'nodes' : dict((n, { 'kind' : 'tech' if n[0] == 't' else 'comm', 'name' : n[2:], 'sector' : 'supply', 'degree' : 2 })
+        for n in names),
+      'edges' : [[a, b] for a, b in zip(names, names[1:])],
+    }
+
+  def test_neighborhood(self):
+    self.assertEqual(sorted(network.neighborhood(self.graph, 'REF', 1)['nodes']), ['c:gas', 'c:oil', 't:REF'])
+    self.assertEqual(len(network.neighborhood(self.graph, 'REF', 100)['nodes']), 7)
+    self.assertRaises(ValueError, network.neighborhood, self.graph, 'nothing', 1)
+
+  @override_settings(NETWORK_MAX_HOPS=2)
+  def test_hops_are_clamped(self):
+    self.assertEqual(len(network.neighborhood(self.graph, 'ethos', 10 ** 9)['nodes']), 3)
+
+  def test_budget_merges_nodes_per_sector(self):
+    graph = network.apply_budget(self.graph, 1, keep=['t:REF'])
+    self.assertEqual(sorted(graph['nodes']), ['g:supply', 't:REF'])
+    self.assertEqual(graph['nodes']['g:supply']['members'], 6)
+    self.assertEqual(graph['edges'], [('g:supply', 't:REF'), ('t:REF', 'g:supply')])
+
+  def test_unknown_format_is_rejected(self):
+    self.assertRaises(ValueError, network.render, 'a.sqlite', 'full', format='x; rm -rf /')
+
+  def test_view_reports_bad_parameters(self):
+    with self.settings(METRICS_DIR=self.dir + 'metrics/'):
+      response = self.client.post(reverse('networkgraph'), { 'datafile' : 'a.sqlite', 'view' : 'full', 'format' : 'exe' })
+      self.assertIn('Unknown format', response.json()['error'])
+      response = self.client.post(reverse('networkgraph'), { 'datafile' : 'a.sqlite', 'hops' : 'many' })
+      self.assertIn('invalid literal', response.json()['error'])
+
+
+class DiagramCacheTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.override = override_settings(UPLOADED_DIR=self.dir + 'files/', RESULT_DIR=self.dir + 'result/')
+    self.override.enable()
+    diagram_cache.caches.clear()
+    os.makedirs(self.dir + 'files/')
+    self.write('a.sqlite', 'abc')
+
+  def tearDown(self):
+    diagram_cache.caches.clear()
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def write(self, name, data):
+    with open(self.dir + 'files/' + name, 'w') as f:
+      f.write(data)
+    file_catalog.update(name, hashlib.sha1(data).hexdigest())
+
+  def key(self, period=2010):
+    return diagram_cache.diagram_key('a.sqlite', 'base', 'input', 'tech', 'E01', period, 'svg', 'color')
+
+  def render(self):
+    folder = self.dir + 'rendered/'
+    os.makedirs(folder + 'images/')
+    with open(folder + 'images/a.svg', 'w') as f:
+      f.write('<svg/>')
+    return folder, folder + 'images/a.svg'
+
+  def test_key_follows_content_and_options(self):
+    key = self.key()
+    self.assertTrue(key.startswith('a.sqlite-'))
+    self.assertEqual(self.key(), key)
+    self.assertNotEqual(self.key(2020), key)
+    self.write('a.sqlite', 'abd')
+    self.assertNotEqual(self.key(), key)
+
+  def test_store_and_lookup(self):
+    self.assertIsNone(diagram_cache.lookup('input', self.key()))
+    stored = diagram_cache.store('input', self.key(), *self.render())
+    self.assertEqual(diagram_cache.lookup('input', self.key()), stored)
+    self.assertEqual(stored[0].split('/')[-2:], ['images', 'a.svg'])
+    with open(self.dir + 'result/input/' + stored[0]) as f:
+      self.assertEqual(f.read(), '<svg/>')
+
+  def test_invalidate_file(self):
+    diagram_cache.store('input', self.key(), *self.render())
+    diagram_cache.invalidate_file('a.sqlite')
+    self.assertIsNone(diagram_cache.lookup('input', self.key()))
+
+  def test_unknown_mode(self):
+    self.assertRaises(ValueError, diagram_cache.get_cache, '../input')
+
+
+class PlotDataTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.override = override_settings(UPLOADED_DIR=self.dir, METRICS_DIR=self.dir + 'metrics/')
+    self.override.enable()
+    con = sqlite3.connect(self.dir + 'out.sqlite')
+    con.execute('CREATE TABLE technologies (tech TEXT, tech_category TEXT)')
+    con.execute('CREATE TABLE Output_CapacityByPeriodAndTech (scenario TEXT, sector TEXT, t_periods INTEGER, tech TEXT, capacity REAL)')
+    con.executemany('INSERT INTO technologies VALUES (?, ?)', [('E01', 'coal'), ('E21', 'nuclear'), ('E31', '')])
+    con.executemany('INSERT INTO Output_CapacityByPeriodAndTech VALUES (?, ?, ?, ?, ?)', [
+      ('base', 'electric', 2010, 'E01', 1.0), ('base', 'electric', 2020, 'E01', 2.0),
+      ('base', 'electric', 2020, 'E21', 3.0), ('base', 'supply', 2020, 'E31', 4.0), ('other', 'electric', 2010, 'E01', 9.0)])
+    con.commit()
+    con.close()
+    file_catalog.update('out.sqlite', 'recorded')
+
+  def tearDown(self):
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def test_etag_uses_the_catalog_hash(self):
+    etag = hashlib.sha1('recorded' + 'filename=out.sqlite').hexdigest()
+    response = self.client.get(reverse('plotdata') + '?filename=out.sqlite', HTTP_IF_NONE_MATCH='"%s"' % etag)
+    self.assertEqual(response.status_code, 304)
+
+  @unittest.skipUnless(_importable('pandas'), 'pandas is not installed')
+  def test_series(self):
+    path = self.dir + 'out.sqlite'
+    self.assertEqual(analytics.series(path, 'base', 1, 'electric'), { 'series' : 'capacity', 'sector' : 'electric',
+      'periods' : [2010, 2020], 'names' : [u'E01', u'E21'], 'values' : [[1.0, 2.0], [0.0, 3.0]] })
+    merged = analytics.series(path, 'base', 1, 'all', supercategories=True)
+    self.assertEqual(merged['names'], [u'E31', u'coal', u'nuclear'])
+    self.assertEqual(analytics.series(path, 'base', 1, 'transport')['values'], [])
+    self.assertRaises(ValueError, analytics.series, path, 'base', 7)
+
+
+def _running(pid):
+  try:
+    with open('/proc/%d/stat' % pid) as f:
+      return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+  except IOError:
+    return False
+
+
+class RenderPeriodsTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.render = diagrams.render
+
+  def tearDown(self):
+    diagrams.render = self.render
+    TempDirTest.tearDown(self)
+
+  def test_manifest_per_period(self):
+    def render(filename, scenario, mode, type, value, period, format, colorscheme, outDir=None):
+      return { "filename" : '', "zip_path" : '', "folder" : '', "error" : 'no diagram for ' + period }
+    diagrams.render = render
+
+    manifest, zip_path = diagrams.render_periods('a.sqlite', 'base', 'technology', 'E01', [2010, 2020], 'svg', 'color')
+    self.assertEqual([(r['period'], r['error']) for r in manifest], [(2010, 'no diagram for 2010'), (2020, 'no diagram for 2020')])
+    self.assertEqual(zip_path, '')
+
+  @override_settings(DIAGRAM_TIMEOUT=1)
+  def test_timeout_kills_dot(self):
+    pids = self.dir + 'pids'
+    def render(filename, scenario, mode, type, value, period, format, colorscheme, outDir=None):
+      dot = subprocess.Popen(['sleep', '60'])
+      with open(pids, 'a') as f:
+        f.write('%d\n' % dot.pid)
+      dot.wait()
+    diagrams.render = render
+
+    manifest, zip_path = diagrams.render_periods('a.sqlite', 'base', 'technology', 'E01', [2010, 2020], 'svg', 'color')
+    self.assertEqual([r['error'] for r in manifest], ['Rendering the diagram took too long'] * 2)
+
+    with open(pids) as f:
+      started = [int(line) for line in f]
+    self.assertEqual(len(started), 2)
+    time.sleep(0.5)
+    self.assertEqual([pid for pid in started if _running(pid)], [])
+
+
+def _pipeline(post, result, run_id=None):
+  yield 'Reading data files.\n'
+  yield 'Solving.\n'
+  if post.get('fail'):
+    raise ValueError('infeasible')
+  result['zip_path'] = 'result.zip'
+
+
+class JobsTest(TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp() + '/'
+    self.override = override_settings(RUN_LOG_DIR=self.dir + 'runs/', METRICS_DIR=self.dir + 'metrics/',
+      JOB_ADMISSION_LOCK=self.dir + 'admission.lock', JOB_MAX_RUNNING=1)
+    self.override.enable()
+    self.pipeline = jobs.run_pipeline
+    jobs.run_pipeline = _pipeline
+
+  def tearDown(self):
+    jobs.run_pipeline = self.pipeline
+    self.override.disable()
+    shutil.rmtree(self.dir)
+
+  def post(self, **extra):
+    post = { 'inputdatafilename' : 'in.sqlite', 'outputdatafilename' : 'out.sqlite', 'scenarioname' : 'base' }
+    post.update(extra)
+    return post
+
+  def test_submit(self):
+    run = jobs.submit(self.post(), batch='b1', owner='alice')
+    self.assertEqual((run.status, run.batch, run.owner, run.scenario), (ModelRun.QUEUED, 'b1', 'alice', 'base'))
+    self.assertEqual(json.loads(run.options)['inputdatafilename'], 'in.sqlite')
+    self.assertEqual(run.log_path, self.dir + 'runs/' + run.run_id + '.log')
+    self.assertEqual(jobs.get_run(run.run_id), run)
+    self.assertIsNone(jobs.get_run('missing'))
+    self.assertEqual(jobs.queue_state(run)['position'], 1)
+
+  def test_start_only_with_room(self):
+    run = jobs.start(self.post())
+    self.assertEqual(run.status, ModelRun.RUNNING)
+    self.assertIsNotNone(run.started)
+    self.assertEqual(jobs.queue_state(run), {})
+    self.assertIsNone(jobs.start(self.post()))
+
+  def test_execute(self):
+    run = jobs.submit(self.post())
+    jobs.execute(run.run_id)
+    run = jobs.get_run(run.run_id)
+    self.assertEqual((run.status, run.zip_path), (ModelRun.DONE, 'result.zip'))
+    self.assertEqual([p['phase'] for p in json.loads(run.timings)['phases']], ['read_data', 'solve'])
+    self.assertEqual(jobs.read_output(run), ('Reading data files.\nSolving.\n', 29))
+    self.assertEqual(jobs.read_output(run, 20), ('Solving.\n', 29))
+
+  def test_failed_run(self):
+    run = jobs.submit(self.post(fail='1'))
+    events = list(jobs.run_events(run))
+    self.assertEqual(events[-1]['error'], 'infeasible')
+    run = jobs.get_run(run.run_id)
+    self.assertEqual((run.status, run.error), (ModelRun.FAILED, 'infeasible'))
+    self.assertIn('ValueError: infeasible', jobs.read_output(run)[0])
+
+  def test_reset_orphans(self):
+    host = socket.gethostname()
+    for run_id, runner in (('gone', '%s:%d' % (host, 2 ** 22 + 1)), ('alive', jobs.runner_id()), ('request', '')):
+      ModelRun.objects.create(run_id=run_id, runner=runner, status=ModelRun.RUNNING,
+        inputfilename='in.sqlite', scenario='s', options='{}')
+
+    jobs.reset_orphans()
+    self.assertEqual(dict(ModelRun.objects.values_list('run_id', 'status')),
+      { 'gone' : ModelRun.FAILED, 'alive' : ModelRun.RUNNING, 'request' : ModelRun.RUNNING })
+
+
+class FileIndexTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.override = override_settings(UPLOADED_DIR=self.dir)
+    self.override.enable()
+    with open(self.dir + 'utopia.dat', 'w') as f:
+      f.write(UTOPIA_DAT)
+
+  def tearDown(self):
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def test_dat_index(self):
+    index = file_index.build_index('utopia.dat')
+    self.assertEqual(index['hash'], hashlib.sha1(UTOPIA_DAT).hexdigest())
+    self.assertEqual(index['lists']['technology'], dict((t, t) for t in ['E01', 'E21', 'IMPDSL1', 'IMPGSL1', 'RHO', 'nan']))
+    self.assertEqual(sorted(index['errors']), ['period', 'scenario'])
+
+    self.assertEqual(file_index.get_list('utopia.dat', 'commodity'), index['lists']['commodity'])
+    with self.assertRaises(ValueError):
+      file_index.get_list('utopia.dat', 'scenario')
+
+  def test_stale_index_is_rebuilt(self):
+    file_index.build_index('utopia.dat')
+    self.assertIsNotNone(file_index.get_index('utopia.dat'))
+
+    with open(self.dir + 'utopia.dat', 'w') as f:
+      f.write(UTOPIA_DAT.replace('RHO', 'RHO2'))
+    self.assertIsNone(file_index.get_index('utopia.dat'))
+    self.assertIn('RHO2', file_index.get_list('utopia.dat', 'technology'))
+
+    file_index.remove_index('utopia.dat')
+    self.assertFalse(os.path.exists(file_index.index_path('utopia.dat')))
+
+  def test_row_counts(self):
+    con = sqlite3.connect(self.dir + 'a.sqlite')
+    con.execute('CREATE TABLE technologies (tech TEXT)')
+    con.executemany('INSERT INTO technologies VALUES (?)', [('E01',), ('E21',)])
+    con.execute('CREATE TABLE "odd ""name" (x)')
+    con.commit()
+    con.close()
+
+    index = file_index.build_index('a.sqlite')
+    self.assertEqual(index['row_counts'], { 'technologies' : 2, 'odd "name' : 0 })
+
+
+class MgaProgressTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.db = self.dir + 'out.sqlite'
+    con = sqlite3.connect(self.db)
+    con.execute('CREATE TABLE Output_Objective (scenario TEXT, objective_name TEXT, objective_value REAL)')
+    #an earlier run of the same scenario
+    con.execute("INSERT INTO Output_Objective VALUES ('base_mga_1', 'obj', 1.0)")
+    con.commit()
+    con.close()
+    self.values = { '--output' : self.db, '--scenario' : 'base', '--mga' : '{\n  slack=0.1\n  iteration=2\n  weight=integer\n}' }
+
+  def write(self, scenario, value):
+    con = sqlite3.connect(self.db)
+    con.execute("INSERT INTO Output_Objective VALUES (?, 'obj', ?)", (scenario, value))
+    con.commit()
+    con.close()
+
+  def lines(self):
+    yield 'Solving.\n'
+    self.write('base', 10.0)
+    self.write('base_mga_1', 11.0)
+    self.write('other_mga_1', 99.0)
+    yield 'Solving.\n'
+    self.write('base_mga_2', 12.0)
+    yield 'Done.\n'
+
+  @override_settings(MGA_PROGRESS_INTERVAL=0)
+  def test_a_line_per_iteration(self):
+    self.assertEqual(mga.mga_iterations(self.values), 2)
+    self.assertEqual(list(mga.progress(self.values, self.lines())), [
+      'Solving.\n', 'Solving.\n', 'MGA iteration 1 of 2 finished, objective 11.0\n',
+      'Done.\n', 'MGA iteration 2 of 2 finished, objective 12.0\n'])
+
+  def test_without_output_database(self):
+    values = dict(self.values, **{ '--output' : self.dir + 'missing/out.sqlite' })
+    self.assertEqual(list(mga.progress(values, iter(['a', 'b']))), ['a', 'b'])
+
+
+class BatchTest(TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp() + '/'
+    self.override = override_settings(RUN_LOG_DIR=self.dir + 'runs/', UPLOADED_DIR=self.dir, RESULT_DIR=self.dir + 'result/')
+    self.override.enable()
+    self.post = { 'inputdatafilename' : 'in.sqlite', 'outputdatafilename' : '0', 'scenarioname' : 'base', 'solver' : 'glpk' }
+
+  def tearDown(self):
+    self.override.disable()
+    shutil.rmtree(self.dir)
+
+  def test_expand(self):
+    variants = batch.expand(dict(self.post, variants='[{"solver" : "cplex"}, {}]', grid='{"solver" : ["cbc"], "x" : [1, 2]}'))
+    self.assertEqual([(v['scenarioname'], v['solver'], v.get('x')) for v in variants], [
+      ('base', 'cplex', None), ('base_2', 'glpk', None), ('base_3', 'cbc', u'1'), ('base_4', 'cbc', u'2')])
+    self.assertNotIn('grid', variants[0])
+    self.assertEqual(batch.expand(self.post), [self.post])
+
+  def test_malformed_sweeps(self):
+    for sweep in ({ 'variants' : '{}' }, { 'variants' : '[1]' }, { 'grid' : '{"x" : 1}' }, { 'variants' : '[{"x" : [1]}]' }):
+      with self.assertRaises(ValueError):
+        batch.expand(dict(self.post, **sweep))
+
+  def test_summary(self):
+    batch_id, runs = batch.submit(dict(self.post, grid='{"solver" : ["glpk", "cbc"]}'), owner='alice')
+    self.assertEqual([run.batch for run in batch.get_runs(batch_id)], [batch_id] * 2)
+    self.assertIsNone(batch.combined_zip(batch_id))
+
+    with open(runs[0].log_path, 'w') as f:
+      f.write('Objective: 12.5\nObjective value: 10.25\n')
+    ModelRun.objects.filter(pk=runs[0].pk).update(status=ModelRun.DONE)
+    ModelRun.objects.filter(pk=runs[1].pk).update(status=ModelRun.FAILED, error='infeasible')
+
+    summary = batch.summary(batch_id)
+    self.assertEqual([(v['scenario'], v['status'], v['objective'], v['error']) for v in summary], [
+      ('base', ModelRun.DONE, 10.25, ''), ('base_2', ModelRun.FAILED, None, 'infeasible')])
+    #no result folder was written
+    self.assertIsNone(batch.combined_zip(batch_id))
+
+
+class DbPoolTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.override = override_settings(UPLOADED_DIR=self.dir + 'files/', SQLITE_POOL_SIZE=2)
+    self.override.enable()
+    os.makedirs(self.dir + 'files/')
+    dbpool.reset()
+    for name in ('a', 'b', 'c'):
+      self.database(name)
+
+  def tearDown(self):
+    for version, con in dbpool._connections.values():
+      con.close()
+    dbpool.reset()
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def database(self, name, rows=1):
+    con = sqlite3.connect(self.dir + 'files/%s.sqlite' % name)
+    con.execute('CREATE TABLE IF NOT EXISTS t (x)')
+    con.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(rows)])
+    con.commit()
+    con.close()
+    return self.dir + 'files/%s.sqlite' % name
+
+  def count(self, path):
+    return dbpool.connect(path).execute('SELECT COUNT(*) FROM t').fetchone()[0]
+
+  def test_shared_read_only_connection(self):
+    path = self.dir + 'files/a.sqlite'
+    first = dbpool.connect(path)
+    first.close()
+    self.assertIs(dbpool.connect(path)._con, first._con)
+    with self.assertRaises(sqlite3.OperationalError):
+      first.execute('INSERT INTO t VALUES (2)')
+
+  def test_reopened_when_the_file_changes(self):
+    path = self.dir + 'files/a.sqlite'
+    self.assertEqual(self.count(path), 1)
+    invalidations = dbpool.stats()['invalidations']
+    self.database('a', 2)
+    #within the same mtime tick the size may not change either
+    os.utime(path, (1, 1))
+    self.assertEqual(self.count(path), 3)
+    self.assertEqual(dbpool.stats()['invalidations'], invalidations + 1)
+
+  def test_least_recently_used_is_evicted(self):
+    for name in ('a', 'b', 'a', 'c'):
+      dbpool.connect(self.dir + 'files/%s.sqlite' % name)
+    self.assertEqual([os.path.basename(path) for path in dbpool._connections], ['a.sqlite', 'c.sqlite'])
+
+  def test_install(self):
+    module = type('Module', (object,), { 'sqlite3' : sqlite3 })()
+    dbpool.install(module)
+    self.assertIsInstance(module.sqlite3.connect(self.dir + 'files/a.sqlite'), dbpool.PooledConnection)
+    con = module.sqlite3.connect(self.dir + 'other.sqlite')
+    self.assertNotIsInstance(con, dbpool.PooledConnection)
+    con.close()
+    self.assertIs(module.sqlite3.Error, sqlite3.Error)
+
+
+class RunLogTest(TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp() + '/'
+    self.override = override_settings(RUN_LOG_DIR=self.dir + 'runs/', RESULT_DIR=self.dir, RUN_LOG_MAX_BYTES=10,
+      RUN_LOG_COMPRESS_AGE=100, RUN_LOG_MAX_AGE=1000)
+    self.override.enable()
+    os.makedirs(self.dir + 'runs/')
+    self.path = runlog.output_path('r1')
+
+  def tearDown(self):
+    self.override.disable()
+    shutil.rmtree(self.dir)
+
+  def read_all(self, offset=0):
+    data = ''
+    while True:
+      chunk, offset = runlog.tail(self.path, offset, 4)
+      if not chunk:
+        return data, offset
+      data += chunk
+
+  def test_tail_from_offset(self):
+    with open(self.path, 'w') as f:
+      f.write('abcdefgh')
+    self.assertEqual(runlog.tail(self.path), ('abcdefgh', 8))
+    self.assertEqual(runlog.tail(self.path, 3, 2), ('de', 5))
+    self.assertEqual(runlog.tail(self.path, 8), ('', 8))
+    self.assertEqual(runlog.tail(self.dir + 'runs/missing.log', 5), ('', 5))
+
+  def test_rotation_keeps_offsets(self):
+    with open(self.path, 'a') as log:
+      log.write('0123456789abc')
+      log.flush()
+      runlog.rotate(force=True)
+      self.assertEqual(os.path.getsize(self.path), 0)
+      self.assertEqual(self.read_all(), ('0123456789abc', 13))
+
+      #the writer goes on at the start of the emptied log
+      log.write('def')
+      log.flush()
+    self.assertEqual(runlog.tail(self.path, 13), ('def', 16))
+    self.assertEqual(self.read_all(), ('0123456789abcdef', 16))
+
+  def test_idle_logs_are_compressed_then_removed(self):
+    with open(self.path, 'w') as f:
+      f.write('done')
+    os.utime(self.path, (time.time() - 200, time.time() - 200))
+    runlog.rotate(force=True)
+    self.assertFalse(os.path.exists(self.path))
+    self.assertEqual(runlog.tail(self.path), ('done', 4))
+
+    os.utime(self.path + '.gz', (time.time() - 2000, time.time() - 2000))
+    runlog.rotate(force=True)
+    self.assertEqual(os.listdir(self.dir + 'runs/'), [])
+
+
+class ProgressTest(SimpleTestCase):
+
+  OUTPUT = [
+    'Reading data files.\n',
+    'Creating Temoa model instance.\n',
+    'Solving.\n',
+    'GLPK Simplex Optimizer\n 120 rows, 340 columns, 900 non-zeros\n',
+    'still solving\n',
+    'Formatting results.\n',
+  ]
+
+  def test_phase_events(self):
+    events = list(progress.events(self.OUTPUT))
+    self.assertEqual([(e['type'], e.get('phase')) for e in events if e['type'] != 'output'], [
+      ('phase_start', 'read_data'),
+      ('phase_end', 'read_data'), ('phase_start', 'build_instance'),
+      ('phase_end', 'build_instance'), ('phase_start', 'solve'),
+      ('model_size', None),
+      ('phase_end', 'solve'), ('phase_start', 'write_results'),
+      ('phase_end', 'write_results'), ('done', None)])
+    self.assertEqual([e['text'] for e in events if e['type'] == 'output'], self.OUTPUT)
+
+    timings = events[-1]['timings']
+    self.assertEqual([p['phase'] for p in timings['phases']], ['read_data', 'build_instance', 'solve', 'write_results'])
+    self.assertEqual(timings['model'], { 'constraints' : 120, 'variables' : 340 })
+    self.assertGreater(timings['peak_rss'], 0)
+    self.assertGreaterEqual(timings['startup'], 0)
+
+  def test_output_without_phases(self):
+    events = list(progress.events(['hello\n']))
+    self.assertEqual([e['type'] for e in events], ['output', 'done'])
+    self.assertIsNone(events[-1]['timings']['startup'])
+    self.assertIsNone(events[-1]['timings']['peak_rss'])
+
+  def test_stream_formats(self):
+    event = { 'type' : 'output', 'text' : 'a' }
+    self.assertEqual(json.loads(list(progress.ndjson([event]))[0]), event)
+    self.assertTrue(list(progress.sse([event]))[0].startswith('event: output\ndata: {'))
+
+  def test_solver_processes_are_sampled(self):
+    solver = subprocess.Popen(['sleep', '10'])
+    try:
+      time.sleep(0.1)
+      self.assertIn(solver.pid, procutils.descendants())
+      self.assertGreater(procutils.peak_rss(solver.pid), 0)
+    finally:
+      solver.kill()
+      solver.wait()
+    self.assertIsNone(procutils.peak_rss(solver.pid))
+
+  def test_summarize(self):
+    summary = progress.summarize([
+      { 'startup' : 1.0, 'phases' : [{ 'phase' : 'solve', 'duration' : 10.0 }] },
+      { 'startup' : None, 'phases' : [{ 'phase' : 'solve', 'duration' : 20.0 }] },
+    ])
+    self.assertEqual(summary['solve'], { 'runs' : 2, 'total' : 30.0, 'max' : 20.0, 'mean' : 15.0 })
+    self.assertEqual(summary['startup']['runs'], 1)
+
+
+class MetricsTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.override = override_settings(METRICS_DIR=self.dir)
+    self.override.enable()
+    metrics.reset()
+
+  def tearDown(self):
+    metrics.reset()
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def lines(self, prefix):
+    return [line for line in metrics.render().splitlines() if line.startswith(prefix)]
+
+  def test_requests_are_counted(self):
+    self.client.get(reverse('metrics'))
+    text = self.client.get(reverse('metrics')).content
+    self.assertIn('dapp_requests_total{status="200",view="metrics"} 1', text)
+    self.assertIn('dapp_request_duration_seconds_count{view="metrics"} 1', text)
+    #the request being served
+    self.assertIn('dapp_requests_in_flight{pid="%d"} 1' % os.getpid(), text)
+
+  def test_histogram_buckets_are_cumulative(self):
+    metrics.observe('dapp_request_duration_seconds', { 'view' : 'v' }, 0.02)
+    metrics.observe('dapp_request_duration_seconds', { 'view' : 'v' }, 100)
+    lines = self.lines('dapp_request_duration_seconds')
+    self.assertIn('dapp_request_duration_seconds_bucket{view="v",le="0.005"} 0', lines)
+    self.assertIn('dapp_request_duration_seconds_bucket{view="v",le="0.025"} 1', lines)
+    self.assertIn('dapp_request_duration_seconds_bucket{view="v",le="60.0"} 1', lines)
+    self.assertIn('dapp_request_duration_seconds_bucket{view="v",le="+Inf"} 2', lines)
+    self.assertIn('dapp_request_duration_seconds_sum{view="v"} 100.02', lines)
+
+  def test_exited_processes_are_kept(self):
+    with open(self.dir + '%d-gone.json' % (2 ** 22 + 1), 'w') as f:
+      json.dump({ 'counters' : { 'dapp_model_runs_total' : { '[["status", "done"]]' : 2 } },
+        'gauges' : { 'dapp_solver_workers_busy' : { '[]' : 3 } } }, f)
+    metrics.record_run('done', 5)
+    metrics.record_error(ValueError(), 'upload')
+
+    for i in range(2):
+      self.assertEqual(self.lines('dapp_model_runs_total{'), ['dapp_model_runs_total{status="done"} 3'])
+    self.assertEqual(self.lines('dapp_solver_workers_busy'), [])
+    self.assertEqual(self.lines('dapp_errors_total{'), ['dapp_errors_total{exception="ValueError",view="upload"} 1'])
+    self.assertTrue(os.path.isfile(self.dir + metrics.RETIRED))
+
+
+class SolverPoolTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.override = override_settings(METRICS_DIR=self.dir + 'metrics/', JOB_MAX_RUNS_PER_WORKER=2, JOB_WORKER_MAX_RSS=None)
+    self.override.enable()
+    #Pyomo and Temoa are not needed to run a target
+    self.preload = solver_pool.preload
+    solver_pool.preload = lambda: None
+
+    def target(run_id, dispatched):
+      if run_id == 'crash':
+        os._exit(1)
+      with open(self.dir + 'runs', 'a') as f:
+        f.write(run_id + '\n')
+    self.pool = solver_pool.SolverPool(1, target)
+
+  def tearDown(self):
+    self.pool.close()
+    solver_pool.preload = self.preload
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def wait_idle(self):
+    lost = []
+    deadline = time.time() + 10
+    while not self.pool.idle() and time.time() < deadline:
+      lost += self.pool.poll()
+      time.sleep(0.05)
+    self.assertTrue(self.pool.idle())
+    return lost
+
+  def test_runs_and_recycling(self):
+    self.wait_idle()
+    first = self.pool.workers[0].process.pid
+    for run_id in ('r1', 'r2', 'r3'):
+      self.pool.dispatch(run_id)
+      self.assertEqual(self.pool.busy(), 1)
+      self.assertEqual(self.wait_idle(), [])
+
+    with open(self.dir + 'runs') as f:
+      self.assertEqual(f.read().split(), ['r1', 'r2', 'r3'])
+    #replaced after JOB_MAX_RUNS_PER_WORKER runs
+    self.assertEqual(self.pool.stats()['recycled'], 1)
+    self.assertNotEqual(self.pool.workers[0].process.pid, first)
+
+  def test_run_of_a_dead_worker_is_lost(self):
+    self.wait_idle()
+    self.pool.dispatch('crash')
+    self.assertEqual(self.wait_idle(), ['crash'])
+    self.assertEqual(len(self.pool.workers), 1)
+
+
+class ArtifactsTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.root = self.dir + 'runs/'
+    self.override = override_settings(ARTIFACT_DB=self.dir + 'artifacts.sqlite', ARTIFACT_MIN_AGE=0, ARTIFACT_USE_ATIME=False,
+      ARTIFACT_AREAS={ 'runs' : { 'path' : self.root, 'max_bytes' : 25, 'max_age' : 1000, 'exclude' : ['cache'] } })
+    self.override.enable()
+    os.makedirs(self.root + 'cache/')
+
+  def tearDown(self):
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def entry(self, name, age, size=10):
+    os.makedirs(self.root + name)
+    with open(self.root + name + '/out.zip', 'w') as f:
+      f.write('x' * size)
+    then = time.time() - age
+    os.utime(self.root + name, (then, then))
+
+  def test_least_recently_used_over_quota(self):
+    self.entry('a', 300)
+    self.entry('b', 200)
+    self.entry('c', 100)
+    artifacts.touch(self.root + 'a/out.zip')
+
+    self.assertEqual(artifacts.sweep(force=True), { 'runs' : (1, 10) })
+    self.assertEqual(sorted(os.listdir(self.root)), ['a', 'c', 'cache'])
+    stats = artifacts.stats()['runs']
+    self.assertEqual((stats['entries'], stats['bytes'], stats['reclaimed_entries'], stats['reclaimed_bytes']), (2, 20, 1, 10))
+
+  def test_expired_entries_and_dangling_links(self):
+    self.entry('old', 2000, 1)
+    self.entry('new', 10, 1)
+    os.symlink(self.root + 'old', self.root + 'latest')
+
+    artifacts.sweep(force=True)
+    self.assertEqual(sorted(os.listdir(self.root)), ['cache', 'latest', 'new'])
+    artifacts.sweep(force=True)
+    self.assertEqual(sorted(os.listdir(self.root)), ['cache', 'new'])
+
+  def test_entry_of(self):
+    self.entry('a', 0)
+    self.assertEqual(artifacts.entry_of(self.root + 'a/out.zip'), ('runs', os.path.realpath(self.root + 'a')))
+    self.assertEqual(artifacts.entry_of(self.root + 'cache/x'), (None, None))
+    self.assertEqual(artifacts.entry_of(self.dir + 'elsewhere'), (None, None))
+
+
+class SubsystemsTest(SimpleTestCase):
+
+  def setUp(self):
+    self.subsystems = subsystems.SUBSYSTEMS
+    self.loaded = subsystems._loaded.copy()
+    subsystems.SUBSYSTEMS = collections.OrderedDict([('json', 'json'), ('missing', 'dapp.no_such_module')])
+    subsystems._loaded.clear()
+
+  def tearDown(self):
+    subsystems.SUBSYSTEMS = self.subsystems
+    subsystems._loaded.clear()
+    subsystems._loaded.update(self.loaded)
+
+  def test_preload_reports_failures(self):
+    errors = subsystems.preload()
+    self.assertEqual(list(errors), ['missing'])
+    self.assertTrue(errors['missing'].startswith('ImportError'))
+
+    report = subsystems.report()
+    self.assertEqual((report['json']['loaded'], report['json']['preloaded']), (True, False))
+    self.assertEqual(report['missing'], { 'loaded' : False })
+    self.assertIs(subsystems.load('json'), json)
+
+  def test_views_import_no_subsystem(self):
+    script = ('import sys, django; django.setup(); import dapp.views; '
+      'print [m for m in %r if m in sys.modules]' % list(self.subsystems.values()))
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE='dproject.settings')
+    output = subprocess.check_output([sys.executable, '-c', script], env=env,
+      cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    self.assertEqual(output.strip(), '[]')
+
+
+class WorkspaceTest(TempDirTest):
+
+  def setUp(self):
+    TempDirTest.setUp(self)
+    self.override = override_settings(RUN_WORKSPACE_DIR=self.dir + 'workspaces/', RESULT_DIR=self.dir + 'result/',
+      UPLOADED_DIR=self.dir + 'files/')
+    self.override.enable()
+    os.makedirs(self.dir + 'files/')
+
+  def tearDown(self):
+    self.override.disable()
+    TempDirTest.tearDown(self)
+
+  def finished(self, run_id, text, folder='in_base_model'):
+    space = workspace.Workspace(run_id)
+    os.makedirs(space.run_folder(folder))
+    with open(os.path.join(space.run_folder(folder), 'result.txt'), 'w') as f:
+      f.write(text)
+    return space
+
+  def test_clone_input(self):
+    for name in ('in.dat', 'in.sqlite'):
+      with open(self.dir + 'files/' + name, 'w') as f:
+        f.write('data')
+    space = workspace.Workspace('r1')
+
+    target = space.clone_input(self.dir + 'files/in.dat')
+    self.assertEqual((target, space.clone), (self.dir + 'workspaces/r1/input/in.dat', 'link'))
+    self.assertTrue(os.path.samefile(target, self.dir + 'files/in.dat'))
+
+    target = space.clone_input(self.dir + 'files/in.sqlite')
+    self.assertIn(space.clone, ('reflink', 'copy'))
+    self.assertFalse(os.path.samefile(target, self.dir + 'files/in.sqlite'))
+    with open(target) as f:
+      self.assertEqual(f.read(), 'data')
+
+    space.remove()
+    self.assertFalse(os.path.exists(self.dir + 'workspaces/r1'))
+
+  def test_promote_switches_the_shared_name(self):
+    shared = self.dir + 'result/db_io/'
+    first, second = self.finished('r1', 'first'), self.finished('r2', 'second')
+
+    self.assertEqual(first.promote('in_base_model'), 'db_io/in_base_model@r1')
+    self.assertEqual(second.promote('in_base_model'), 'db_io/in_base_model@r2')
+    with open(shared + 'in_base_model/result.txt') as f:
+      self.assertEqual(f.read(), 'second')
+    #the earlier run keeps its own results
+    with open(shared + 'in_base_model@r1/result.txt') as f:
+      self.assertEqual(f.read(), 'first')
+    self.assertIsNone(self.finished('r3', '').promote('other_model'))
+
+  def test_promote_over_an_old_folder(self):
+    shared = self.dir + 'result/db_io/'
+    os.makedirs(shared + 'in_base_model')
+    self.finished('r1', 'new').promote('in_base_model')
+
+    self.assertTrue(os.path.islink(shared + 'in_base_model'))
+    self.assertEqual(len([n for n in os.listdir(shared) if n.startswith('in_base_model@') and n != 'in_base_model@r1']), 1)
@@ -0,0 +1,233 @@
+"""
+Uploads: the checks shared by every upload path and resumable chunked
+uploads. A chunked upload is started with init, sends its chunks in any
+order (each with its sha1), can ask which chunks arrived after a dropped
+connection and ends with finalize, which moves the data into the content
+store and links the file name to it.
+"""
+
+from django.conf import settings
+
+import fcntl
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from . import content_store
+from .fileutils import makedirs
+
+SUPPORTED_EXTENSIONS = ('.data', '.sqlite', '.dat')
+
+#upload_id -> (sha1 of the contiguous data received so far, bytes hashed)
+_hashers = {}
+
+
+class UploadError(Exception):
+  pass
+
+
+def prepare_target(name, overwrite):
+  """
+  Check an upload name and make room for it. Returns an error message, or
+  an empty string if the file can be written.
+  """
+  fname = settings.UPLOADED_DIR + name
+
+  filename, file_extension = os.path.splitext(name)
+
+  if file_extension not in SUPPORTED_EXTENSIONS or os.path.basename(name) != name:
+    return "Please select a valid file. Supported files are data and sqlite"
+
+  if(os.path.isfile(fname) ):
+
+    if int(overwrite) <> 0:
+      try:
+        os.remove(fname)
+      except OSError as e:
+        return "File already exists and failed to overwrite. Reason is {0}. Please try again.".format(e.strerror)
+    else:
+      return "File already exists. Please rename and try to upload."
+
+  return ""
+
+
+def _state_path(upload_id):
+  if not upload_id or not upload_id.isalnum():
+    raise UploadError("Unknown upload")
+  return settings.UPLOAD_PARTIAL_DIR + upload_id + '.json'
+
+
+def _data_path(upload_id):
+  return settings.UPLOAD_PARTIAL_DIR + upload_id + '.part'
+
+
+def _load(upload_id):
+  try:
+    with open(_state_path(upload_id)) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    raise UploadError("Unknown upload")
+
+
+def _save(state):
+  path = _state_path(state['upload_id'])
+  with open(path + '.tmp', 'w') as f:
+    json.dump(state, f)
+  os.rename(path + '.tmp', path)
+
+
+class _locked(object):
+  """
+  Serialize updates of one upload between workers
+  """
+
+  def __init__(self, upload_id):
+    self.path = _state_path(upload_id) + '.lock'
+
+  def __enter__(self):
+    self.f = open(self.path, 'a')
+    fcntl.flock(self.f, fcntl.LOCK_EX)
+
+  def __exit__(self, *args):
+    fcntl.flock(self.f, fcntl.LOCK_UN)
+    self.f.close()
+
+
+def purge_expired():
+  if not os.path.isdir(settings.UPLOAD_PARTIAL_DIR):
+    return
+
+  limit = time.time() - settings.UPLOAD_PARTIAL_MAX_AGE
+  for name in os.listdir(settings.UPLOAD_PARTIAL_DIR):
+    path = settings.UPLOAD_PARTIAL_DIR + name
+    try:
+      if os.path.getmtime(path) < limit:
+        os.remove(path)
+    except OSError:
+      pass
+
+  for upload_id in list(_hashers):
+    if not os.path.exists(_state_path(upload_id)):
+      _hashers.pop(upload_id, None)
+
+
+def init(name, size, mode, overwrite, chunk_size=None):
+  filename, file_extension = os.path.splitext(name)
+  if file_extension not in SUPPORTED_EXTENSIONS or os.path.basename(name) != name:
+    raise UploadError("Please select a valid file. Supported files are data and sqlite")
+  if os.path.isfile(settings.UPLOADED_DIR + name) and int(overwrite) == 0:
+    raise UploadError("File already exists. Please rename and try to upload.")
+
+  try:
+    size = int(size)
+    chunk_size = min(int(chunk_size or settings.UPLOAD_CHUNK_SIZE), settings.UPLOAD_CHUNK_SIZE)
+  except (TypeError, ValueError):
+    raise UploadError("The file and chunk sizes must be numbers")
+  if size < 0 or chunk_size < 1:
+    raise UploadError("Invalid file or chunk size")
+
+  makedirs(settings.UPLOAD_PARTIAL_DIR)
+  purge_expired()
+
+  state = {
+    "upload_id" : uuid.uuid4().hex,
+    "filename" : name,
+    "size" : size,
+    "chunk_size" : chunk_size,
+    "chunks" : (size + chunk_size - 1) // chunk_size,
+    "received" : [],
+    "mode" : mode,
+    "overwrite" : int(overwrite),
+  }
+
+  with open(_data_path(state['upload_id']), 'wb') as f:
+    f.truncate(state['size'])
+  _save(state)
+
+  return state
+
+
+def status(upload_id):
+  return _load(upload_id)
+
+
+def _hash_forward(state):
+  """
+  Extend the running hash over chunks received contiguously from its end
+  """
+  upload_id = state['upload_id']
+  sha, hashed = _hashers.get(upload_id, (hashlib.sha1(), 0))
+  received = set(state['received'])
+
+  with open(_data_path(upload_id), 'rb') as f:
+    while hashed < state['size'] and hashed // state['chunk_size'] in received:
+      f.seek(hashed)
+      data = f.read(min(state['chunk_size'], state['size'] - hashed))
+      sha.update(data)
+      hashed += len(data)
+
+  _hashers[upload_id] = (sha, hashed)
+  return sha, hashed
+
+
+def write_chunk(upload_id, index, checksum, data):
+  index = int(index)
+  if hashlib.sha1(data).hexdigest() != checksum:
+    raise UploadError("Checksum mismatch for chunk %d, please send it again" % index)
+
+  with _locked(upload_id):
+    state = _load(upload_id)
+    if index < 0 or index >= state['chunks']:
+      raise UploadError("Chunk %d out of range" % index)
+
+    offset = index * state['chunk_size']
+    expected = min(state['chunk_size'], state['size'] - offset)
+    if len(data) != expected:
+      raise UploadError("Chunk %d should be %d bytes" % (index, expected))
+
+    with open(_data_path(upload_id), 'r+b') as f:
+      f.seek(offset)
+      f.write(data)
+
+    if index not in state['received']:
+      state['received'].append(index)
+      _save(state)
+
+  _hash_forward(state)
+  return state
+
+
+def finalize(upload_id):
+  """
+  Store a complete upload and link its file name to it. Returns the state
+  with the content hash added.
+  """
+  with _locked(upload_id):
+    state = _load(upload_id)
+    missing = sorted(set(range(state['chunks'])) - set(state['received']))
+    if missing:
+      raise UploadError("Missing chunks: %s" % ', '.join(str(i) for i in missing[:20]))
+
+    sha, hashed = _hash_forward(state)
+    if hashed != state['size']:
+      raise UploadError("Upload data is incomplete")
+    digest = sha.hexdigest()
+
+    error = prepare_target(state['filename'], state['overwrite'])
+    if error:
+      raise UploadError(error)
+
+    content_store.store(_data_path(upload_id), digest, settings.UPLOADED_DIR + state['filename'])
+
+    os.remove(_state_path(upload_id))
+    _hashers.pop(upload_id, None)
+
+  try:
+    os.remove(_state_path(upload_id) + '.lock')
+  except OSError:
+    pass
+
+  state['hash'] = digest
+  return state
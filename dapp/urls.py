@@ -10,11 +10,34 @@ urlpatterns = [
     url(r'^modelrun$', views.modelRun, name='modelrun'),
     url(r'^about$', views.about, name='about'),
     url(r'^model$', views.runModel, name='model'),
+    url(r'^model/events$', views.runModelEvents, name='modelevents'),
+    url(r'^job/submit$', views.jobSubmit, name='jobsubmit'),
+    url(r'^job/status$', views.jobStatus, name='jobstatus'),
+    url(r'^job/output$', views.jobOutput, name='joboutput'),
+    url(r'^job/log$', views.jobLog, name='joblog'),
+    url(r'^job/timings$', views.jobTimings, name='jobtimings'),
+    url(r'^job/phases$', views.phaseStats, name='jobphases'),
+    url(r'^job/pool$', views.solverPoolStats, name='jobpool'),
+    url(r'^job/result$', views.jobResult, name='jobresult'),
+    url(r'^batch/submit$', views.batchSubmit, name='batchsubmit'),
+    url(r'^batch/summary$', views.batchSummary, name='batchsummary'),
     url(r'^fileupload$', views.fileUpload, name='fileupload'),
+    url(r'^upload/init$', views.uploadInit, name='uploadinit'),
+    url(r'^upload/chunk$', views.uploadChunk, name='uploadchunk'),
+    url(r'^upload/status$', views.uploadStatus, name='uploadstatus'),
+    url(r'^upload/finalize$', views.uploadFinalize, name='uploadfinalize'),
     url(r'^runinput$', views.runInput, name='runinput'),
+    url(r'^networkgraph$', views.networkGraph, name='networkgraph'),
+    url(r'^download$', views.download, name='download'),
+    url(r'^cachestats$', views.cacheStats, name='cachestats'),
+    url(r'^artifactstats$', views.artifactStats, name='artifactstats'),
+    url(r'^dbpoolstats$', views.dbPoolStats, name='dbpoolstats'),
+    url(r'^subsystems$', views.subsystemStats, name='subsystems'),
+    url(r'^metrics$', views.metricsView, name='metrics'),
     url(r'^loadfilelist$', views.loadFileList, name='loadfilelist'),
     url(r'^loadctlist$', views.loadCTList, name='loadctlist'),
     url(r'^dbquery/$', views.dbQuery, name='dbquery'),
     url(r'^generateplot$', views.generateplot, name='generateplot'),
+    url(r'^plotdata$', views.plotData, name='plotdata'),
     url(r'^loadsector$', views.loadsector, name='loadsector'),
 ]
@@ -6,8 +6,11 @@ from django.conf import settings
 from django import forms
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import condition
+from django.utils.cache import patch_cache_control
 
 #System
+import hashlib
+import itertools
 import json
 import os
 import re
@@ -21,12 +24,26 @@ from os import path
 
 #Custom / Thirdparty
 from thirdparty import test
-from thirdparty.temoa.data_processing.MakeGraphviz import GraphvizDiagramGenerator
-from handle_modelrun import run_model
-from thirdparty.temoa.temoa_model import get_comm_tech
+import jobs
+import batch
+import diagram_cache
+import result_cache
+import plot_cache
+import file_index
+import zipstream
+import uploads
+import content_store
+import dbpool
+import runlog
+import progress
+import metrics
+import file_catalog
+import analytics
+import diagrams
+import network
+import artifacts
+import subsystems
 
-from thirdparty.temoa.data_processing.db_query import get_flags
-from thirdparty.temoa.data_processing.MakeOutputPlots import OutputPlotGenerator
 
 def login(request):
   return render_to_response('login.html', context_instance=RequestContext(request))
@@ -49,77 +66,194 @@ def index(request):
 def about(request):
   return render_to_response('About-Us.html', context_instance=RequestContext(request))
 
-def _getLog():
-  originalLogFile = settings.RESULT_DIR +  "debug_logs/Complete_OutputLog.log"
-  archiveLogFile = settings.RESULT_DIR + "debug_logs/OutputLog__"+str(datetime.now().date()) + "__" +str(datetime.now().time())+".log"
+def runModel(request):
+  # resp = StreamingHttpResponse( generateStuff(request.POST.get("outputdatafilename")), content_type='text/html')
+  resp = StreamingHttpResponse( runModel2(request), content_type='text/html')
+  return resp
 
-  file = open(originalLogFile, 'r')
+  # return JsonResponse( {"result" : msg , "message" : msg } )
 
-  if not file:
-    return "Log not found or created"
+def _owner(request):
+  #runs are queued fairly between users, or browser sessions
+  if request.user.is_authenticated():
+    return 'user:%s' % request.user.pk
+  if not request.session.session_key:
+    request.session.save()
+  return 'session:' + request.session.session_key
 
-  output = file.read()
+def _busy():
+  return "Too many model runs are running. Please submit the run to the queue or try again later."
 
-  #Maintain archive of current log file
-  fileArch = open(archiveLogFile, "w")
-  fileArch.write(output)
+def runModel2(request):
+  run = jobs.start(request.POST, _owner(request))
+  if run is None:
+    return [_busy()]
+  return (event['text'] if event['type'] == 'output' else event['error']
+    for event in jobs.run_limited(run) if event['type'] in ('output', 'error'))
 
-  return output
+@csrf_exempt
+def runModelEvents(request):
+  """
+  Run the model inside this request like runModel, streaming typed progress
+  events as newline-delimited json, or as server-sent events for
+  format=sse / Accept: text/event-stream. Phase timings are stored with
+  the run.
+  """
+  if request.method != 'POST':
+    return HttpResponse("Use post method only", status = 403)
 
-def runModel(request):
-  # resp = StreamingHttpResponse( generateStuff(request.POST.get("outputdatafilename")), content_type='text/html')
-  resp = StreamingHttpResponse( runModel2(request), content_type='text/html')
+  run = jobs.start(request.POST, _owner(request))
+  if run is None:
+    return JsonResponse( { "error" : _busy() }, status = 503)
+  events = itertools.chain([{ "type" : "run", "run_id" : run.run_id }], jobs.run_limited(run))
+
+  if request.GET.get('format') == 'sse' or 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+    return StreamingHttpResponse( progress.sse(events), content_type='text/event-stream')
+  return StreamingHttpResponse( progress.ndjson(events), content_type='application/x-ndjson')
+
+
+@csrf_exempt
+def jobSubmit(request):
+  if request.method != 'POST':
+    return HttpResponse("Use post method only", status = 403)
+
+  run = jobs.submit(request.POST, owner=_owner(request))
+
+  return JsonResponse( dict(jobs.queue_state(run), run_id=run.run_id, status=run.status) )
+
+def _jobRun(request):
+  run = jobs.get_run(request.GET.get('run', ''))
+  if run is None:
+    return None, JsonResponse( { "error" : "Run not found" }, status = 404)
+  return run, None
+
+def jobStatus(request):
+  run, error = _jobRun(request)
+  if error:
+    return error
+
+  data = {
+          "run_id" : run.run_id,
+          "status" : run.status,
+          "scenario" : run.scenario,
+          "created" : run.created,
+          "started" : run.started,
+          "finished" : run.finished,
+          "error" : run.error
+          }
+  #queued runs also report their position, estimated_start and estimated_wait
+  data.update(jobs.queue_state(run))
+  return JsonResponse(data)
+
+def jobOutput(request):
+  run, error = _jobRun(request)
+  if error:
+    return error
+
+  offset = int(request.GET.get('offset', '0'))
+  data, offset = jobs.read_output(run, offset)
+
+  return JsonResponse( { "data" : data, "offset" : offset, "status" : run.status } )
+
+def jobTimings(request):
+  run, error = _jobRun(request)
+  if error:
+    return error
+
+  return JsonResponse( { "status" : run.status, "timings" : json.loads(run.timings or '{}') } )
+
+def solverPoolStats(request):
+  return JsonResponse(jobs.pool_stats())
+
+def phaseStats(request):
+  return JsonResponse( { "phases" : jobs.phase_stats(int(request.GET.get('limit', '100'))) } )
+
+def jobLog(request):
+  """
+  Temoa's debug log (Complete_OutputLog.log) of a run from byte offset
+  """
+  run, error = _jobRun(request)
+  if error:
+    return error
+
+  offset = int(request.GET.get('offset', '0'))
+  data, offset = runlog.tail(os.path.join(settings.RUN_LOG_DIR, run.run_id, runlog.DEBUG_LOG), offset)
+
+  return JsonResponse( { "data" : data, "offset" : offset, "status" : run.status } )
+
+def jobResult(request):
+  run, error = _jobRun(request)
+  if error:
+    return error
+
+  return JsonResponse( { "status" : run.status, "zip_path" : run.zip_path, "error" : run.error } )
+
+
+@csrf_exempt
+def batchSubmit(request):
+  if request.method != 'POST':
+    return HttpResponse("Use post method only", status = 403)
+
+  try:
+    batch_id, runs = batch.submit(request.POST, _owner(request))
+  except ValueError as e:
+    return JsonResponse( { "error" : "Invalid variants or grid: %s" % e }, status = 400)
+
+  return JsonResponse( { "batch_id" : batch_id, "run_ids" : [run.run_id for run in runs] } )
+
+def batchSummary(request):
+  batch_id = request.GET.get('batch', '')
+  variants = batch.summary(batch_id)
+  if not variants:
+    return JsonResponse( { "error" : "Batch not found" }, status = 404)
+
+  return JsonResponse( { "batch_id" : batch_id, "variants" : variants, "zip_path" : batch.combined_zip(batch_id) or '' } )
+
+
+def download(request):
+  """
+  Stream a zip of result files or folders (path, relative to result/) as
+  it is built. store=1 stores entries without compressing them.
+  """
+  relpaths = request.GET.getlist('path')
+  paths = [zipstream.resolve(relpath) for relpath in relpaths]
+  if not paths or None in paths:
+    return HttpResponse("File not found", status = 404)
+
+  roots = request.GET.getlist('root')
+  if len(roots) != len(paths):
+    roots = [os.path.basename(os.path.normpath(p)) for p in paths]
+
+  entries = itertools.chain(*[zipstream.walk(p, root) for p, root in zip(paths, roots)])
+  artifacts.touch(*paths)
+
+  name = request.GET.get('name') or os.path.basename(os.path.normpath(paths[0])) + '.zip'
+  store = request.GET.get('store', '') == '1'
+
+  resp = StreamingHttpResponse( zipstream.generate(entries, store), content_type='application/zip')
+  resp['Content-Disposition'] = 'attachment; filename="%s"' % name.replace('"', '')
   return resp
 
-  # return JsonResponse( {"result" : msg , "message" : msg } )
 
-def runModel2(request):
-  
-  msg = 'Successfully generated'
-  result = True
-  generatedfolderpath = ''
-  zip_path = ''
-  outputFilename = request.POST.get("outputdatafilename")
-  inputfilename =  request.POST.get("inputdatafilename")
-  scenario = request.POST.get("scenarioname")
-  
-  #try:
-    #This function will handle 
-    #TODO try catch handling
-  
-  generatedfolderpath =  settings.RESULT_DIR + "db_io/" + os.path.splitext(inputfilename)[0] + "_" + scenario + "_model"
+def artifactStats(request):
+  return JsonResponse(artifacts.stats())
 
-  if path.exists(generatedfolderpath):
-    shutil.rmtree(generatedfolderpath)
 
-  yield "<div>Starting Model Run \n"
-  for k in run_model(request):
-    yield k
+def subsystemStats(request):
+  return JsonResponse(subsystems.report())
+
+
+def metricsView(request):
+  return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
 
-  yield "Model Run Compelete</div>"
-  
-  #if not generatedfolderpath:
-  #  raise "Error detected"
-  zip_path = ""
-  
-  if outputFilename:
-    random = str(uuid.uuid4().get_hex().upper()[0:6])
-    output_dirname = 'db_io/db_io_' + random 
-    #print "Zipping: " + settings.BASE_DIR + "/" + generatedfolderpath + " | " + output_dirname
-    if path.exists(generatedfolderpath):
-      shutil.make_archive( settings.RESULT_DIR + output_dirname , 'zip', generatedfolderpath)
-    
-      zip_path = output_dirname + ".zip"
-      yield "*Zip file is at path {" + zip_path + "}"
-      
-    else:
-      yield "Failed to generate zip file"
-  
-  #except:
-  #  msg = 'An error occured. Please try again.'
-  #  result = False
-  
-    # return JsonResponse( {"result" : result , "message" : msg , 'zip_path' : zip_path, "output" : _getLog()  } )
+
+def dbPoolStats(request):
+  return JsonResponse(dbpool.stats())
+
+
+def cacheStats(request):
+  return JsonResponse( { "results" : result_cache.cache.stats(), "diagrams" : diagram_cache.stats(), "plots" : plot_cache.plots.stats(),
+    "network" : network.stats() } )
 
 
 #get posted data
@@ -137,49 +271,21 @@ def runInput(request):
   scenario =request.POST.get("scenario-name", "")
   dateRange =request.POST.get("date-range", "")
   
+  if mode not in diagram_cache.MODES:
+    return JsonResponse( { "error" : "Unknown mode %s" % mode, "filename" : '', "zip_path" : '', "folder" : '', "mode" : mode } )
+
+  if mode == 'output' and request.POST.get("periods", ""):
+    return _runInputPeriods(request, filename, scenario, type, value, format, colorscheme)
+
   error = ''
   imagepath = ''
   zip_file_path = ''
   try:
-    graphGen = GraphvizDiagramGenerator(dbFile=settings.UPLOADED_DIR+filename, scenario=scenario, outDir=settings.RESULT_DIR  + mode, verbose=1)
-    graphGen.connect()
-    graphGen.setGraphicOptions(greyFlag = (colorscheme == "grey"))
-
-    if (mode == "input"):
-      if (type == 'commodity'):
-        folderpath, imagepath = graphGen.createCompleteInputGraph(inp_comm=value, outputFormat=format)
-      elif (type == 'technology'):
-        folderpath, imagepath = graphGen.createCompleteInputGraph(inp_tech=value, outputFormat=format)
-      else:
-        folderpath, imagepath = graphGen.createCompleteInputGraph(outputFormat=format)
-    elif (mode == 'output'):
-      if (type == 'commodity' and (value != "")):
-        folderpath, imagepath = graphGen.CreateCommodityPartialResults(period = dateRange, comm=value, outputFormat=format)
-      elif (type == 'technology' and (value != "")):
-        folderpath, imagepath = graphGen.CreateTechResultsDiagrams(period = dateRange, tech=value, outputFormat=format)
-      else:
-        folderpath, imagepath = graphGen.CreateMainResultsDiagram(period = dateRange, outputFormat=format)
-
-    graphGen.close()
-
-    print "output_file_path = ", imagepath
-    if not path.exists(imagepath):
-      error = "The selected technology or commodity doesn't exist for selected period"
-    else:
-      if path.exists(folderpath) :
-        print "Zipping: " + folderpath
-        zip_file_path = folderpath+'_zip'
-
-        if (os.path.exists(zip_file_path+'.zip')):
-          os.remove(zip_file_path+'.zip')
-        shutil.make_archive((zip_file_path), 'zip', folderpath)
-        zip_file_path = os.path.relpath(zip_file_path+'.zip', settings.RESULT_DIR)
-        imagepath = os.path.relpath(imagepath, os.path.join(settings.RESULT_DIR, mode)) 
-      else:
-        error = "Folder is missing at " + folderpath
-
+    result = diagrams.render(filename, scenario, mode, type, value, dateRange, format, colorscheme)
+    error, imagepath, zip_file_path = result['error'], result['filename'], result['zip_path']
   except Exception as E:
     print E
+    metrics.record_error(E)
     error = 'An error occured. Please try again.'    
 
   return JsonResponse( 
@@ -190,8 +296,59 @@ def runInput(request):
           "folder" : '' ,
           "mode" : mode 
           } )
+
+def _runInputPeriods(request, filename, scenario, type, value, format, colorscheme):
+  """
+  Output diagrams of several periods: periods is a comma separated list
+  or all
+  """
+  periods = request.POST.get("periods", "")
+  manifest = []
+  zip_file_path = ''
+  error = ''
+  try:
+    if periods == 'all':
+      periods = diagrams.periods(filename, scenario)
+    else:
+      periods = [p.strip() for p in periods.split(',') if p.strip()]
+    manifest, zip_file_path = diagrams.render_periods(filename, scenario, type, value, periods, format, colorscheme)
+  except Exception as E:
+    print E
+    metrics.record_error(E)
+    error = 'An error occured. Please try again.'
+
+  return JsonResponse( { "error" : error, "manifest" : manifest, "zip_path" : zip_file_path, "mode" : 'output' } )
     
  
+def networkGraph(request):
+  """
+  Level of detail view of the input network: view is overview,
+  neighborhood (of center, within hops) or full, with at most budget nodes
+  """
+  if request.method != 'POST':
+    return HttpResponse("Use post method only", status = 403)
+
+  filename = request.POST.get("datafile", "")
+  view = request.POST.get("view", "overview")
+  center = request.POST.get("center", "")
+
+  result = {}
+  error = ''
+  try:
+    hops = min(int(request.POST.get("hops", "1")), settings.NETWORK_MAX_HOPS)
+    budget = max(int(request.POST.get("budget", settings.NETWORK_NODE_BUDGET)), 1)
+    result = network.render(filename, view, center, hops, budget,
+      request.POST.get("format", "svg"), request.POST.get("colorscheme", "color"))
+  except ValueError as E:
+    error = str(E)
+  except Exception as E:
+    print E
+    metrics.record_error(E)
+    error = 'An error occured. Please try again.'
+
+  result.update({ "error" : error, "mode" : 'input' })
+  return JsonResponse(result)
+
 def dbQuery(request):
 
   inputs = {}
@@ -199,7 +356,7 @@ def dbQuery(request):
   inputs["--query"] = request.POST['query']
   inputs["--input"] = request.POST['input']
 
-  result = get_flags(inputs)
+  result = subsystems.db_query().get_flags(inputs)
 
   return  JsonResponse( {"result" : result })
 
@@ -225,57 +382,107 @@ def fileUpload(request):
     return JsonResponse({'error': result}, status = 403)
 
 def handle_uploaded_file(f, mode, overwrite):
-  import os.path
-  
   
   fname = settings.UPLOADED_DIR  + f.name
   
-  
-  filename, file_extension = os.path.splitext(f.name)
-  #print(fname)
-  #print file_extension
-  
-  if file_extension != ".data" and file_extension != ".sqlite" and file_extension != ".dat" :
-    return "Please select a valid file. Supported files are data and sqlite"
-     
-  
-  if(os.path.isfile(fname) ):
-    
-    if int(overwrite) <> 0:
-      #print("isOverwrite 2", overwrite )
-      try:
-        os.remove(fname)
-      except OSError as e: # name the Exception `e`
-        #print "Failed with:", e.strerror # look what it says
-        #print "Error code:", e.code 
-        return "File already exists and failed to overwrite. Reason is {0}. Please try again.".format(e.strerror)
-    else: 
-      #print("isOverwrite 3", overwrite )
-      #print "Testing" + fname
-      return "File already exists. Please rename and try to upload."
+  error = uploads.prepare_target(f.name, overwrite)
+  if error:
+    return error
   
   with open(fname, 'wb+') as destination:
     for chunk in f.chunks():
       destination.write(chunk)
+
+  digest = content_store.add_file(fname)
+  _uploaded(f.name, digest)
   
   return "";
 
+def _uploaded(name, digest):
+  #drop what was derived from a previous file of this name
+  diagram_cache.invalidate_file(name)
+  file_catalog.update(name, digest)
+
+  try:
+    file_index.build_index(name)
+  except Exception as e:
+    #loadCTList rebuilds a missing index on first use
+    print "Indexing failed for " + name, e
+    file_index.remove_index(name)
+
+
+@csrf_exempt
+def uploadInit(request):
+  if request.method != 'POST':
+    return HttpResponse("Use post method only", status = 403)
+
+  try:
+    state = uploads.init(request.POST.get("filename", ""), request.POST.get("size", "0"),
+      request.POST.get("mode", "input"), request.POST.get("isOverwrite", 0), request.POST.get("chunksize"))
+  except (uploads.UploadError, ValueError) as e:
+    return JsonResponse({'error': str(e)}, status = 403)
+
+  return JsonResponse(state)
+
+@csrf_exempt
+def uploadChunk(request):
+  if request.method != 'POST':
+    return HttpResponse("Use post method only", status = 403)
+
+  try:
+    state = uploads.write_chunk(request.POST.get("upload", ""), request.POST.get("index", ""),
+      request.POST.get("checksum", ""), request.FILES['chunk'].read())
+  except (uploads.UploadError, ValueError, KeyError) as e:
+    return JsonResponse({'error': str(e)}, status = 400)
+
+  return JsonResponse({"upload_id" : state["upload_id"], "received" : len(state["received"]), "chunks" : state["chunks"]})
+
+def uploadStatus(request):
+  try:
+    state = uploads.status(request.GET.get("upload", ""))
+  except uploads.UploadError as e:
+    return JsonResponse({'error': str(e)}, status = 404)
+
+  return JsonResponse(state)
+
+@csrf_exempt
+def uploadFinalize(request):
+  if request.method != 'POST':
+    return HttpResponse("Use post method only", status = 403)
 
+  try:
+    state = uploads.finalize(request.POST.get("upload", ""))
+  except uploads.UploadError as e:
+    return JsonResponse({'error': str(e)}, status = 403)
+
+  _uploaded(state['filename'], state['hash'])
+
+  return JsonResponse( {"data" : loadFiles(state['mode']), 'mode' : state['mode'], 'hash' : state['hash'] })
+
+
+def _fileListEtag(request):
+  return hashlib.sha1(file_catalog.version() + request.GET.urlencode()).hexdigest()
+
+@condition(etag_func=_fileListEtag)
 def loadFileList(request):
   mode = request.GET.get('mode','input')
-  fileList = { "data" : loadFiles(mode) }
-  return JsonResponse(fileList)
+  prefix = request.GET.get('q', '')
+  try:
+    page = int(request.GET.get('page', '1'))
+    per_page = int(request.GET.get('per_page', '0'))
+  except ValueError:
+    return JsonResponse({'error': 'page and per_page must be numbers'}, status = 400)
+
+  files, total = file_catalog.listing(mode, prefix, page, per_page)
+  fileList = { "data" : [f['name'] for f in files], "files" : files, "total" : total, "page" : page, "per_page" : per_page }
+  response = JsonResponse(fileList)
+  #revalidate every time, unchanged listings are answered with 304
+  patch_cache_control(response, no_cache=True)
+  return response
 
 def loadFiles(mode):
-  #print mode
-  if (mode == 'input'):
-    types = ('.data', '.sqlite', '.sqlite3', '.dat') # the tuple of file types
-  else:
-    types = ('.sqlite', '.sqlite3') # the tuple of file types
-  
-  filelist = [each for each in os.listdir(settings.UPLOADED_DIR) if each.endswith(types)]
-
-  return sorted(filelist, key=lambda s: s.lower())
+  files, total = file_catalog.listing(mode)
+  return [f['name'] for f in files]
   
 def loadsector(request):
   filename = request.GET.get('filename')
@@ -286,9 +493,10 @@ def loadsector(request):
   sectors =[]
   error = ''
   try:
-    res = OutputPlotGenerator(db_path, scenario)
+    res = plot_cache.get_generator(db_path, scenario)
     sectors = res.getSectors(plottype)
-  except:
+  except Exception as e:
+    metrics.record_error(e)
     error = 'Database file not supported: ' +db_path
 
   return JsonResponse({"data" : sectors, "error": error})
@@ -302,19 +510,12 @@ def generateplot(request):
 
   db_path = settings.UPLOADED_DIR + filename
 
-  image_path_dir = settings.RESULT_DIR + 'matplot/'
-  res = OutputPlotGenerator(db_path, scenario)
-
-  plotpath = 'result/matplot/'
+  plotpath = 'result/'
   error = ""
   try:
-    if (plottype == 1):
-      plotpath += res.generatePlotForCapacity(sector, supercategories, image_path_dir)
-    elif (plottype == 2):
-      plotpath += res.generatePlotForOutputFlow(sector, supercategories, image_path_dir)
-    elif (plottype == 3):
-      plotpath += res.generatePlotForEmissions(sector, supercategories, image_path_dir)
+    plotpath += plot_cache.get_plot(db_path, scenario, plottype, sector, supercategories)
   except Exception as e:
+    metrics.record_error(e)
     plotpath = ""
     error = "An error occured. Please try again in some time."
   
@@ -322,6 +523,34 @@ def generateplot(request):
   return JsonResponse({"data" : plotpath, "error": error})
 
 
+def _plotDataEtag(request):
+  try:
+    digest = file_catalog.content_hash(request.GET.get('filename', ''))
+  except (OSError, IOError):
+    return None
+  return hashlib.sha1(digest + request.GET.urlencode()).hexdigest()
+
+@condition(etag_func=_plotDataEtag)
+def plotData(request):
+  filename = request.GET.get('filename', '')
+  scenario = request.GET.get('scenario', '')
+  plottype = int(request.GET.get('plottype', '1'))
+  sector = request.GET.get('sector', 'all')
+  supercategories = request.GET.get('merge-tech', '') not in ('', '0', 'false')
+
+  data = {}
+  error = ''
+  try:
+    data = analytics.series(settings.UPLOADED_DIR + filename, scenario, plottype, sector, supercategories)
+  except Exception as e:
+    metrics.record_error(e)
+    error = 'Database file not supported: ' + filename
+
+  response = JsonResponse({"data" : data, "error" : error})
+  patch_cache_control(response, no_cache=True)
+  return response
+
+
 def loadCTList(request):
   error = ''  
   data = {}
@@ -331,29 +560,16 @@ def loadCTList(request):
   listType = request.GET.get('type','')
   scenarioName = request.GET.get('scenario-name','')
   
-  input = {"--input" : settings.UPLOADED_DIR + filename}
-  
   _, fext = os.path.splitext(filename)
   if mode == "output" and fext == '.dat':
     error = "For output, only database files supported (.sqlite)"
     return JsonResponse( { "data" : data , "error" : error } )
 
-  if listType == 'commodity':
-    input["--comm"] = True
-
-  elif listType == 'technology':
-    input["--tech"] = True
-
-  elif listType == 'scenario':
-    input["--scenario"] = True
-  
-  elif listType == 'period':
-    input["--period"] = True  
-    
   try:
-    data = get_comm_tech.get_info(input)
-  except:
+    data = file_index.get_list(filename, listType)
+  except Exception as e:
+    metrics.record_error(e)
     error = 'An error occured. Please try again.'  
       
   
-  return JsonResponse( { "data" : data , "error" : error } )
+  return JsonResponse( { "data" : data , "error" : error } )
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Per-run workspaces, so runs of the same input and scenario never delete or
+overwrite each other's files. A run gets RUN_WORKSPACE_DIR/<run id>/ with
+
+  input/   a clone of the input file
+  db_io/   the folder Temoa writes the run folder into
+  output/  the scratch copy of the output database (see result_writer)
+
+.dat inputs are hardlinked, uploads are replaced and never rewritten in
+place. Databases can be the target of result merges, so they are reflinked
+(or copied) under the database's shared lock to get a consistent snapshot.
+
+When the run is done its folder is moved to db_io/<folder>@<run id>, which
+stays that run's result, and the shared name db_io/<folder> is a symlink
+switched to it with one atomic rename. Older versions are left to the
+artifact sweeper. The workspace is removed either way.
+"""
+
+from django.conf import settings
+
+import fcntl
+import os
+import shutil
+import uuid
+
+from .fileutils import clone_file, makedirs
+from . import dat_reader
+from . import result_writer
+
+SHARED_DIR = 'db_io/'
+LOCK_DIR = '.locks/'
+
+
+def versioned(folder, run_id):
+  """
+  Folder of one run's results, for the shared folder name it promotes
+  """
+  return folder + '@' + run_id
+
+
+class Workspace(object):
+
+  def __init__(self, run_id):
+    self.run_id = run_id
+    self.path = settings.RUN_WORKSPACE_DIR + run_id + '/'
+    self.clone = None
+
+  def dir(self, name):
+    path = self.path + name
+    makedirs(path)
+    return path
+
+  def run_folder(self, folder):
+    return os.path.join(self.path + SHARED_DIR, folder)
+
+  def clone_input(self, source):
+    """
+    Clone of the input file inside the workspace, under the same name so
+    Temoa names the run folder as before
+    """
+    target = os.path.join(self.dir('input'), os.path.basename(source))
+    if dat_reader.is_dat(source):
+      self.clone = clone_file(source, target, link=True)
+    else:
+      with result_writer.DatabaseLock(source, exclusive=False):
+        self.clone = clone_file(source, target)
+    return target
+
+  def promote(self, folder):
+    """
+    Move the run folder of the workspace to RESULT_DIR/db_io/<folder>@<run
+    id> and point db_io/<folder> at it. Returns the run's own folder
+    relative to RESULT_DIR, or None if the run wrote no folder.
+    """
+    source = self.run_folder(folder)
+    if not os.path.isdir(source):
+      return None
+
+    shared = settings.RESULT_DIR + SHARED_DIR
+    version = versioned(folder, self.run_id)
+    makedirs(shared + LOCK_DIR)
+    os.rename(source, shared + version)
+
+    link = shared + folder
+    tmp = shared + '.' + version + '.link'
+    os.symlink(version, tmp)
+    with open(shared + LOCK_DIR + folder + '.lock', 'a') as lock:
+      #promotions of the same folder wait for each other
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      if os.path.isdir(link) and not os.path.islink(link):
+        #a folder written before runs had their own
+        os.rename(link, link + '@' + uuid.uuid4().hex)
+      os.rename(tmp, link)
+
+    return SHARED_DIR + version
+
+  def remove(self):
+    shutil.rmtree(self.path, ignore_errors=True)
+
@@ -0,0 +1,136 @@
+"""
+Zip archives generated while they are sent. Entries use data descriptors,
+so nothing is seeked back to and nothing is written to disk; memory use is
+one read block plus the central directory entries.
+"""
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+
+import os
+import struct
+import time
+import urllib
+import zlib
+
+BLOCK_SIZE = 64 * 1024
+
+#already compressed, deflating them again only costs CPU
+STORED_EXTENSIONS = ('.zip', '.gz', '.bz2', '.xz', '.png', '.jpg', '.jpeg', '.gif', '.xlsx', '.xls')
+
+ZIP_MAX = 0xFFFFFFFF
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+DEFLATED = 8
+STORED = 0
+
+
+def _dos_time(mtime):
+  t = time.localtime(mtime)
+  if t.tm_year < 1980:
+    return 0, (0 << 9) | (1 << 5) | 1
+  return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+    ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def walk(path, arcroot):
+  """
+  (arcname, file path) for a file or every file below a directory
+  """
+  if os.path.isfile(path):
+    yield arcroot, path
+    return
+
+  for root, dirs, files in os.walk(path):
+    dirs.sort()
+    for name in sorted(files):
+      filepath = os.path.join(root, name)
+      yield arcroot + '/' + os.path.relpath(filepath, path).replace(os.sep, '/'), filepath
+
+
+def generate(entries, store=False):
+  """
+  Yield the bytes of a zip holding the (arcname, file path) entries
+  """
+  offset = 0
+  central = []
+
+  for arcname, filepath in entries:
+    if isinstance(arcname, unicode):
+      name = arcname.encode('utf-8')
+    else:
+      name = arcname
+    st = os.stat(filepath)
+    dostime, dosdate = _dos_time(st.st_mtime)
+    method = STORED if store or filepath.lower().endswith(STORED_EXTENSIONS) else DEFLATED
+    flags = FLAG_DATA_DESCRIPTOR | FLAG_UTF8
+
+    if offset > ZIP_MAX:
+      raise ValueError("Archive too large for zip without zip64")
+
+    header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, method, dostime, dosdate, 0, 0, 0, len(name), 0) + name
+    yield header
+    header_offset = offset
+    offset += len(header)
+
+    crc = 0
+    size = 0
+    compressed_size = 0
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if method == DEFLATED else None
+
+    with open(filepath, 'rb') as f:
+      for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        if compressor:
+          block = compressor.compress(block)
+        if block:
+          compressed_size += len(block)
+          yield block
+      if compressor:
+        block = compressor.flush()
+        compressed_size += len(block)
+        yield block
+
+    if size > ZIP_MAX or compressed_size > ZIP_MAX:
+      raise ValueError("%s is too large for zip without zip64" % arcname)
+
+    crc &= 0xFFFFFFFF
+    descriptor = struct.pack('<IIII', 0x08074b50, crc, compressed_size, size)
+    yield descriptor
+    offset += compressed_size + len(descriptor)
+
+    central.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 20, 20, flags, method,
+      dostime, dosdate, crc, compressed_size, size, len(name), 0, 0, 0, 0,
+      (st.st_mode & 0xFFFF) << 16, header_offset) + name)
+
+  directory = b''.join(central)
+  yield directory
+  yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(central), len(central), len(directory), offset, 0)
+
+
+def resolve(relpath):
+  """
+  Absolute path of a path relative to RESULT_DIR, None if it points outside
+  """
+  root = os.path.realpath(settings.RESULT_DIR)
+  path = os.path.realpath(os.path.join(root, relpath))
+  if path != root and path.startswith(root + os.sep) and os.path.exists(path):
+    return path
+  return None
+
+
+def download_url(paths, name=None, store=False, roots=None):
+  """
+  Url of the download view zipping the given paths (relative to RESULT_DIR).
+  roots names the folder of each path in the zip, its basename by default.
+  """
+  query = [('path', p) for p in paths]
+  if roots:
+    query += [('root', r) for r in roots]
+  if name:
+    query.append(('name', name))
+  if store:
+    query.append(('store', '1'))
+  return reverse('download') + '?' + urllib.urlencode(query)
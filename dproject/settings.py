@@ -21,7 +21,113 @@ UPLOADED_DIR = BASE_DIR + '/uploads/uploaded/files/'
 
 CONFIG_TEMP = BASE_DIR + '/uploads/uploaded/config_temp/'
 
+# Chunked uploads in progress and the content addressed store the upload
+# names link to (dapp/uploads.py, dapp/content_store.py)
+UPLOAD_PARTIAL_DIR = BASE_DIR + '/uploads/uploaded/partial/'
+UPLOAD_STORE_DIR = BASE_DIR + '/uploads/uploaded/store/'
+UPLOAD_CHUNK_SIZE = 8 * 1024 ** 2
+UPLOAD_PARTIAL_MAX_AGE = 24 * 3600
+# Seconds between removals of stored contents no file name links to
+UPLOAD_STORE_GC_INTERVAL = 10 * 60
+
 RESULT_DIR = BASE_DIR + '/result/'
+# Output databases the runs write into before their results are merged
+# into the shared one (dapp/result_writer.py)
+RESULT_SCRATCH_DIR = RESULT_DIR + 'scratch/'
+# One folder per model run, holding its input clone and run folder (dapp/workspace.py)
+RUN_WORKSPACE_DIR = RESULT_DIR + 'workspaces/'
+
+# Background model runs (dapp/jobs.py, manage.py runjobs)
+# Pool size, None for one process per CPU
+JOB_WORKERS = None
+# Memory reserved per running solve when deciding how many solves to start
+SOLVE_MEMORY_BYTES = 2 * 1024 ** 3
+JOB_POLL_INTERVAL = 2
+# Solver workers preload Pyomo and Temoa and are replaced after this many
+# runs or once their RSS passes the limit (dapp/solver_pool.py)
+JOB_MAX_RUNS_PER_WORKER = 50
+JOB_WORKER_MAX_RSS = 1536 * 1024 ** 2
+JOB_PRELOAD_SOLVER = 'glpk'
+JOB_POOL_STATS = RESULT_DIR + 'debug_logs/solver_pool.json'
+# Admission control (dapp/admission.py): runs solving at once over the job
+# runner and the web workers, None for JOB_WORKERS
+JOB_MAX_RUNNING = None
+JOB_ADMISSION_LOCK = RESULT_DIR + 'debug_logs/admission.lock'
+# Run duration assumed for queue estimates until runs have finished
+JOB_DEFAULT_RUN_SECONDS = 600
+# Per run limits in the solver workers, None for no limit
+JOB_RUN_MAX_CPU_SECONDS = 6 * 3600
+JOB_RUN_MAX_WALL_SECONDS = 12 * 3600
+JOB_RUN_MAX_ADDRESS_SPACE = 8 * 1024 ** 3
+JOB_RUN_LIMIT_CHECK_INTERVAL = 5
+
+# Per-run logs (dapp/runlog.py): output in RUN_LOG_DIR/<run_id>.log, Temoa's
+# debug logs in RUN_LOG_DIR/<run_id>/. Idle logs are gzipped, old ones removed, and
+# logs over RUN_LOG_MAX_BYTES rotated by copy and truncate.
+RUN_LOG_DIR = RESULT_DIR + 'debug_logs/runs/'
+RUN_LOG_TAIL_MAX_BYTES = 1024 ** 2
+RUN_LOG_MAX_BYTES = 50 * 1024 ** 2
+RUN_LOG_DIR_MAX_BYTES = 2 * 1024 ** 3
+RUN_LOG_COMPRESS_AGE = 24 * 3600
+RUN_LOG_MAX_AGE = 30 * 24 * 3600
+RUN_LOG_ROTATE_INTERVAL = 600
+
+# Results of identical model runs (dapp/result_cache.py)
+RESULT_CACHE_DIR = RESULT_DIR + 'cache/runs/'
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Rendered runInput diagrams, per mode under RESULT_DIR/<mode>/cache/ (dapp/diagram_cache.py)
+DIAGRAM_CACHE_MAX_BYTES = 512 * 1024 ** 2
+# Processes rendering the diagrams of several periods at once, per request
+DIAGRAM_WORKERS = 4
+# Seconds a request waits for the diagrams of all periods
+DIAGRAM_TIMEOUT = 120
+# Input network graphs assembled once per database, and the node budget of
+# their level of detail views (dapp/network.py)
+NETWORK_CACHE_DIR = RESULT_DIR + 'cache/network/'
+NETWORK_CACHE_MAX_BYTES = 256 * 1024 ** 2
+NETWORK_NODE_BUDGET = 150
+# Farthest a neighborhood view reaches from its center
+NETWORK_MAX_HOPS = 6
+
+# Output plots: loaded output tables per worker, drawn PNGs on disk (dapp/plot_cache.py)
+PLOT_DATA_CACHE_SIZE = 16
+PLOT_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+# Shared read-only (PRAGMA query_only) connections to uploaded databases, per worker (dapp/dbpool.py)
+SQLITE_POOL_SIZE = 32
+SQLITE_MMAP_SIZE = 256 * 1024 ** 2
+SQLITE_CACHE_KB = 64 * 1024
+
+# Generated artifacts tracked in ARTIFACT_DB, removed after max_age seconds
+# without access or least recently used first over max_bytes (dapp/artifacts.py).
+# exclude names cache folders which evict themselves.
+ARTIFACT_DB = RESULT_DIR + 'cache/artifacts.sqlite'
+ARTIFACT_AREAS = {
+    'db_io' : { 'path' : RESULT_DIR + 'db_io/', 'max_bytes' : 5 * 1024 ** 3, 'exclude' : ['.locks'] },
+    'matplot' : { 'path' : RESULT_DIR + 'matplot/', 'max_bytes' : 1024 ** 3, 'exclude' : ['cache'] },
+    'input' : { 'path' : RESULT_DIR + 'input/', 'max_bytes' : 1024 ** 3, 'exclude' : ['cache', 'lod'] },
+    'output' : { 'path' : RESULT_DIR + 'output/', 'max_bytes' : 1024 ** 3, 'exclude' : ['cache', 'render'] },
+    'render' : { 'path' : RESULT_DIR + 'output/render/', 'max_age' : 3600 },
+    'config_temp' : { 'path' : CONFIG_TEMP, 'max_age' : 24 * 3600 },
+    'scratch' : { 'path' : RESULT_SCRATCH_DIR, 'max_age' : 7 * 24 * 3600 },
+    'workspaces' : { 'path' : RUN_WORKSPACE_DIR, 'max_age' : 2 * 24 * 3600 },
+}
+# Entries accessed more recently are never removed (runs still writing)
+ARTIFACT_MIN_AGE = 15 * 60
+ARTIFACT_SWEEP_INTERVAL = 10 * 60
+# Count atime as an access where the filesystem updates it
+ARTIFACT_USE_ATIME = False
+
+# Per-process metrics files merged by /metrics (dapp/metrics.py)
+METRICS_DIR = RESULT_DIR + 'metrics/'
+METRICS_FLUSH_INTERVAL = 5
+
+# manage.py benchmark results; baseline.json is what new runs are compared to
+BENCHMARK_DIR = RESULT_DIR + 'benchmarks/'
+
+# Minimum seconds between output database polls for MGA iteration progress (dapp/mga.py)
+MGA_PROGRESS_INTERVAL = 2
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.9/howto/deployment/checklist/
@@ -48,6 +154,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'dapp.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware', 
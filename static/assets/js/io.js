@@ -153,7 +153,7 @@ function initForm(mode) {
             displayNetworkDiagram(data.mode, data.filename );
 
             //Make download button ready
-            $("#download-button").addClass("btn-yellow").attr("href", "/static/" + data.zip_path);
+            $("#download-button").addClass("btn-yellow").attr("href", data.zip_path.charAt(0) == "/" ? data.zip_path : "/static/" + data.zip_path);
 
         },
        'json' // I expect a JSON response
@@ -288,7 +288,7 @@ function initForm() {
                     end_index = zip.lastIndexOf('}');
                     zippath = zip.substring(start_index, end_index);
                     if(zippath != "")
-                        $("#download-button").addClass("btn-yellow").attr("href", "/static/" + zippath);
+                        $("#download-button").addClass("btn-yellow").attr("href", zippath.charAt(0) == "/" ? zippath : "/static/" + zippath);
                 }
 
                 $(".spinner").addClass("invisible");